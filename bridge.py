@@ -2,6 +2,12 @@
 # UART v3 protocol: SLIP framing + CRC16 + (type, seq) + pack payload
 import struct
 import time
+from array import array
+
+try:
+    import micropython
+except ImportError:  # CPython
+    micropython = None
 
 # SLIP constants
 _END = 0xC0
@@ -11,9 +17,13 @@ _ESC_ESC = 0xDD
 
 # Protocol
 V3 = 3
+V3X = 4  # V3 plus a cumulative ack field, used once both sides negotiated "ack"
 T_REQ  = 1
 T_RESP = 2
 T_ACK  = 3
+T_DATA = 4    # ESP32 -> Pico: socket data pushed by sock_stream_start, seq = sid
+T_CREDIT = 5  # Pico -> ESP32: stream ack and credit, seq = sid
+T_WINDOW = 6  # either way: link flow control ("flow" cap), seq = 0
 
 # Packet layout (before SLIP):
 # [0]=ver (1)
@@ -22,127 +32,416 @@ T_ACK  = 3
 # [4:6]=plen (uint16 LE)
 # [6:8]=crc16 (uint16 LE)  crc over bytes[0:6] + payload
 # [8:]=payload (CBOR, plen bytes)
+#
+# V3X layout (same up to plen):
+# [6:8]=ack (uint16 LE)  every seq <= ack (serial order) has been received
+# [8:10]=crc16 (uint16 LE)  crc over bytes[0:8] + payload
+# [10:]=payload
 
+HDR_SIZE = 8
+HDR_SIZE_X = 10
 MAX_PAYLOAD_SIZE = 65535
 
-def _crc16_ccitt(data: bytes, init=0xFFFF) -> int:
-    crc = init
-    for b in data:
-        crc ^= (b << 8)
-        for _ in range(8):
+# Stream frames (V3 header, seq = sid), payloads not CBOR:
+# T_DATA:   [0:4]=offset (uint32 LE) of the first byte, [4:]=data.
+#           No data: end of stream, which takes one offset of its own.
+# T_CREDIT: [0:4]=offset (uint32 LE), every byte before it has arrived
+#           [4:8]=window (uint32 LE), the ESP32 may send up to offset+window
+#           [8]=flags, CREDIT_GAP: data after a lost frame was dropped
+DATA_HDR = "<I"
+DATA_HDR_SIZE = 4
+CREDIT_FMT = "<IIB"
+CREDIT_SIZE = 9
+CREDIT_GAP = 1
+
+# T_WINDOW: [0:4]=bytes read from the UART (uint32 LE), numbered as the
+#           receiver of this frame counts the bytes it wrote
+#           [4:8]=bytes written before this frame (uint32 LE)
+#           [8]=flags, WINDOW_PROBE: answer at once, WINDOW_SYNCED: [0:4] is valid
+WINDOW_FMT = "<IIB"
+WINDOW_SIZE = 9
+WINDOW_PROBE = 1
+WINDOW_SYNCED = 2
+
+CRC_INIT = 0xFFFF
+CRC_SMALL_TABLE = False  # True: 16-entry nibble table (32 B) instead of 256 entries (512 B)
+
+def _crc16_table(bits):
+    # Table for CRC16-CCITT (poly 0x1021), indexed by a byte (bits=8) or nibble (bits=4)
+    tbl = array("H", [0] * (1 << bits))
+    for i in range(1 << bits):
+        crc = i << (16 - bits)
+        for _ in range(bits):
             if crc & 0x8000:
                 crc = ((crc << 1) ^ 0x1021) & 0xFFFF
             else:
                 crc = (crc << 1) & 0xFFFF
-    return crc & 0xFFFF
+        tbl[i] = crc
+    return tbl
+
+_CRC_TABLE = _crc16_table(4 if CRC_SMALL_TABLE else 8)
+
+def _crc16_update_py(crc, buf, start, end):
+    tbl = _CRC_TABLE
+    if CRC_SMALL_TABLE:
+        for b in memoryview(buf)[start:end]:
+            crc = ((crc << 4) & 0xFFFF) ^ tbl[(crc >> 12) ^ (b >> 4)]
+            crc = ((crc << 4) & 0xFFFF) ^ tbl[(crc >> 12) ^ (b & 0x0F)]
+        return crc
+    for b in memoryview(buf)[start:end]:
+        crc = ((crc << 8) & 0xFFFF) ^ tbl[(crc >> 8) ^ b]
+    return crc
+
+_crc16_update = _crc16_update_py
+
+if micropython is not None and not CRC_SMALL_TABLE:
+    # Native fast path. Needs a port with the viper emitter (rp2, esp32);
+    # when precompiling, pass the matching -march to mpy-cross.
+    @micropython.viper
+    def _crc16_update_viper(crc: int, buf, start: int, end: int) -> int:
+        tbl = ptr16(_CRC_TABLE)
+        p = ptr8(buf)
+        i = start
+        while i < end:
+            crc = ((crc << 8) & 0xFFFF) ^ tbl[((crc >> 8) ^ p[i]) & 0xFF]
+            i += 1
+        return crc
+
+    _crc16_update = _crc16_update_viper
+
+def crc16_update(crc: int, buf, start: int = 0, end: int = None) -> int:
+    # Continue a CRC over buf[start:end]; buf may be bytes, bytearray or memoryview
+    n = len(buf)
+    if end is None or end > n:
+        end = n
+    if start < 0:
+        start = 0
+    if start >= end:
+        return crc & 0xFFFF
+    return _crc16_update(crc & 0xFFFF, buf, start, end) & 0xFFFF
+
+def _crc16_ccitt(data: bytes, init=CRC_INIT) -> int:
+    return crc16_update(init, data)
+
+_END_B = b"\xC0"
+_ESC_B = b"\xDB"
+
+def _slip_escape_into(out, idx, src, start, end):
+    # SLIP-escape src[start:end] into out at idx, return the new idx.
+    # bytes has find(): literal runs between END/ESC bytes are copied in bulk.
+    find = getattr(src, "find", None)
+    if find is None:
+        for b in memoryview(src)[start:end]:
+            if b == _END:
+                out[idx] = _ESC
+                out[idx + 1] = _ESC_END
+                idx += 2
+            elif b == _ESC:
+                out[idx] = _ESC
+                out[idx + 1] = _ESC_ESC
+                idx += 2
+            else:
+                out[idx] = b
+                idx += 1
+        return idx
+
+    omv = memoryview(out)
+    smv = memoryview(src)
+    i = start
+    nxt_end = find(_END_B, i, end)
+    nxt_esc = find(_ESC_B, i, end)
+    while i < end:
+        if nxt_end < 0:
+            j = end if nxt_esc < 0 else nxt_esc
+        elif nxt_esc < 0 or nxt_end < nxt_esc:
+            j = nxt_end
+        else:
+            j = nxt_esc
+        if j > i:
+            omv[idx:idx + j - i] = smv[i:j]
+            idx += j - i
+        if j >= end:
+            break
+        out[idx] = _ESC
+        i = j + 1
+        if j == nxt_end:
+            out[idx + 1] = _ESC_END
+            nxt_end = find(_END_B, i, end)
+        else:
+            out[idx + 1] = _ESC_ESC
+            nxt_esc = find(_ESC_B, i, end)
+        idx += 2
+    return idx
 
 def slip_encode(raw: bytes) -> bytes:
     if not raw:
         return bytes([_END, _END])
     out = bytearray(len(raw) * 2 + 2)
-    idx = 0
-    out[idx] = _END
-    idx += 1
-    for b in raw:
-        if b == _END:
-            out[idx] = _ESC
-            idx += 1
-            out[idx] = _ESC_END
-            idx += 1
-        elif b == _ESC:
-            out[idx] = _ESC
-            idx += 1
-            out[idx] = _ESC_ESC
-            idx += 1
-        else:
-            out[idx] = b
-            idx += 1
+    out[0] = _END
+    idx = _slip_escape_into(out, 1, raw, 0, len(raw))
     out[idx] = _END
     idx += 1
     return bytes(out[:idx])
 
 class SlipStream:
     def __init__(self, max_frame_size=8192):
-        self._buf = bytearray()
+        # Frames are assembled in a preallocated buffer; oversized frames are dropped
+        self._buf = bytearray(max_frame_size)
+        self._mv = memoryview(self._buf)
+        self._n = 0
         self._esc = False
+        self._drop = False
         self._max_frame_size = max_frame_size
 
-    def _buf_clear(self):
-        # MicroPython compatibility across ports/builds
-        try:
-            self._buf.clear()
-            return
-        except AttributeError:
-            pass
-        try:
-            self._buf[:] = b""
-            return
-        except TypeError:
-            # Some builds don't support slice operations on bytearray
-            self._buf = bytearray()
+    def _put(self, b):
+        if self._n < self._max_frame_size:
+            self._buf[self._n] = b
+            self._n += 1
+        else:
+            self._drop = True
+
+    def _put_run(self, src, start, end):
+        m = end - start
+        if self._n + m <= self._max_frame_size:
+            self._mv[self._n:self._n + m] = src[start:end]
+            self._n += m
+        else:
+            self._drop = True
 
     def feed(self, data: bytes):
+        # Returns a list of completed frames as bytes (one copy per frame)
         if not data:
             return []
         frames = []
-        for b in data:
-            if b == _END:
-                if self._buf:
-                    if len(self._buf) <= self._max_frame_size:
-                        frames.append(bytes(self._buf))
-                    self._buf_clear()
-                self._esc = False
-                continue
+        self.feed_views(data, lambda mv: frames.append(bytes(mv)))
+        return frames
 
+    def feed_views(self, data: bytes, handler) -> int:
+        # Calls handler(frame) for each completed frame, returns the frame count.
+        # frame is a memoryview over the internal frame buffer: it is only valid
+        # until handler returns, the next frame (even from the same data) reuses
+        # the buffer. Copy it (bytes(frame)) to keep it.
+        if not data:
+            return 0
+        count = 0
+        find = getattr(data, "find", None)
+        if find is None:
+            data = bytes(data)
+            find = data.find
+        src = memoryview(data)
+        n = len(data)
+        i = 0
+        nxt_end = -1
+        nxt_esc = -1
+        while i < n:
             if self._esc:
-                if b == _ESC_END:
-                    self._buf.append(_END)
-                elif b == _ESC_ESC:
-                    self._buf.append(_ESC)
-                else:
-                    self._buf.append(b)
+                b = data[i]
+                if b != _END:
+                    # Escape sequence, handled per byte
+                    if b == _ESC_END:
+                        self._put(_END)
+                    elif b == _ESC_ESC:
+                        self._put(_ESC)
+                    else:
+                        self._put(b)
+                    self._esc = False
+                    i += 1
+                    continue
                 self._esc = False
-                continue
 
-            if b == _ESC:
+            # Scan for the next END/ESC and copy the literal run before it in bulk
+            if nxt_end < i:
+                nxt_end = find(_END_B, i)
+                if nxt_end < 0:
+                    nxt_end = n
+            if nxt_esc < i:
+                nxt_esc = find(_ESC_B, i)
+                if nxt_esc < 0:
+                    nxt_esc = n
+            j = nxt_end if nxt_end < nxt_esc else nxt_esc
+            if j > i:
+                self._put_run(src, i, j)
+            if j >= n:
+                break
+            if j == nxt_end:
+                m = self._n
+                drop = self._drop
+                self._n = 0
+                self._drop = False
+                if m and not drop:
+                    count += 1
+                    handler(self._mv[:m])
+            else:
                 self._esc = True
-                continue
+            i = j + 1
 
-            if len(self._buf) < self._max_frame_size:
-                self._buf.append(b)
+        return count
 
-        return frames
+def frame_size(plen: int) -> int:
+    # Worst-case SLIP-encoded size of a packet carrying plen payload bytes
+    return 2 * (HDR_SIZE_X + plen) + 2
 
-def pack_packet(msg_type: int, seq: int, payload: bytes = b"") -> bytes:
+def pack_packet_into(buf, msg_type: int, seq: int, payload=b"", ack=None) -> int:
+    # Encode a SLIP-framed packet straight into buf, return the used length.
+    # buf must hold frame_size(len(payload)) bytes; payload may be a memoryview.
+    # With an ack value the packet is sent as V3X and carries that cumulative ack.
     if payload is None:
         payload = b""
     plen = len(payload)
     if plen > MAX_PAYLOAD_SIZE:
         raise ValueError(f"Payload too large: {plen} > {MAX_PAYLOAD_SIZE}")
-    hdr_wo_crc = bytes([V3, msg_type]) + struct.pack("<HH", seq & 0xFFFF, plen & 0xFFFF)
-    crc = _crc16_ccitt(hdr_wo_crc + payload)
-    raw = hdr_wo_crc + struct.pack("<H", crc) + payload
-    return slip_encode(raw)
+    need = frame_size(plen)
+    if len(buf) < need:
+        raise ValueError(f"Buffer too small: {len(buf)} < {need}")
+    if ack is None:
+        hlen = HDR_SIZE
+        hdr = bytearray(hlen)
+        struct.pack_into("<BBHH", hdr, 0, V3, msg_type, seq & 0xFFFF, plen)
+    else:
+        hlen = HDR_SIZE_X
+        hdr = bytearray(hlen)
+        struct.pack_into("<BBHHH", hdr, 0, V3X, msg_type, seq & 0xFFFF, plen, ack & 0xFFFF)
+    crc = crc16_update(crc16_update(CRC_INIT, hdr, 0, hlen - 2), payload)
+    struct.pack_into("<H", hdr, hlen - 2, crc)
+    buf[0] = _END
+    idx = _slip_escape_into(buf, 1, hdr, 0, hlen)
+    idx = _slip_escape_into(buf, idx, payload, 0, plen)
+    buf[idx] = _END
+    return idx + 1
 
-def unpack_packet(raw: bytes):
-    # returns (msg_type, seq, payload_bytes) or None if invalid
-    if raw is None or len(raw) < 8:
+def pack_packet(msg_type: int, seq: int, payload: bytes = b"", ack=None) -> bytes:
+    if payload is None:
+        payload = b""
+    buf = bytearray(frame_size(len(payload)))
+    n = pack_packet_into(buf, msg_type, seq, payload, ack)
+    return bytes(memoryview(buf)[:n])
+
+def unpack_packet_view(raw):
+    # returns (msg_type, seq, payload_view) or None if invalid.
+    # payload_view is a memoryview into raw, valid as long as raw is.
+    # Accepts V3 and V3X packets, see packet_ack() for the V3X ack field.
+    if raw is None or len(raw) < HDR_SIZE:
         return None
     ver = raw[0]
-    if ver != V3:
+    if ver == V3:
+        hlen = HDR_SIZE
+    elif ver == V3X:
+        hlen = HDR_SIZE_X
+    else:
         return None
     msg_type = raw[1]
-    seq, plen = struct.unpack("<HH", raw[2:6])
-    crc = struct.unpack("<H", raw[6:8])[0]
-    if len(raw) != 8 + plen:
+    seq, plen = struct.unpack_from("<HH", raw, 2)
+    if len(raw) != hlen + plen:
         return None
     if plen > MAX_PAYLOAD_SIZE:
         return None
-    payload = raw[8:8+plen]
-    calc = _crc16_ccitt(raw[0:6] + payload)
+    crc = struct.unpack_from("<H", raw, hlen - 2)[0]
+    calc = crc16_update(crc16_update(CRC_INIT, raw, 0, hlen - 2), raw, hlen, hlen + plen)
     if calc != crc:
         return None
-    return (msg_type, seq, payload)
+    return (msg_type, seq, memoryview(raw)[hlen:hlen + plen])
+
+def packet_ack(raw):
+    # Cumulative ack carried by a valid V3X packet, None for V3
+    if raw[0] != V3X:
+        return None
+    return raw[6] | (raw[7] << 8)
+
+def packet_crc(raw):
+    # CRC field of a valid packet; with seq it identifies a retransmitted frame
+    i = HDR_SIZE_X - 2 if raw[0] == V3X else HDR_SIZE - 2
+    return raw[i] | (raw[i + 1] << 8)
+
+def unpack_packet(raw: bytes):
+    # returns (msg_type, seq, payload_bytes) or None if invalid
+    pkt = unpack_packet_view(raw)
+    if pkt is None:
+        return None
+    msg_type, seq, payload = pkt
+    return (msg_type, seq, bytes(payload))
+
+def seq_next(seq: int) -> int:
+    # Sequence numbers run 1..65535, 0 is never used
+    seq = (seq + 1) & 0xFFFF
+    return seq or 1
+
+def seq_prev(seq: int) -> int:
+    seq = (seq - 1) & 0xFFFF
+    return seq or 0xFFFF
+
+def seq_le(a: int, b: int) -> bool:
+    # a <= b in 16-bit serial number order
+    return ((b - a) & 0xFFFF) < 0x8000
+
+def off_diff(a: int, b: int) -> int:
+    # a - b for uint32 stream offsets that wrap around
+    d = (a - b) & 0xFFFFFFFF
+    return d - 0x100000000 if d & 0x80000000 else d
+
+# Compact request form, negotiated with the "compact" cap: the request is
+# [opcode, arg, ...] instead of {"op": name, "args": {...}}. The opcode is the
+# index in OP_ARGS and args are given in its order. Append new ops only, and
+# new args at the end of an op, the opcodes are part of the wire format.
+OP_ARGS = (
+    ("hello", ("caps",)),
+    ("sock_reset", ()),
+    ("ping", ()),
+    ("get_time", ()),
+    ("set_time", ("host",)),
+    ("wifi_status", ()),
+    ("dns", ("host", "port", "family", "type", "proto")),
+    ("sock_open", ("family", "type", "proto")),
+    ("sock_settimeout", ("sid", "timeout_ms")),
+    ("sock_connect", ("sid", "host", "port", "ssl", "timeout_ms", "pool")),
+    ("sock_send", ("sid", "data", "all")),
+    ("sock_recv", ("sid", "n", "ssl", "timeout_ms")),
+    ("sock_close", ("sid", "pool")),
+    ("sock_bind", ("sid", "host", "port")),
+    ("sock_listen", ("sid", "backlog")),
+    ("sock_accept", ("sid", "timeout_ms")),
+    ("sock_sendto", ("sid", "data", "host", "port")),
+    ("sock_recvfrom", ("sid", "n", "timeout_ms")),
+    ("sock_wrap_ssl", ("sid", "server_hostname", "verify", "reuse")),
+    ("sock_stream_start", ("sid", "credit")),
+    ("sock_stream_stop", ("sid",)),
+    ("batch", ("ops", "stop")),
+    ("dns_flush", ("host",)),
+)
+OP_CODES = {name: code for code, (name, _) in enumerate(OP_ARGS)}
+
+def compact_request(op: str, args: dict):
+    # [opcode, args...] or None when op/args have no compact form.
+    # A None arg is the same as a missing one.
+    code = OP_CODES.get(op)
+    if code is None:
+        return None
+    names = OP_ARGS[code][1]
+    for k in args:
+        if k not in names:
+            return None
+    req = [code]
+    for k in names:
+        req.append(args.get(k))
+    while len(req) > 1 and req[-1] is None:
+        req.pop()
+    return req
+
+def expand_request(req):
+    # Either request form to (op, args dict); op is None if not understood
+    if isinstance(req, dict):
+        return req.get("op"), req.get("args", {}) or {}
+    if not isinstance(req, (list, tuple)) or not req:
+        return None, {}
+    code = req[0]
+    if not isinstance(code, int) or not 0 <= code < len(OP_ARGS):
+        return None, {}
+    op, names = OP_ARGS[code]
+    args = {}
+    for i in range(min(len(names), len(req) - 1)):
+        v = req[i + 1]
+        if v is not None:
+            args[names[i]] = v
+    return op, args
 
 def ticks_ms():
     return time.ticks_ms()
@@ -153,3 +452,275 @@ def ticks_add(a, b):
 def ticks_diff(a, b):
     return time.ticks_diff(a, b)
 
+
+# Link flow control, negotiated with the "flow" cap. Without RTS/CTS a UART
+# drops what arrives while its rx buffer is full, so each side counts the
+# bytes it writes and reads, tells the other how far it has read (T_WINDOW),
+# and keeps at most the peer's rx buffer size in flight. ACK, T_CREDIT and
+# T_WINDOW frames are small and go out regardless, FLOW_RESERVE bytes are
+# kept free for them.
+FLOW_RESERVE = 256
+FLOW_PROBE_MS = 20       # a stalled sender asks for an update after this,
+FLOW_PROBE_MAX_MS = 1000 # doubling up to this while none comes
+
+class FlowControl:
+    def __init__(self, write, rxbuf):
+        self._write = write     # write(frame) to the UART
+        self.rxbuf = rxbuf      # our rx buffer, advertised to the peer
+        self.peer_rxbuf = None  # None: off, every frame may go out
+        self.tx = 0             # bytes written (uint32)
+        self.rx = 0             # bytes read, numbered as the peer wrote them once synced
+        self.synced = False
+        self.peer_rx = 0        # the peer has read every byte before this
+        self.stalls = 0
+        self._told = 0
+        self._probe_at = ticks_ms()
+        self._probe_ms = FLOW_PROBE_MS
+        self._buf = bytearray(frame_size(WINDOW_SIZE))
+
+    def enable(self, peer_rxbuf):
+        # Start counting in-flight bytes against peer_rxbuf; both sides
+        # renumber on the first T_WINDOW of the other
+        self.peer_rxbuf = max(int(peer_rxbuf), 2 * FLOW_RESERVE)
+        self.peer_rx = self.tx
+        self.synced = False
+        self._send(WINDOW_PROBE)
+
+    def disable(self):
+        self.peer_rxbuf = None
+        self.synced = False
+
+    def write(self, frame):
+        # Every frame goes through here, to be counted
+        self.tx = (self.tx + len(frame)) & 0xFFFFFFFF
+        return self._write(frame)
+
+    def room(self):
+        # Bytes that may still be sent without overrunning the peer
+        if self.peer_rxbuf is None:
+            return MAX_PAYLOAD_SIZE
+        return self.peer_rxbuf - FLOW_RESERVE - off_diff(self.tx, self.peer_rx)
+
+    def can_send(self, n):
+        # True when n more bytes fit; a frame larger than the peer's buffer
+        # once no more than FLOW_RESERVE is in flight. False asks the peer
+        # for an update from time to time, so call it again later.
+        if self.peer_rxbuf is None:
+            return True
+        room = self.room()
+        if n <= room or room >= self.peer_rxbuf - 2 * FLOW_RESERVE:
+            return True
+        now = ticks_ms()
+        if ticks_diff(now, self._probe_at) >= 0:
+            self.stalls += 1
+            self._send(WINDOW_PROBE)
+            self._probe_at = ticks_add(now, self._probe_ms)
+            self._probe_ms = min(self._probe_ms << 1, FLOW_PROBE_MAX_MS)
+        return False
+
+    def received(self, n):
+        # n bytes were read from the UART; tell the peer every quarter buffer
+        self.rx = (self.rx + n) & 0xFFFFFFFF
+        if self.peer_rxbuf is not None and self.synced and off_diff(self.rx, self._told) >= self.rxbuf >> 2:
+            self._send(0)
+
+    def on_window(self, payload):
+        if len(payload) < WINDOW_SIZE:
+            return
+        rx, tx, flags = struct.unpack(WINDOW_FMT, bytes(payload[:WINDOW_SIZE]))
+        # Everything the peer wrote before this frame has been read here, or
+        # was lost on the wire: count from its numbering
+        if not self.synced or off_diff(tx, self.rx) > 0:
+            self.rx = self._told = tx
+            self.synced = True
+        if flags & WINDOW_SYNCED and off_diff(rx, self.peer_rx) > 0 and off_diff(rx, self.tx) <= 0:
+            self.peer_rx = rx
+            self._probe_ms = FLOW_PROBE_MS
+            self._probe_at = ticks_ms()
+        if flags & WINDOW_PROBE:
+            self._send(0)
+
+    def _send(self, flags):
+        if self.synced:
+            flags |= WINDOW_SYNCED
+            self._told = self.rx
+        payload = struct.pack(WINDOW_FMT, self.rx, self.tx, flags)
+        n = pack_packet_into(self._buf, T_WINDOW, 0, payload)
+        self.write(memoryview(self._buf)[:n])
+
+
+# Waiting for UART input. An idle loop that sleeps 1 ms between uart.any()
+# calls adds up to 1 ms to every frame and never lets the CPU rest for
+# long. UartWait.wait() returns as soon as input is there, using the first
+# the port offers: an RX interrupt (UART.irq) that ends machine.idle(),
+# select.poll on the UART, or 1 ms sleeps as before.
+class UartWait:
+    def __init__(self, uart, mode=None):
+        # mode: "irq", "poll" or "sleep", None for the best one available
+        self.uart = uart
+        self.mode = "sleep"
+        self.wakeups = 0   # waits ended by input
+        self.timeouts = 0  # waits that ran out
+        self._flag = False
+        if mode in (None, "irq") and self._setup_irq():
+            self.mode = "irq"
+        elif mode in (None, "poll") and self._setup_poll():
+            self.mode = "poll"
+
+    def _setup_irq(self):
+        # RXIDLE fires once the line goes quiet after a frame, RX per byte
+        # or FIFO fill where there is no RXIDLE
+        cls = type(self.uart)
+        trigger = getattr(cls, "IRQ_RXIDLE", None) or getattr(cls, "IRQ_RX", None)
+        if trigger is None or not hasattr(self.uart, "irq"):
+            return False
+        try:
+            import machine
+            self._idle = machine.idle
+            self.uart.irq(handler=self._on_irq, trigger=trigger)
+        except Exception:
+            return False
+        return True
+
+    def _on_irq(self, uart):
+        self._flag = True
+
+    def _setup_poll(self):
+        try:
+            import select
+            self._poller = select.poll()
+            self._poller.register(self.uart, select.POLLIN)
+        except Exception:
+            return False
+        return True
+
+    def wait(self, timeout_ms):
+        # True once the UART has input, False after timeout_ms without
+        # (in "sleep" mode after at most 1 ms, callers loop anyway)
+        any_ = self.uart.any
+        if self.mode == "irq":
+            # Bytes of a frame still coming in do not end the wait, the
+            # interrupt after them does; a read in between costs a wakeup
+            deadline = ticks_add(ticks_ms(), timeout_ms)
+            idle = self._idle
+            while not self._flag:
+                if ticks_diff(deadline, ticks_ms()) <= 0:
+                    self.timeouts += 1
+                    return bool(any_())
+                idle()  # until the next interrupt, the UART's or the tick
+            self._flag = False
+            self.wakeups += 1
+            return True
+        if any_():
+            return True
+        if self.mode == "poll":
+            if not self._poller.poll(timeout_ms):
+                self.timeouts += 1
+                return False
+        else:
+            time.sleep_ms(min(1, timeout_ms))
+            if not any_():
+                self.timeouts += 1
+                return False
+        self.wakeups += 1
+        return True
+
+
+# Name lookups. getaddrinfo() blocks for a DNS round trip over WiFi, tens
+# to hundreds of ms, on every call. DnsCache keeps results by (host, port,
+# family, type, proto) for ttl_ms, and failures for neg_ttl_ms so a name
+# that does not resolve is not retried on every connect. At most
+# max_entries are kept, the least recently used goes first; the cache is
+# small, finding it is a scan. A ttl of 0 turns that kind of caching off.
+class DnsCache:
+    def __init__(self, max_entries=16, ttl_ms=300_000, neg_ttl_ms=10_000):
+        self.max_entries = max_entries
+        self.ttl_ms = ttl_ms
+        self.neg_ttl_ms = neg_ttl_ms
+        self._m = {}    # key -> [expires, result or OSError, last use]
+        self._use = 0   # use counter, orders the entries for eviction
+        self.hits = 0       # lookups answered from the cache
+        self.neg_hits = 0   # ... of them with a cached failure
+        self.misses = 0     # lookups not in the cache
+        self.evictions = 0  # live entries dropped for room
+
+    def __len__(self):
+        return len(self._m)
+
+    def get(self, key):
+        # The cached result of key, None on a miss; a cached failure is
+        # raised again
+        e = self._m.get(key)
+        if e is None or ticks_diff(e[0], ticks_ms()) <= 0:
+            self.misses += 1
+            return None
+        self._use += 1
+        e[2] = self._use
+        self.hits += 1
+        r = e[1]
+        if isinstance(r, OSError):
+            self.neg_hits += 1
+            raise type(r)(*r.args)
+        return r
+
+    def peek(self, key):
+        # The cached result of key (an OSError for a failure), None when
+        # not cached; counts nothing and leaves the eviction order alone
+        e = self._m.get(key)
+        if e is None or ticks_diff(e[0], ticks_ms()) <= 0:
+            return None
+        return e[1]
+
+    def lookup(self, key, resolve, negative=None):
+        # resolve(*key) on a miss. Its OSError is cached too, unless
+        # negative(error) says it is not about the name (a lost link).
+        r = self.get(key)
+        if r is None:
+            try:
+                r = resolve(*key)
+            except OSError as ex:
+                if negative is None or negative(ex):
+                    self.add(key, ex)
+                raise
+            self.add(key, r)
+        return r
+
+    def add(self, key, result):
+        # A result, or the OSError of a failed lookup, with its TTL
+        self.put(key, result, self.neg_ttl_ms if isinstance(result, OSError) else self.ttl_ms)
+
+    def put(self, key, result, ttl_ms):
+        m = self._m
+        if ttl_ms <= 0 or self.max_entries <= 0:
+            m.pop(key, None)
+            return
+        now = ticks_ms()
+        if key not in m and len(m) >= self.max_entries:
+            # Expired entries go first, else the least recently used
+            old = None
+            for k, e in m.items():
+                if ticks_diff(e[0], now) <= 0:
+                    old = k
+                    break
+                if old is None or e[2] < m[old][2]:
+                    old = k
+            if ticks_diff(m[old][0], now) > 0:
+                self.evictions += 1
+            del m[old]
+        self._use += 1
+        m[key] = [ticks_add(now, ttl_ms), result, self._use]
+
+    def flush(self, host=None):
+        # Drop the entries of host, or all; returns how many went
+        if host is None:
+            n = len(self._m)
+            self._m.clear()
+            return n
+        keys = [k for k in self._m if k[0] == host]
+        for k in keys:
+            del self._m[k]
+        return len(keys)
+
+    def stats(self):
+        return {"entries": len(self._m), "hits": self.hits, "neg_hits": self.neg_hits,
+                "misses": self.misses, "evictions": self.evictions}
@@ -12,7 +12,49 @@ RX = 9
 RTS = 4
 CTS = 5
 
+# Modules with extra ops, each provides register_ops(op)
+OP_MODULES = ()
+
+# False: importing esp32_proxy does not start it, call esp32_proxy.main()
+# (or esp32_proxy_async.run())
+AUTOSTART = True
+
+# True: socket ops that would block are parked and completed from the main
+# loop, so one slow socket does not hold up the others
+NONBLOCKING = False
+
+# esp32_proxy_async: requests running at once, each one costs RAM
+MAX_TASKS = 8
+
+# When the main loop runs gc.collect(): "always", "alloc", "threshold" or
+# "idle" (see gcpolicy.py)
+GC_POLICY = "idle"
+
+# DNS cache of the dns op and sock_connect: names kept, and for how long a
+# result and a failed lookup are used (0: not cached)
+DNS_CACHE_MAX = 16
+DNS_TTL_MS = 300_000
+DNS_NEG_TTL_MS = 10_000
+
+# Connection pool (sock_connect/sock_close with "pool"): idle connections
+# kept, and how long one may stay unused
+POOL_MAX = 4
+POOL_IDLE_MS = 30_000
+
+# sock_wrap_ssl: CA certificates (PEM file) to check servers against, and
+# whether it does so by default (the client's verify= overrides)
+TLS_CAFILE = None
+TLS_VERIFY = False
+
+# Sockets open at once, pooled connections not counted (see Socket Table)
+SOCK_SLOTS = 16
+
+# UART rx buffer size, set by uart_setup(); with the "flow" cap the other
+# side never has more bytes than this in flight
+UART_RXBUF = 8192
+
 def uart_setup():
+    global UART_RXBUF
     try:
         rxbuf=16384
         uart = UART(
@@ -22,6 +64,7 @@ def uart_setup():
             timeout=0, rxbuf=rxbuf,
             flow=UART.RTS | UART.CTS,
         )
+        UART_RXBUF = rxbuf
         print(f"UART: {BAUD} baud, rxbuf={rxbuf}, flow=ON, timeout=0")
         print(f"PINS: tx={TX}, rx={RX}, rts={RTS}, cts={CTS}")
     except TypeError:
@@ -31,6 +74,7 @@ def uart_setup():
             tx=Pin(TX), rx=Pin(RX),
             timeout=0, rxbuf=rxbuf
         )
+        UART_RXBUF = rxbuf
         print(f"UART: {BAUD} baud, rxbuf={rxbuf}, flow=OFF, timeout=0")
         print(f"PINS: tx={TX}, rx={RX}")
     except Exception as e:
@@ -1,341 +1,869 @@
 # esp32_proxy.py
+import esp32_config
 from esp32_config import uart_setup, wifi_connect, set_time
 from cbor3 import dumps as pack, loads as unpack
 import time
 import socket
+import struct
+import select
+import errno
+import sys
 import tls # use tls directly
 import gc
+import gcpolicy
 
 from bridge import (
-    SlipStream, pack_packet, unpack_packet,
-    T_REQ, T_RESP, T_ACK,
-    ticks_ms
+    SlipStream, pack_packet_into, unpack_packet_view, frame_size,
+    packet_ack, packet_crc, expand_request,
+    T_REQ, T_RESP, T_ACK, T_DATA, T_CREDIT, T_WINDOW, FlowControl, UartWait, DnsCache, seq_next, seq_prev, seq_le,
+    DATA_HDR, DATA_HDR_SIZE, CREDIT_FMT, CREDIT_SIZE, CREDIT_GAP, off_diff,
+    ticks_ms, ticks_add, ticks_diff
 )
 
-sta = wifi_connect()
-uart = uart_setup()
-ok = set_time()
+sta = None  # WLAN station, connected by main()
 
 DEBUG = 0
-RESP_CACHE_MAX = 16
+RESP_CACHE_MAX = 32       # responses kept for replay to a retransmitted request
+RESP_CACHE_BYTES = 32768  # ... and their total size; the newest one is always kept
+REORDER_WINDOW = 16     # requests held back while an earlier seq is missing
+REORDER_WAIT_MS = 5000  # give up waiting for a missing seq after this long: more than
+                        # the Pico's longest retransmit interval (RTO_MAX_MS, 4000)
+RECENT_MAX = 64         # executed (seq, crc) pairs remembered to drop stale retransmits
+ACK_DELAY_MS = 20       # "ack" mode: stand-alone ACK only for ops slower than this
+IDLE_WAIT_MS = 20       # longest wait for UART input with nothing else to do
 SOCKET_TIMEOUT_DEFAULT = 5.0
-MAX_SID = 1024
+SOCK_SLOTS = getattr(esp32_config, "SOCK_SLOTS", 16)  # sockets open at once, see SockTable
+SID_SLOT_BITS = 8         # sid: slot + 1 in the low bits, its generation above
+SID_SLOT_MASK = (1 << SID_SLOT_BITS) - 1
+SID_GEN_MASK = 0xFF       # sids fit the 16-bit sid of T_DATA frames
+NONBLOCKING = getattr(esp32_config, "NONBLOCKING", False)  # see PendingOps
+STREAM_CHUNK = 2048       # data per T_DATA frame (sock_stream_start)
+STREAM_CREDIT_MAX = 16384 # largest credit a stream may use: unacked data kept per stream
+STREAM_RTO_MS = 300       # resend unacked stream data after this long without a credit
+BATCH_MAX = 16            # sub-requests per batch request
+DNS_CACHE_MAX = getattr(esp32_config, "DNS_CACHE_MAX", 16)        # names kept, see DnsCache
+DNS_TTL_MS = getattr(esp32_config, "DNS_TTL_MS", 300_000)         # how long a result is kept
+DNS_NEG_TTL_MS = getattr(esp32_config, "DNS_NEG_TTL_MS", 10_000)  # ... and a failure
+POOL_MAX = getattr(esp32_config, "POOL_MAX", 4)                   # idle connections kept, see ConnPool
+POOL_IDLE_MS = getattr(esp32_config, "POOL_IDLE_MS", 30_000)      # ... closed after this long unused
+TLS_CAFILE = getattr(esp32_config, "TLS_CAFILE", None)   # CA certificates for "verify", see TLSCache
+TLS_VERIFY = getattr(esp32_config, "TLS_VERIFY", False)  # sock_wrap_ssl checks the server by default
+TLS_SESSIONS_MAX = 8      # server names whose TLS session is kept for resumption
+
+# Protocol extensions this proxy offers, and those the client accepted ("hello" op)
+SUPPORTED_CAPS = ("ack", "compact", "flow")
+caps = set()
+
+class _Slot:
+    __slots__ = ("s", "typ", "created", "used", "rx", "tx", "conn", "tls")
+
+    def __init__(self, s, typ):
+        self.s = s
+        self.typ = typ          # socket type: SOCK_STREAM, SOCK_DGRAM
+        self.created = self.used = ticks_ms()
+        self.rx = 0             # bytes received
+        self.tx = 0             # bytes sent
+        self.conn = None        # (host, port) of a connect with "pool"
+        self.tls = None         # (server_hostname, verify, reuse) once wrapped in TLS
 
 class SockTable:
-    def __init__(self):
-        self._next = 0
-        self._m = {}
+    # Sockets by sid, in a fixed array of SOCK_SLOTS slots with a free list:
+    # sid = generation << 8 | slot + 1. A slot's generation goes up when it
+    # is freed, so a sid kept after its sock_close cannot reach the socket
+    # that took the slot over, and the table never hands out a sid in use.
+    def __init__(self, nonblocking=False, slots=SOCK_SLOTS):
+        slots = max(1, min(slots, SID_SLOT_MASK))
+        self._slots = [None] * slots
+        self._gen = bytearray(slots)
+        self._free = list(range(slots - 1, -1, -1))  # slot 0 (sid 1) first
+        self.opened = 0     # sockets added
+        self.stale = 0      # lookups of a closed sid
+        self.full = 0       # sockets refused, every slot in use
+        self.nonblocking = nonblocking
+        self.timeouts = {}  # non-blocking mode: sid -> sock_settimeout value (ms)
+        self.streams = None # Streams of the main loop, for sock_stream_start
+        self.flow = None    # FlowControl of the main loop, for the "flow" cap
+        self.resp_cache = None  # RespCache of the main loop, for proxy_stats
+        self.gc = None          # GCPolicy of the main loop, for proxy_stats
+        self.dns = DnsCache(DNS_CACHE_MAX, DNS_TTL_MS, DNS_NEG_TTL_MS)  # dns, sock_connect
+        self.pool = ConnPool(POOL_MAX, POOL_IDLE_MS)  # sock_connect/sock_close with "pool"
+        self.tls_cache = TLSCache()  # contexts and sessions of sock_wrap_ssl
+
+    def __len__(self):
+        return len(self._slots) - len(self._free)
 
     def new(self, family, typ, proto=0):
         s = socket.socket(family, typ, proto)
-        self._next = (self._next%MAX_SID)+1
-        sid = self._next
-        self._m[sid] = s
-        if DEBUG: print('DEBUG socktab:', self._m) 
+        if self.nonblocking:
+            s.setblocking(False)
+        return self.add(s, typ)
+
+    def add(self, s, typ=socket.SOCK_STREAM):
+        # A sid for socket s; s is closed when the table is full
+        if not self._free:
+            self.full += 1
+            _close_quietly(s)
+            raise OpError("no_free_sid", f"{len(self._slots)} sockets open")
+        i = self._free.pop()
+        self._slots[i] = _Slot(s, typ)
+        self.opened += 1
+        sid = self._gen[i] << SID_SLOT_BITS | (i + 1)
+        if DEBUG: print('DEBUG socktab: open', sid, len(self))
         return sid
 
+    def slot(self, sid):
+        # The _Slot of sid, None when it is closed or never was
+        i = (sid & SID_SLOT_MASK) - 1
+        if i < 0 or i >= len(self._slots) or sid >> SID_SLOT_BITS != self._gen[i]:
+            return None
+        return self._slots[i]
+
     def get(self, sid):
         sid = int(sid)
-        if sid not in self._m:
+        sl = self.slot(sid)
+        if sl is None:
+            self.stale += 1
             raise KeyError(f"Socket {sid} not found")
-        return self._m[sid]
+        sl.used = ticks_ms()
+        return sl.s
 
-    def close(self, sid):
+    def io(self, sid, rx=0, tx=0):
+        # Count bytes received and sent on sid
+        sl = self.slot(sid)
+        if sl is not None:
+            sl.rx += rx
+            sl.tx += tx
+
+    def sids(self):
+        # (sid, _Slot) of the open sockets, for reaping and stats
+        gen = self._gen
+        return [(gen[i] << SID_SLOT_BITS | (i + 1), sl) for i, sl in enumerate(self._slots) if sl is not None]
+
+    def _free_slot(self, sid):
+        # Empty the slot of sid, bump its generation; its _Slot or None
         sid = int(sid)
-        s = self._m.pop(sid, None)
-        if s:
-            try:
-                s.close()
-            except:
-                pass
-        if DEBUG: print('DEBUG socktab:', self._m) 
+        sl = self.slot(sid)
+        if sl is None:
+            return None
+        i = (sid & SID_SLOT_MASK) - 1
+        self._slots[i] = None
+        self._gen[i] = (self._gen[i] + 1) & SID_GEN_MASK
+        self._free.append(i)
+        self.timeouts.pop(sid, None)
+        if self.streams is not None:
+            self.streams.stop(sid)
+        return sl
+
+    def close(self, sid):
+        sl = self._free_slot(sid)
+        if sl is None:
+            return
+        if sl.tls:
+            self.tls_cache.save(sl.s, *sl.tls)  # TLS 1.3 tickets come after the handshake
+        _close_quietly(sl.s)
+        if DEBUG: print('DEBUG socktab: close', sid, len(self))
 
     def close_all(self):
-        for sid in list(self._m.keys()):
+        for sid, sl in self.sids():
             self.close(sid)
+        self.pool.clear()
 
-def handle_req(socktab: SockTable, req: dict) -> dict:
-    global sta
-    op = req.get("op")
-    args = req.get("args", {}) or {}
+    def park(self, sid):
+        # Hand the connection of sid to the pool instead of closing it; False
+        # unless it was connected with "pool"
+        sid = int(sid)
+        sl = self.slot(sid)
+        if sl is None or sl.conn is None:
+            return False
+        self._free_slot(sid)
+        host, port = sl.conn
+        self.pool.park((host, port, sl.tls is not None), sl.s, sl.tls)
+        return True
 
-    if DEBUG: print('DEBUG:', op, args)
+    def reuse(self, sid, host, port, ssl):
+        # sock_connect with "pool": sid takes over a parked connection to
+        # (host, port), with TLS when ssl. False when there is none, then
+        # sid goes to the pool on a sock_close with "pool" later.
+        sl = self.slot(sid)
+        sl.conn = (host, port)
+        got = self.pool.take((host, port, bool(ssl)))
+        if got is None:
+            return False
+        old = sl.s
+        sl.s, sl.tls = got
+        _close_quietly(old)
+        return True
 
+    def stats(self):
+        return {"open": len(self), "slots": len(self._slots), "opened": self.opened,
+                "stale": self.stale, "full": self.full}
+
+class RespCache:
+    # Encoded responses by seq, replayed when the Pico re-sends a request
+    # whose response got lost. Bounded by entries and by total bytes; the
+    # oldest go first, from a ring of slots in insertion order, so eviction
+    # never shifts a list. Entries acked by the Pico are dropped early and
+    # leave a stale slot behind, skipped when the ring reaches it.
+    def __init__(self, max_entries=RESP_CACHE_MAX, max_bytes=RESP_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._m = {}    # seq -> packet
+        self._ring = [None] * max_entries  # (seq, packet) in insertion order
+        self._head = 0  # oldest slot
+        self._used = 0  # slots from head on, stale ones included
+        self.bytes = 0
+        self.hits = 0       # retransmits answered from the cache
+        self.misses = 0     # executed retransmits with no response to replay
+        self.evictions = 0  # unacked responses dropped for room
+
+    def __len__(self):
+        return len(self._m)
+
+    def get(self, seq):
+        pkt = self._m.get(seq)
+        if pkt is not None:
+            self.hits += 1
+        return pkt
+
+    def put(self, seq, pkt):
+        self.pop(seq)
+        ring = self._ring
+        size = len(ring)
+        while self._used and (self._used == size or self.bytes + len(pkt) > self.max_bytes):
+            s, old = ring[self._head]
+            ring[self._head] = None
+            self._head = (self._head + 1) % size
+            self._used -= 1
+            if self._m.get(s) is old:
+                del self._m[s]
+                self.bytes -= len(old)
+                self.evictions += 1
+        ring[(self._head + self._used) % size] = (seq, pkt)
+        self._used += 1
+        self._m[seq] = pkt
+        self.bytes += len(pkt)
+
+    def pop(self, seq):
+        pkt = self._m.pop(seq, None)
+        if pkt is not None:
+            self.bytes -= len(pkt)
+
+    def ack(self, upto):
+        # Cumulative ack: the Pico got every response up to seq upto
+        for s in [s for s in self._m if seq_le(s, upto)]:
+            self.pop(s)
+
+    def clear(self):
+        self._m.clear()
+        self._ring = [None] * len(self._ring)
+        self._head = self._used = self.bytes = 0
+
+    def stats(self):
+        return {"entries": len(self._m), "bytes": self.bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+def _close_quietly(s):
     try:
-        # RPC like. Add more when needed
-        if op == "sock_reset":
-            # Close all sockets and clear the table
-            socktab.close_all()
-            return {"ok": True, "result": True}
-
-        if op == "ping":
-            return {"ok": True, "result": {"pong": True, "t_ms": ticks_ms(), "echo": "I see you, you see me"}}
-
-        if op == "get_time":
-            return {"ok": True, "result": {"time": time.time()}}
-
-        if op == "set_time":
-            host = args.get("host")
-            if not host:
-               host = 'pool.ntp.org' # global ntp servers pool
-            if set_time(host=host):
-               return {"ok": True, "result": {"time": time.time()}}
+        s.close()
+    except:
+        pass
+
+class ConnPool:
+    # Connected sockets parked by sock_close with "pool", by (host, port,
+    # tls), for the next sock_connect with "pool" to the same place: no new
+    # TCP and TLS handshake, seconds on a slow board. At most max_entries,
+    # the oldest go first, and none is kept longer than idle_ms. A socket
+    # that polls readable before reuse, the server closed it or sent
+    # something unasked, is dropped.
+    def __init__(self, max_entries=POOL_MAX, idle_ms=POOL_IDLE_MS):
+        self.max_entries = max_entries
+        self.idle_ms = idle_ms
+        self._m = {}    # key -> [(socket, parked at, meta), ...], oldest first
+        self._n = 0
+        self.hits = 0       # connects served from the pool
+        self.misses = 0     # connects with "pool" that found none
+        self.dead = 0       # parked sockets found closed at reuse
+        self.expired = 0    # closed after idle_ms
+        self.evictions = 0  # closed for room
+
+    def __len__(self):
+        return self._n
+
+    def park(self, key, s, meta=None):
+        if self.max_entries <= 0:
+            _close_quietly(s)
+            return
+        self.expire()
+        while self._n >= self.max_entries:
+            oldest = None
+            for k, lst in self._m.items():
+                if oldest is None or ticks_diff(lst[0][1], self._m[oldest][0][1]) < 0:
+                    oldest = k
+            self._drop(oldest)
+            self.evictions += 1
+        self._m.setdefault(key, []).append((s, ticks_ms(), meta))
+        self._n += 1
+
+    def take(self, key):
+        # (socket, meta) most recently parked for key and still alive, None
+        # if there is none
+        lst = self._m.get(key)
+        now = ticks_ms()
+        while lst:
+            s, t, meta = lst.pop()
+            self._n -= 1
+            if ticks_diff(now, t) >= self.idle_ms:
+                self.expired += 1
+            elif self._alive(s):
+                if not lst:
+                    del self._m[key]
+                self.hits += 1
+                return s, meta
             else:
-               return {"ok": False, "error": f"ntp server {host} not responding."}
-
-        if op == "wifi_status":
-            return {"ok": True, "result": {"connected": sta.isconnected(), "ifconfig": sta.ifconfig() if sta.isconnected() else None}}
-
-        if op == "dns":
-            host = args.get("host")
-            if not host:
-                return {"ok": False, "error": "missing_host"}
-            port = int(args.get("port", 80))
-            family = int(args.get("family", 0))
-            typ = int(args.get("type", 0))
-            proto = int(args.get("proto", 0))
-            try:
-               res = socket.getaddrinfo(host, port, family, typ, proto)
-               out = []
-               for r in res:
-                   af, ty, pr, canon, sa = r
-                   out.append([af, ty, pr, canon, sa])
-               return {"ok": True, "result": out}
-            except Exception as e:
-               return {"ok": False, "error": "dns_error", "detail": repr(e)}
-
-        # Socket commands
-        if op == "sock_open":
-            family = int(args.get("family", 2))
-            typ = int(args.get("type", 1))
-            proto = int(args.get("proto", 0))
-            try:
-               sid = socktab.new(family, typ, proto)
-               return {"ok": True, "result": {"sid": sid}}
-            except Exception as e:
-               return {"ok": False, "error": "sock_open_error", "detail": repr(e)}
-
-        if op == "sock_settimeout":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            timeout_ms = args.get("timeout_ms", None)
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError):
-                return {"ok": False, "error": "invalid_sid_type", "detail": repr(e)}
-            try:
-               if timeout_ms is None:
-                   s.settimeout(None)
-               else:
-                   s.settimeout(max(0, int(timeout_ms)) / 1000.0)
-               return {"ok": True, "result": True}
-            except Exception as e:
-               return {"ok": False, "error": "sock_settimeout_error", "detail": repr(e)}
-
-        if op == "sock_connect":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            host = args.get("host")
-            if not host:
-                return {"ok": False, "error": "missing_host"}
-            port = int(args.get("port", 80))
-            ssl = args.get("ssl")
-            timeout_ms = int(args.get("timeout_ms", 5000))
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
-            try:
-               if not ssl: # can not settimeout() for ssl wrap
-                  s.settimeout(max(0, timeout_ms) / 1000.0)
-               addr = socket.getaddrinfo(host, port)[0][-1]
-               s.connect(addr)
-               return {"ok": True, "result": True}
-            except Exception as e:
-               # On connect failure, drop the socket so it doesn’t leak
-               socktab.close(sid)
-               return {"ok": False, "error": "sock_connect_error", "detail": repr(e)}
-
-        if op == "sock_send":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            data = args.get("data")
-            if data is None:
-                return {"ok": False, "error": "missing_data"}
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
-            try:
-               n = s.send(data)
-               return {"ok": True, "result": {"n": n}}
-            except Exception as e:
-               # Failed send => connection probably broken; clean it up
-               socktab.close(sid)
-               return {"ok": False, "error": "sock_send_error", "detail": repr(e)}
-
-        if op == "sock_recv":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            n = int(args.get("n", 512))
-            ssl = args.get("ssl")
-            timeout_ms = int(args.get("timeout_ms", 5000))
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
-            try:
-               if not ssl: # tls socket has no settimeout()
-                  s.settimeout(max(0, timeout_ms) / 1000.0)
-               data = s.recv(n)
-               return {"ok": True, "result": {"data": data, "n": len(data), "eof": (len(data) == 0)}}
-            except Exception as e:
-               # Failed recv => connection probably broken; clean it up
-               socktab.close(sid)
-               return {"ok": False, "error": "sock_recv_error", "detail": repr(e)}
-
-        if op == "sock_close":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            try:
-               sid = int(sid)
-               socktab.close(sid)
-               return {"ok": True, "result": True}
-            except Exception as e:
-               return {"ok": False, "error": "sock_close_error", "detail": repr(e)}
-
-        if op == "sock_bind":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            host = args.get("host", "")
-            port = int(args.get("port", 0))
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
-            try:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # server
-                addr = (host, port) if host else ("0.0.0.0", port)
-                s.bind(addr)
-                return {"ok": True, "result": True}
-            except Exception as e:
-                return {"ok": False, "error": "sock_bind_error", "detail": repr(e)}
-
-        if op == "sock_listen":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            backlog = int(args.get("backlog", 5))
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
-            try:
-                s.listen(backlog)
-                return {"ok": True, "result": True}
-            except Exception as e:
-                return {"ok": False, "error": "sock_listen_error", "detail": repr(e)}
-
-        if op == "sock_accept":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            timeout_ms = int(args.get("timeout_ms", 5000))
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
-            try:
-                s.settimeout(max(0, timeout_ms) / 1000.0)
-                conn, addr = s.accept()
-                socktab._next = (socktab._next%MAX_SID)+1
-                new_sid = socktab._next
-                socktab._m[new_sid] = conn
-                return {"ok": True, "result": {"sid": new_sid, "addr": addr}}
-            except Exception as e:
-                return {"ok": False, "error": "sock_accept_error", "detail": repr(e)}
-
-        if op == "sock_sendto":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            data = args.get("data")
-            if data is None:
-                return {"ok": False, "error": "missing_data"}
-            host = args.get("host")
-            port = int(args.get("port", 0))
-            if not host or not port:
-                return {"ok": False, "error": "missing_host_or_port"}
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
-            try:
-                addr = (host, port)
-                n = s.sendto(data, addr)
-                return {"ok": True, "result": {"n": n}}
-            except Exception as e:
-                # Failed sendto => connection probably broken; clean it up
-                socktab.close(sid)
-                return {"ok": False, "error": "sock_sendto_error", "detail": repr(e)}
-
-        if op == "sock_recvfrom":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            n = int(args.get("n", 512))
-            timeout_ms = int(args.get("timeout_ms", 5000))
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
-            try:
-                s.settimeout(max(0, timeout_ms) / 1000.0)
-                data, addr = s.recvfrom(n)
-                return {"ok": True, "result": {"data": data, "n": len(data), "addr": addr}}
-            except Exception as e:
-                # Failed recvfrom => connection probably broken; clean it up
-                socktab.close(sid)
-                return {"ok": False, "error": "sock_recvfrom_error", "detail": repr(e)}
-
-        if op == "sock_wrap_ssl":
-            sid = args.get("sid")
-            if sid is None:
-                return {"ok": False, "error": "missing_sid"}
-            server_hostname = args.get("server_hostname")
-            try:
-                sid = int(sid)
-                s = socktab.get(sid)
-            except (ValueError, TypeError, KeyError) as e:
-                return {"ok": False, "error": "invalid_sid", "detail": repr(e)}
+                self.dead += 1
+            _close_quietly(s)
+        self._m.pop(key, None)
+        self.misses += 1
+        return None
+
+    def _alive(self, s):
+        # Idle between requests, a healthy connection has nothing to read
+        try:
+            p = select.poll()
+            p.register(s, select.POLLIN)
+            return not p.poll(0)
+        except Exception:
+            return False
+
+    def _drop(self, key):
+        # Close the oldest socket of key
+        lst = self._m[key]
+        _close_quietly(lst.pop(0)[0])
+        self._n -= 1
+        if not lst:
+            del self._m[key]
+
+    def expire(self):
+        # Close the sockets parked longer than idle_ms; the main loop calls
+        # this while idle
+        if not self._n:
+            return
+        now = ticks_ms()
+        for key in list(self._m):
+            lst = self._m[key]
+            while lst and ticks_diff(now, lst[0][1]) >= self.idle_ms:
+                self._drop(key)
+                self.expired += 1
+                lst = self._m.get(key)
+
+    def clear(self):
+        for key in list(self._m):
+            for e in self._m.pop(key):
+                _close_quietly(e[0])
+        self._n = 0
+
+    def stats(self):
+        asked = self.hits + self.misses
+        return {"parked": self._n, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / asked if asked else 0.0,
+                "dead": self.dead, "expired": self.expired, "evictions": self.evictions}
+
+class TLSCache:
+    # Client SSLContexts, one per configuration ("verify" or not), made on
+    # first use and kept: a new context per socket cost time and a heap
+    # spike, and the CA certificates (TLS_CAFILE) are read once. Where the
+    # tls module's wrap_socket() takes session= (CPython's ssl, not
+    # MicroPython's tls so far), the session of the last connection to a
+    # server name is offered to the next one, for a shorter handshake.
+    def __init__(self, cafile=TLS_CAFILE, max_sessions=TLS_SESSIONS_MAX):
+        self.cafile = cafile
+        self.max_sessions = max_sessions
+        self._ctx = {}       # verify -> SSLContext
+        self._sessions = {}  # server_hostname -> session
+        self._resume = True  # wrap_socket() takes session=, until it says otherwise
+        self.contexts = 0    # contexts made
+        self.handshakes = 0  # completed, resumed ones included
+        self.resumed = 0
+        self.handshake_us = 0
+        # Growth of the heap in use over a handshake, to its highest sample
+        # (MicroPython): taken after it, and after each step of a
+        # non-blocking one. Temporaries freed within a step are not seen.
+        self.heap_max = 0
+        self.heap_last = 0   # ... of the latest one
+
+    def context(self, verify=False, reuse=True):
+        ctx = self._ctx.get(verify) if reuse else None
+        if ctx is None:
+            ctx = tls.SSLContext(tls.PROTOCOL_TLS_CLIENT)
+            if verify:
+                if not self.cafile:
+                    raise OpError("no_ca", "TLS_CAFILE is not set")
+                with open(self.cafile, "rb") as f:
+                    ctx.load_verify_locations(cadata=f.read())
+                ctx.verify_mode = tls.CERT_REQUIRED
+            else:
+                ctx.verify_mode = tls.CERT_NONE
+            self.contexts += 1
+            if reuse:
+                self._ctx[verify] = ctx
+        return ctx
+
+    def wrap(self, s, server_hostname=None, verify=False, reuse=True, handshake=True):
+        # s wrapped for a client, with SNI server_hostname; the handshake
+        # runs now unless handshake is False
+        ctx = self.context(verify, reuse)
+        kw = {"server_side": False, "server_hostname": server_hostname}
+        if not handshake:
+            kw["do_handshake_on_connect"] = False
+        session = None
+        if reuse and server_hostname and self._resume:
+            session = self._sessions.get((server_hostname, verify))
+        if session is not None:
             try:
-                ssl = tls.SSLContext(tls.PROTOCOL_TLS_CLIENT)
-                ssl.verify_mode = tls.CERT_NONE
-                # ssl.load_verify_locations(cacert) # MBEDTLS_ERR_SSL_CA_CHAIN_REQUIRED
-                # ssl_sock = ssl.wrap_socket(s, server_side=False, server_hostname=server_hostname)
-                ssl_sock = ssl.wrap_socket(s, server_side=False)
-                socktab._m[sid] = ssl_sock
-                return {"ok": True, "result": True}
-            except Exception as e:
-                return {"ok": False, "error": "sock_wrap_ssl_error", "detail": repr(e)}
+                return ctx.wrap_socket(s, session=session, **kw)
+            except TypeError:
+                self._resume = False
+        return ctx.wrap_socket(s, **kw)
 
-        return {"ok": False, "error": "unknown_op", "detail": op}
+    def done(self, ssl_sock, server_hostname, verify, reuse, t0, a0, peak=None):
+        # Handshake complete: count it, keep the session. t0 and a0 are
+        # ticks_us() and the heap in use (None) from before wrap(), peak
+        # the most heap in use seen during the handshake.
+        self.handshakes += 1
+        self.handshake_us += ticks_diff(time.ticks_us(), t0)
+        if a0 is not None:
+            a = heap_in_use()
+            if peak is not None and peak > a:
+                a = peak
+            self.heap_last = max(0, a - a0)
+            self.heap_max = max(self.heap_max, self.heap_last)
+        if getattr(ssl_sock, "session_reused", False):
+            self.resumed += 1
+        self.save(ssl_sock, server_hostname, verify, reuse)
+
+    def save(self, ssl_sock, server_hostname, verify, reuse=True):
+        # Keep the socket's session for the next connection to the server.
+        # Not with reuse False: a session is only good with its context.
+        if not (reuse and server_hostname and self._resume):
+            return
+        session = getattr(ssl_sock, "session", None)
+        if session is None:
+            return
+        key = (server_hostname, verify)
+        m = self._sessions
+        if key not in m and len(m) >= self.max_sessions:
+            del m[next(iter(m))]
+        m[key] = session
+
+    def stats(self):
+        n = max(1, self.handshakes)
+        return {"contexts": self.contexts, "handshakes": self.handshakes, "resumed": self.resumed,
+                "handshake_us": self.handshake_us // n, "heap_max": self.heap_max,
+                "heap_last": self.heap_last, "sessions": len(self._sessions)}
+
+def heap_in_use():
+    # gc.mem_alloc(), None where the port has none (CPython)
+    f = getattr(gc, "mem_alloc", None)
+    return f() if f is not None else None
+
+class OpError(Exception):
+    # Raised by op handlers, answered as {"ok": False, "error": ..., "detail": ...}
+    def __init__(self, error, detail=None):
+        super().__init__(error)
+        self.error = error
+        self.detail = detail
+
+    def resp(self):
+        r = {"ok": False, "error": self.error}
+        if self.detail is not None:
+            r["detail"] = self.detail
+        return r
+
+# op name -> handler(socktab, args) returning the response dict
+OPS = {}
+
+def op(name):
+    # Decorator registering a request handler under an op name
+    def register(fn):
+        OPS[name] = fn
+        return fn
+    return register
+
+def load_op_modules(names=None):
+    # Extra ops from other modules: each one provides register_ops(op)
+    if names is None:
+        import esp32_config
+        names = getattr(esp32_config, "OP_MODULES", ())
+    for name in names:
+        mod = __import__(name)
+        mod.register_ops(op)
+
+# getaddrinfo() errnos for a name that does not exist: CPython/lwIP, ESP-IDF
+NAME_ERRORS = (getattr(socket, "EAI_NONAME", -2), -202)
+
+def name_error(e):
+    # True if e says the name does not exist. A lookup that failed because
+    # WiFi is down or the DNS server did not answer is neither cached nor
+    # reported as dns_error, so the next one asks again.
+    if sta is not None and not sta.isconnected():
+        return False
+    return isinstance(e, OSError) and bool(e.args) and e.args[0] in NAME_ERRORS
+
+def resolve(socktab, host, port, family=0, typ=0, proto=0):
+    # socket.getaddrinfo() through the socktab's DnsCache
+    return socktab.dns.lookup((host, port, family, typ, proto), socket.getaddrinfo, name_error)
+
+def sock_arg(socktab, args):
+    # Resolve args["sid"] to (sid, socket)
+    sid = args.get("sid")
+    if sid is None:
+        raise OpError("missing_sid")
+    try:
+        sid = int(sid)
+        return sid, socktab.get(sid)
+    except (ValueError, TypeError, KeyError) as e:
+        raise OpError("invalid_sid", repr(e))
+
+@op("hello")
+def op_hello(socktab, args):
+    # Session start: agree on protocol extensions. "flow" needs the
+    # client's rx buffer size ("rx"), and answers with ours.
+    flow = socktab.flow
+    caps.clear()
+    for c in args.get("caps") or ():
+        if c in SUPPORTED_CAPS and (c != "flow" or flow is not None):
+            caps.add(c)
+    # "window": most requests the client may have in flight, see Reorder
+    result = {"caps": list(caps), "window": REORDER_WINDOW - 1}
+    if flow is not None:
+        if "flow" in caps:
+            flow.enable(int(args.get("rx") or 0))
+            result["rx"] = flow.rxbuf
+        else:
+            flow.disable()
+    return {"ok": True, "result": result}
+
+@op("proxy_stats")
+def op_proxy_stats(socktab, args):
+    # Counters of the main loop: response replay cache, link flow control,
+    # garbage collection, socket table, DNS cache, connection pool, TLS
+    result = {"socks": socktab.stats(), "dns": socktab.dns.stats(), "pool": socktab.pool.stats(),
+              "tls": socktab.tls_cache.stats()}
+    if socktab.resp_cache is not None:
+        result["resp_cache"] = socktab.resp_cache.stats()
+    if socktab.gc is not None:
+        result["gc"] = socktab.gc.stats()
+    if socktab.flow is not None:
+        result["flow_stalls"] = socktab.flow.stalls
+    if hasattr(gc, "mem_free"):
+        result["mem_free"] = gc.mem_free()
+    return {"ok": True, "result": result}
+
+@op("sock_reset")
+def op_sock_reset(socktab, args):
+    # Close all sockets and clear the table
+    socktab.close_all()
+    return {"ok": True, "result": True}
+
+@op("ping")
+def op_ping(socktab, args):
+    return {"ok": True, "result": {"pong": True, "t_ms": ticks_ms(), "echo": "I see you, you see me"}}
+
+@op("get_time")
+def op_get_time(socktab, args):
+    return {"ok": True, "result": {"time": time.time()}}
+
+@op("set_time")
+def op_set_time(socktab, args):
+    host = args.get("host")
+    if not host:
+       host = 'pool.ntp.org' # global ntp servers pool
+    if set_time(host=host):
+       return {"ok": True, "result": {"time": time.time()}}
+    else:
+       return {"ok": False, "error": f"ntp server {host} not responding."}
+
+@op("wifi_status")
+def op_wifi_status(socktab, args):
+    return {"ok": True, "result": {"connected": sta.isconnected(), "ifconfig": sta.ifconfig() if sta.isconnected() else None}}
+
+@op("dns")
+def op_dns(socktab, args):
+    host = args.get("host")
+    if not host:
+        return {"ok": False, "error": "missing_host"}
+    port = int(args.get("port", 80))
+    family = int(args.get("family", 0))
+    typ = int(args.get("type", 0))
+    proto = int(args.get("proto", 0))
+    try:
+       res = resolve(socktab, host, port, family, typ, proto)
+       out = []
+       for r in res:
+           af, ty, pr, canon, sa = r
+           out.append([af, ty, pr, canon, sa])
+       return {"ok": True, "result": out}
+    except Exception as e:
+       return {"ok": False, "error": "dns_error" if name_error(e) else "dns_unavailable", "detail": repr(e)}
+
+@op("dns_flush")
+def op_dns_flush(socktab, args):
+    # Forget cached lookups of args["host"], or all of them
+    host = args.get("host")
+    return {"ok": True, "result": {"flushed": socktab.dns.flush(host or None)}}
+
+# Socket commands
+@op("sock_open")
+def op_sock_open(socktab, args):
+    family = int(args.get("family", 2))
+    typ = int(args.get("type", 1))
+    proto = int(args.get("proto", 0))
+    try:
+       sid = socktab.new(family, typ, proto)
+       return {"ok": True, "result": {"sid": sid}}
+    except OpError:
+       raise
+    except Exception as e:
+       return {"ok": False, "error": "sock_open_error", "detail": repr(e)}
+
+@op("sock_settimeout")
+def op_sock_settimeout(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    timeout_ms = args.get("timeout_ms", None)
+    if socktab.nonblocking:
+        # The socket stays non-blocking, this is the deadline of parked ops
+        socktab.timeouts[sid] = None if timeout_ms is None else max(0, int(timeout_ms))
+        return {"ok": True, "result": True}
+    try:
+       if timeout_ms is None:
+           s.settimeout(None)
+       else:
+           s.settimeout(max(0, int(timeout_ms)) / 1000.0)
+       return {"ok": True, "result": True}
+    except Exception as e:
+       return {"ok": False, "error": "sock_settimeout_error", "detail": repr(e)}
+
+@op("sock_connect")
+def op_sock_connect(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    host = args.get("host")
+    if not host:
+        return {"ok": False, "error": "missing_host"}
+    port = int(args.get("port", 80))
+    ssl = args.get("ssl")
+    timeout_ms = int(args.get("timeout_ms", 5000))
+    if args.get("pool") and socktab.reuse(sid, host, port, ssl):
+        return {"ok": True, "result": True}
+    try:
+       if not ssl: # can not settimeout() for ssl wrap
+          s.settimeout(max(0, timeout_ms) / 1000.0)
+       addr = resolve(socktab, host, port)[0][-1]
+       try:
+          s.connect(addr)
+       except OSError:
+          socktab.dns.flush(host)  # the address may be stale, look it up again next time
+          raise
+       return {"ok": True, "result": True}
+    except Exception as e:
+       # On connect failure, drop the socket so it doesn’t leak
+       socktab.close(sid)
+       return {"ok": False, "error": "sock_connect_error", "detail": repr(e)}
+
+@op("sock_send")
+def op_sock_send(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    data = args.get("data")
+    if data is None:
+        return {"ok": False, "error": "missing_data"}
+    try:
+       if args.get("all"):
+           # Send everything: pipelined chunks must not be cut short
+           mv = memoryview(data)
+           n = 0
+           while n < len(mv):
+               k = s.send(mv[n:])
+               if not k:
+                   raise OSError("send returned 0")
+               n += k
+       else:
+           n = s.send(data)
+       socktab.io(sid, tx=n)
+       return {"ok": True, "result": {"n": n}}
+    except Exception as e:
+       # Failed send => connection probably broken; clean it up
+       socktab.close(sid)
+       return {"ok": False, "error": "sock_send_error", "detail": repr(e)}
+
+@op("sock_recv")
+def op_sock_recv(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    n = int(args.get("n", 512))
+    ssl = args.get("ssl")
+    timeout_ms = int(args.get("timeout_ms", 5000))
+    try:
+       if not ssl: # tls socket has no settimeout()
+          s.settimeout(max(0, timeout_ms) / 1000.0)
+       data = s.recv(n)
+       socktab.io(sid, rx=len(data))
+       return {"ok": True, "result": {"data": data, "n": len(data), "eof": (len(data) == 0)}}
+    except Exception as e:
+       # Failed recv => connection probably broken; clean it up
+       socktab.close(sid)
+       return {"ok": False, "error": "sock_recv_error", "detail": repr(e)}
+
+@op("sock_close")
+def op_sock_close(socktab, args):
+    sid = args.get("sid")
+    if sid is None:
+        return {"ok": False, "error": "missing_sid"}
+    try:
+       sid = int(sid)
+       if not (args.get("pool") and socktab.park(sid)):
+           socktab.close(sid)
+       return {"ok": True, "result": True}
+    except Exception as e:
+       return {"ok": False, "error": "sock_close_error", "detail": repr(e)}
+
+@op("sock_stream_start")
+def op_sock_stream_start(socktab, args):
+    # Push the socket's data to the Pico in T_DATA frames, see Streams
+    sid, s = sock_arg(socktab, args)
+    if socktab.streams is None:
+        raise OpError("unsupported", "sock_stream_start")
+    credit = min(int(args.get("credit", STREAM_CHUNK)), STREAM_CREDIT_MAX)
+    if credit <= 0:
+        raise OpError("invalid_parameter", "credit")
+    socktab.streams.start(sid, credit)
+    return {"ok": True, "result": {"credit": credit, "chunk": STREAM_CHUNK}}
 
+@op("sock_stream_stop")
+def op_sock_stream_stop(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    if socktab.streams is not None:
+        socktab.streams.stop(sid)
+    return {"ok": True, "result": True}
+
+@op("sock_bind")
+def op_sock_bind(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    host = args.get("host", "")
+    port = int(args.get("port", 0))
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # server
+        addr = (host, port) if host else ("0.0.0.0", port)
+        s.bind(addr)
+        return {"ok": True, "result": True}
+    except Exception as e:
+        return {"ok": False, "error": "sock_bind_error", "detail": repr(e)}
+
+@op("sock_listen")
+def op_sock_listen(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    backlog = int(args.get("backlog", 5))
+    try:
+        s.listen(backlog)
+        return {"ok": True, "result": True}
+    except Exception as e:
+        return {"ok": False, "error": "sock_listen_error", "detail": repr(e)}
+
+@op("sock_accept")
+def op_sock_accept(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    timeout_ms = int(args.get("timeout_ms", 5000))
+    try:
+        s.settimeout(max(0, timeout_ms) / 1000.0)
+        conn, addr = s.accept()
+        return {"ok": True, "result": {"sid": socktab.add(conn), "addr": addr}}
+    except OpError:
+        raise
+    except Exception as e:
+        return {"ok": False, "error": "sock_accept_error", "detail": repr(e)}
+
+@op("sock_sendto")
+def op_sock_sendto(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    data = args.get("data")
+    if data is None:
+        return {"ok": False, "error": "missing_data"}
+    host = args.get("host")
+    port = int(args.get("port", 0))
+    if not host or not port:
+        return {"ok": False, "error": "missing_host_or_port"}
+    try:
+        addr = (host, port)
+        n = s.sendto(data, addr)
+        socktab.io(sid, tx=n)
+        return {"ok": True, "result": {"n": n}}
+    except Exception as e:
+        # Failed sendto => connection probably broken; clean it up
+        socktab.close(sid)
+        return {"ok": False, "error": "sock_sendto_error", "detail": repr(e)}
+
+@op("sock_recvfrom")
+def op_sock_recvfrom(socktab, args):
+    sid, s = sock_arg(socktab, args)
+    n = int(args.get("n", 512))
+    timeout_ms = int(args.get("timeout_ms", 5000))
+    try:
+        s.settimeout(max(0, timeout_ms) / 1000.0)
+        data, addr = s.recvfrom(n)
+        socktab.io(sid, rx=len(data))
+        return {"ok": True, "result": {"data": data, "n": len(data), "addr": addr}}
+    except Exception as e:
+        # Failed recvfrom => connection probably broken; clean it up
+        socktab.close(sid)
+        return {"ok": False, "error": "sock_recvfrom_error", "detail": repr(e)}
+
+def wrap_args(socktab, sid, args):
+    # (server_hostname, verify, reuse) of a sock_wrap_ssl; None when sid is
+    # a pooled connection with TLS up already
+    server_hostname = args.get("server_hostname") or None
+    verify = args.get("verify")
+    verify = TLS_VERIFY if verify is None else bool(verify)
+    have = socktab.slot(sid).tls
+    if have is not None:
+        if verify and not have[1]:
+            raise OpError("sock_wrap_ssl_error", "pooled connection was not verified")
+        return None
+    return server_hostname, verify, args.get("reuse") is not False
+
+@op("sock_wrap_ssl")
+def op_sock_wrap_ssl(socktab, args):
+    # Server name (SNI) and contexts from socktab.tls_cache, see TLSCache
+    sid, s = sock_arg(socktab, args)
+    w = wrap_args(socktab, sid, args)
+    if w is None:
+        return {"ok": True, "result": True}  # a pooled connection, TLS is up
+    server_hostname, verify, reuse = w
+    cache = socktab.tls_cache
+    sl = socktab.slot(sid)
+    try:
+        t0 = time.ticks_us()
+        a0 = heap_in_use()
+        sl.s = ssl_sock = cache.wrap(s, server_hostname, verify, reuse)
+        sl.tls = (server_hostname, verify, reuse)
+        cache.done(ssl_sock, server_hostname, verify, reuse, t0, a0)
+        return {"ok": True, "result": True}
+    except OpError:
+        raise
+    except Exception as e:
+        sl.conn = None  # half-wrapped, not for the pool
+        return {"ok": False, "error": "sock_wrap_ssl_error", "detail": repr(e)}
+
+def handle_req(socktab: SockTable, req) -> dict:
+    # req is {"op": name, "args": {...}} or the compact [opcode, arg, ...]
+    op, args = expand_request(req)
+    return handle_op(socktab, op, args)
+
+def handle_op(socktab: SockTable, op, args: dict) -> dict:
+    if DEBUG: print('DEBUG:', op, args)
+
+    fn = OPS.get(op) if isinstance(op, str) else None
+    if fn is None:
+        return {"ok": False, "error": "unknown_op", "detail": op}
+    try:
+        return fn(socktab, args)
+    except OpError as e:
+        return e.resp()
     except KeyError as e:
         return {"ok": False, "error": "missing_parameter", "detail": repr(e)}
     except ValueError as e:
@@ -343,69 +871,926 @@ def handle_req(socktab: SockTable, req: dict) -> dict:
     except Exception as e:
         return {"ok": False, "error": "exception", "detail": repr(e)}
 
-def main():
-    global uart
+# Non-blocking mode (NONBLOCKING = True in esp32_config): proxied sockets are
+# non-blocking, and ops that would wait on one are parked and finished from
+# the main loop, so a slow peer no longer stalls the other sockets or ping.
+#
+# Such an op is a generator: it yields the poll events it waits for and gets
+# back the events that occurred (0 when just retried); it returns the
+# response dict. Exceptions become {"ok": False, "error": <error>}.
+
+# op name -> (generator function, error name, close the socket on error)
+NB_OPS = {}
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EINPROGRESS, errno.EALREADY)
+_POLL_FD = sys.implementation.name != "micropython"
+
+def nb_op(name, error, close=False):
+    def register(fn):
+        NB_OPS[name] = (fn, error, close)
+        return fn
+    return register
+
+def would_block(e):
+    # tls raises EAGAIN (MicroPython) or SSLWantRead/WriteError (CPython)
+    if type(e).__name__ in ("SSLWantReadError", "SSLWantWriteError"):
+        return True
+    return getattr(e, "errno", None) in _WOULD_BLOCK
+
+def op_deadline(socktab, sid, args):
+    # When a waiting op gives up: its timeout_ms arg, else sock_settimeout
+    t = args.get("timeout_ms")
+    if not t or int(t) <= 0:
+        t = socktab.timeouts.get(sid, int(SOCKET_TIMEOUT_DEFAULT * 1000))
+    return None if t is None else ticks_add(ticks_ms(), int(t))
+
+@nb_op("sock_connect", "sock_connect_error", close=True)
+def nb_sock_connect(socktab, sid, s, args):
+    host = args.get("host")
+    if not host:
+        return {"ok": False, "error": "missing_host"}
+    port = int(args.get("port", 80))
+    if args.get("pool") and socktab.reuse(sid, host, port, args.get("ssl")):
+        return {"ok": True, "result": True}
+    addr = resolve(socktab, host, port)[0][-1]
+    try:
+        s.connect(addr)
+    except OSError as e:
+        if not would_block(e):
+            socktab.dns.flush(host)
+            raise
+        ev = yield select.POLLOUT
+        while not ev:
+            ev = yield select.POLLOUT
+        if ev & (select.POLLERR | select.POLLHUP):
+            err = errno.ECONNREFUSED
+            if hasattr(socket, "SO_ERROR"):
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) or err
+            socktab.dns.flush(host)
+            raise OSError(err)
+    return {"ok": True, "result": True}
+
+@nb_op("sock_send", "sock_send_error", close=True)
+def nb_sock_send(socktab, sid, s, args):
+    data = args.get("data")
+    if data is None:
+        return {"ok": False, "error": "missing_data"}
+    mv = memoryview(data)
+    n = 0
+    while True:
+        try:
+            k = s.send(mv[n:])
+        except OSError as e:
+            if not would_block(e):
+                raise
+            k = None
+        if k is not None:
+            if k == 0 and len(mv):
+                raise OSError("send returned 0")
+            n += k
+            if n >= len(mv) or not args.get("all"):
+                socktab.io(sid, tx=n)
+                return {"ok": True, "result": {"n": n}}
+        yield select.POLLOUT
+
+@nb_op("sock_recv", "sock_recv_error", close=True)
+def nb_sock_recv(socktab, sid, s, args):
+    n = int(args.get("n", 512))
+    while True:
+        try:
+            data = s.recv(n)
+        except OSError as e:
+            if not would_block(e):
+                raise
+            data = None
+        if data is not None:
+            socktab.io(sid, rx=len(data))
+            return {"ok": True, "result": {"data": data, "n": len(data), "eof": (len(data) == 0)}}
+        yield select.POLLIN
+
+@nb_op("sock_recvfrom", "sock_recvfrom_error", close=True)
+def nb_sock_recvfrom(socktab, sid, s, args):
+    n = int(args.get("n", 512))
+    while True:
+        try:
+            data, addr = s.recvfrom(n)
+            socktab.io(sid, rx=len(data))
+            return {"ok": True, "result": {"data": data, "n": len(data), "addr": addr}}
+        except OSError as e:
+            if not would_block(e):
+                raise
+        yield select.POLLIN
+
+@nb_op("sock_accept", "sock_accept_error")
+def nb_sock_accept(socktab, sid, s, args):
+    while True:
+        try:
+            conn, addr = s.accept()
+            break
+        except OSError as e:
+            if not would_block(e):
+                raise
+        yield select.POLLIN
+    conn.setblocking(False)
+    return {"ok": True, "result": {"sid": socktab.add(conn), "addr": addr}}
+
+@nb_op("sock_wrap_ssl", "sock_wrap_ssl_error")
+def nb_sock_wrap_ssl(socktab, sid, s, args):
+    w = wrap_args(socktab, sid, args)
+    if w is None:
+        return {"ok": True, "result": True}
+    server_hostname, verify, reuse = w
+    cache = socktab.tls_cache
+    sl = socktab.slot(sid)
+    hp = sl.conn
+    t0 = time.ticks_us()
+    a0 = peak = heap_in_use()
+    sl.s = ssl_sock = cache.wrap(s, server_hostname, verify, reuse, handshake=False)
+    sl.conn = None  # not pooled unless the handshake completes
+    # The handshake runs step by step: do_handshake() (CPython) or, with
+    # MicroPython tls, the first write
+    step = getattr(ssl_sock, "do_handshake", None)
+    while True:
+        try:
+            if step is not None:
+                step()
+                break
+            if ssl_sock.write(b"") is not None:
+                break
+        except OSError as e:
+            if not would_block(e):
+                raise
+        if peak is not None:
+            peak = max(peak, heap_in_use())
+        yield select.POLLIN | select.POLLOUT
+    sl.tls = (server_hostname, verify, reuse)
+    cache.done(ssl_sock, server_hostname, verify, reuse, t0, a0, peak)
+    sl.conn = hp
+    return {"ok": True, "result": True}
+
+# Batches: several requests in one ("batch" op), run in order with the
+# responses returned together, so opening a TLS connection costs one round
+# trip instead of four. A sub-request arg {"$ref": [i, key, ...]} is taken
+# from the result of sub-request i, e.g. {"$ref": [0, "sid"]} for the socket
+# a sock_open made. Unless "stop" is false the batch ends at the first
+# error. In non-blocking mode a batch is parked like a socket op while a
+# sub-request waits for its socket (nb_batch), and the requests after it
+# run in the meantime.
+
+BATCH_DENY = ("batch", "hello", "sock_reset")  # session ops go on their own
+
+def batch_ref(v, results):
+    if isinstance(v, dict) and "$ref" in v:
+        path = v["$ref"]
+        r = results[int(path[0])]
+        if not r.get("ok"):
+            raise ValueError(f"$ref to failed request {path[0]}")
+        v = r.get("result")
+        for k in path[1:]:
+            v = v[k]
+    return v
+
+def batch_requests(args):
+    # Generator over the sub-requests of a batch: yields (op, args) with the
+    # references filled in and is sent back the response. Returns the
+    # response of the batch, {"ok": True, "result": [response, ...]}.
+    reqs = args.get("ops")
+    if not isinstance(reqs, (list, tuple)) or len(reqs) > BATCH_MAX:
+        raise ValueError(f"ops: a list of up to {BATCH_MAX} requests")
+    stop = args.get("stop", True) is not False
+    results = []
+    for req in reqs:
+        op, a = expand_request(req)
+        if op in BATCH_DENY:
+            r = {"ok": False, "error": "not_batchable", "detail": op}
+        else:
+            try:
+                a = {k: batch_ref(v, results) for k, v in a.items()}
+            except (IndexError, KeyError, TypeError, ValueError) as e:
+                r = {"ok": False, "error": "invalid_ref", "detail": repr(e)}
+            else:
+                r = yield op, a
+        results.append(r)
+        if stop and not r.get("ok"):
+            break
+    return {"ok": True, "result": results}
+
+def nb_steps(socktab, op, args):
+    # One of NB_OPS step by step: yields (sid, mask, deadline, spin) while it
+    # waits for the socket, is sent the poll events (0: none, or spinning),
+    # and returns the response
+    fn, error, close = NB_OPS[op]
+    sid = None
+    try:
+        sid, s = sock_arg(socktab, args)
+        deadline = op_deadline(socktab, sid, args)
+        spin = bool(args.get("ssl")) or op == "sock_wrap_ssl"
+        gen = fn(socktab, sid, s, args)
+        mask = next(gen)
+        while True:
+            ev = yield sid, mask, deadline, spin
+            # also when ready: a handshake waits on POLLOUT, always set
+            if deadline is not None and ticks_diff(ticks_ms(), deadline) >= 0:
+                raise OSError(errno.ETIMEDOUT)
+            mask = gen.send(ev)
+    except StopIteration as r:
+        return r.args[0] if r.args else None
+    except OpError as e:
+        return e.resp()
+    except KeyError as e:
+        return {"ok": False, "error": "missing_parameter", "detail": repr(e)}
+    except ValueError as e:
+        return {"ok": False, "error": "invalid_parameter", "detail": repr(e)}
+    except Exception as e:
+        if close and sid is not None:
+            socktab.close(sid)
+        return {"ok": False, "error": error, "detail": repr(e)}
+
+def run_nb_op_here(socktab, op, args):
+    # One of NB_OPS to its end, waiting for the socket in this call
+    gen = nb_steps(socktab, op, args)
+    poller = select.poll()
+    polled = None
+    ev = None
+    try:
+        while True:
+            sid, mask, deadline, spin = gen.send(ev)
+            # wrap_ssl replaces the socket, so look it up each time
+            s = socktab.get(sid)
+            if polled is not None and polled is not s:
+                poller.unregister(polled)
+            poller.register(s, mask)
+            polled = s
+            wait = 1 if spin else 100
+            if deadline is not None:
+                wait = max(0, min(wait, ticks_diff(deadline, ticks_ms())))
+            ready = poller.poll(wait)
+            ev = ready[0][1] if ready else 0
+    except StopIteration as r:
+        return r.args[0] if r.args else None
+
+def nb_batch(socktab, args):
+    # op_batch step by step, for PendingOps: yields (sid, mask, deadline,
+    # spin) while a sub-request waits for its socket, as nb_steps()
+    gen = batch_requests(args)
+    r = None
+    while True:
+        try:
+            op, a = gen.send(r)
+        except StopIteration as e:
+            return e.args[0] if e.args else None
+        if op in NB_OPS:
+            r = yield from nb_steps(socktab, op, a)
+        else:
+            r = handle_op(socktab, op, a)
+
+@op("batch")
+def op_batch(socktab, args):
+    # Non-blocking mode parks batches (PendingOps), this runs them in place
+    gen = batch_requests(args)
+    try:
+        op, a = next(gen)
+        while True:
+            if socktab.nonblocking and op in NB_OPS:
+                r = run_nb_op_here(socktab, op, a)
+            else:
+                r = handle_op(socktab, op, a)
+            op, a = gen.send(r)
+    except StopIteration as r:
+        return r.args[0] if r.args else None
+
+class _Parked:
+    __slots__ = ("seq", "op", "args", "gen", "sock", "deadline", "spin", "close")
+
+    def __init__(self, seq, op, args):
+        self.seq = seq
+        self.op = op
+        self.args = args
+        self.gen = None
+        self.sock = None
+        self.deadline = None
+        self.spin = False
+        self.close = False  # close the socket with the (error) response
+
+class PendingOps:
+    # Requests for each socket run one at a time in seq order: the first
+    # one in a socket's queue may be parked, the others wait behind it.
+    def __init__(self, socktab, respond, park, uart=None):
+        self.socktab = socktab
+        self._respond = respond  # respond(seq, resp_obj)
+        self._park = park        # park(seq): the response will come later
+        self._q = {}             # sid -> [_Parked, ...]
+        self._keys = {}          # poll key -> sid
+        self._poller = select.poll()
+        self.uart_polled = False
+        if uart is not None:
+            # Wake on UART input too, where the port can poll it
+            try:
+                self._poller.register(uart, select.POLLIN)
+                self.uart_polled = True
+            except Exception:
+                pass
+
+    def active(self):
+        return bool(self._q)
+
+    def spinning(self):
+        # True when a parked op retries on every poll instead of waiting
+        # for a socket event
+        for q in self._q.values():
+            if q and q[0].spin:
+                return True
+        return False
+
+    def take(self, seq, op, args):
+        # True when the request was handled here (answered or parked)
+        if op == "batch":
+            # Not tied to one socket: queued on its own
+            key = ("batch", seq)
+            self._q[key] = [_Parked(seq, op, args)]
+            self._run(key, 0)
+            if key in self._q:
+                self._park(seq)
+            return True
+        try:
+            sid = int(args.get("sid"))
+        except (ValueError, TypeError):
+            return False
+        q = self._q.get(sid)
+        if q:
+            q.append(_Parked(seq, op, args))
+            self._park(seq)
+            return True
+        if op not in NB_OPS:
+            return False
+        e = _Parked(seq, op, args)
+        self._q[sid] = [e]
+        self._run(sid, 0)
+        if sid in self._q and self._q[sid][0] is e:
+            self._park(seq)
+        return True
+
+    def cancel_all(self, error="sock_reset"):
+        for sid in list(self._q):
+            for e in self._q.pop(sid):
+                self._respond(e.seq, {"ok": False, "error": error, "detail": e.op})
+        for key in list(self._keys):
+            self._unregister(key)
+
+    def _key(self, sock):
+        # select.poll reports objects on MicroPython, file descriptors on CPython
+        return sock.fileno() if _POLL_FD else sock
+
+    def _unregister(self, key):
+        if self._keys.pop(key, None) is not None:
+            try:
+                self._poller.unregister(key)
+            except Exception:
+                pass
+
+    def _finish(self, sid, e, resp):
+        e.gen = None
+        if e.sock is not None:
+            self._unregister(e.sock)
+            e.sock = None
+        if e.close:
+            self.socktab.close(sid)
+        self._respond(e.seq, resp)
+
+    def _wait(self, qkey, e, sid, mask):
+        # Poll the socket of sid for mask, on behalf of the queue qkey;
+        # (re)registered each time, wrap_ssl replaces the socket
+        key = self._key(self.socktab.get(sid))
+        if e.sock is not None and e.sock != key:
+            self._unregister(e.sock)
+        self._poller.register(key, mask)
+        self._keys[key] = qkey
+        e.sock = key
+
+    def _step_batch(self, qkey, e, ev):
+        # A parked batch: each step advances the sub-request that waits
+        try:
+            if e.gen is None:
+                e.gen = nb_batch(self.socktab, e.args)
+                ev = None
+            sid, mask, e.deadline, e.spin = e.gen.send(ev)
+        except StopIteration as r:
+            return r.args[0] if r.args else None
+        except ValueError as err:
+            return {"ok": False, "error": "invalid_parameter", "detail": repr(err)}
+        self._wait(qkey, e, sid, mask)
+        return None
+
+    def _step(self, sid, e, ev):
+        # Advance the op: None while it waits, else the response
+        if e.op == "batch":
+            return self._step_batch(sid, e, ev)
+        if e.gen is None:
+            if e.op not in NB_OPS:
+                return handle_op(self.socktab, e.op, e.args)
+        fn, error, close = NB_OPS[e.op]
+        try:
+            if e.gen is None:
+                sid, s = sock_arg(self.socktab, e.args)
+                e.deadline = op_deadline(self.socktab, sid, e.args)
+                e.spin = bool(e.args.get("ssl")) or e.op == "sock_wrap_ssl"
+                e.gen = fn(self.socktab, sid, s, e.args)
+                mask = next(e.gen)
+            else:
+                mask = e.gen.send(ev)
+        except StopIteration as r:
+            return r.args[0] if r.args else None
+        except OpError as err:
+            return err.resp()
+        except KeyError as err:
+            return {"ok": False, "error": "missing_parameter", "detail": repr(err)}
+        except ValueError as err:
+            return {"ok": False, "error": "invalid_parameter", "detail": repr(err)}
+        except Exception as err:
+            e.close = close
+            return {"ok": False, "error": error, "detail": repr(err)}
+        self._wait(sid, e, sid, mask)
+        return None
+
+    def _run(self, sid, ev):
+        # Work through the socket's queue until an op has to wait
+        q = self._q.get(sid)
+        while q:
+            e = q[0]
+            resp = self._step(sid, e, ev)
+            if resp is None:
+                return
+            self._finish(sid, e, resp)
+            q.pop(0)
+            ev = 0
+        self._q.pop(sid, None)
+
+    def poll(self, timeout_ms):
+        # Wait up to timeout_ms for socket (or UART) events, then advance the
+        # ops that can make progress and fail those past their deadline
+        ready = {}
+        for item in self._poller.poll(timeout_ms):
+            sid = self._keys.get(item[0])
+            if sid is not None:
+                ready[sid] = item[1]
+        now = ticks_ms()
+        for sid in list(self._q):
+            q = self._q.get(sid)
+            if not q:
+                continue
+            e = q[0]
+            ev = ready.get(sid, 0)
+            if e.deadline is not None and ticks_diff(now, e.deadline) >= 0:
+                if e.op == "batch":
+                    self._run(sid, 0)  # the sub-request times out, the batch goes on
+                    continue
+                fn, error, e.close = NB_OPS[e.op]
+                self._finish(sid, e, {"ok": False, "error": error, "detail": repr(OSError(errno.ETIMEDOUT))})
+                q.pop(0)
+                self._run(sid, 0)
+                continue
+            if ev or e.spin:
+                self._run(sid, ev)
+
+# Server push (sock_stream_start): data arriving on a socket goes to the Pico
+# in T_DATA frames without a sock_recv per chunk. The Pico grants credit, the
+# bytes it can buffer, and acks with T_CREDIT frames; data is kept until it is
+# acked and sent again (go-back-N) after a gap report or STREAM_RTO_MS of
+# silence. See the stream frame layouts in bridge.py.
+
+class _Stream:
+    __slots__ = ("key", "credit", "acked", "sent", "limit", "buf", "eof", "last")
+
+    def __init__(self, key, credit):
+        self.key = key        # poll key of the socket
+        self.credit = credit  # window the Pico asked for
+        self.acked = 0        # offset of buf[0]: everything before it arrived
+        self.sent = 0         # offset of the next byte to send
+        self.limit = credit   # may send up to here
+        self.buf = bytearray()
+        self.eof = None       # offset of the end-of-stream marker once read
+        self.last = 0         # ticks of the last credit progress
+
+class Streams:
+    def __init__(self, socktab, write, can_send=None):
+        self.socktab = socktab
+        self._write = write   # write(frame), frame only valid during the call
+        self._can_send = can_send  # can_send(n): link flow control allows n bytes
+        self._m = {}          # sid -> _Stream
+        self._poller = select.poll()
+        self._pl = bytearray(DATA_HDR_SIZE + STREAM_CHUNK)
+        self._tx = bytearray(frame_size(DATA_HDR_SIZE + STREAM_CHUNK))
+
+    def active(self):
+        return bool(self._m)
+
+    def start(self, sid, credit):
+        self.stop(sid)
+        s = self.socktab.get(sid)
+        key = s.fileno() if _POLL_FD else s
+        self._poller.register(key, select.POLLIN)
+        st = self._m[sid] = _Stream(key, credit)
+        st.last = ticks_ms()
+
+    def stop(self, sid):
+        st = self._m.pop(sid, None)
+        if st is not None:
+            try:
+                self._poller.unregister(st.key)
+            except Exception:
+                pass
+
+    def on_credit(self, sid, payload):
+        st = self._m.get(sid)
+        if st is None or len(payload) < CREDIT_SIZE:
+            return
+        off, window, flags = struct.unpack(CREDIT_FMT, bytes(payload[:CREDIT_SIZE]))
+        k = off_diff(off, st.acked)
+        top = len(st.buf) + (0 if st.eof is None else 1)
+        if k < 0 or k > top:
+            return  # stale
+        if k:
+            if st.eof is not None and k == top:
+                self.stop(sid)  # the end marker arrived, the stream is done
+                return
+            st.buf = st.buf[k:]
+            st.acked = off
+            if off_diff(st.sent, off) < 0:
+                st.sent = off
+            st.last = ticks_ms()
+        st.limit = (off + min(window, st.credit)) & 0xFFFFFFFF
+        if flags & CREDIT_GAP:
+            st.sent = st.acked  # a frame was lost, the rest was dropped: go back
+            st.last = ticks_ms()
+
+    def _send(self, sid, st, data):
+        pl = self._pl
+        k = len(data)
+        struct.pack_into(DATA_HDR, pl, 0, st.sent)
+        pl[DATA_HDR_SIZE:DATA_HDR_SIZE + k] = data
+        n = pack_packet_into(self._tx, T_DATA, sid, memoryview(pl)[:DATA_HDR_SIZE + k])
+        if self._can_send is not None and not self._can_send(n):
+            return False
+        if st.sent == st.acked:
+            st.last = ticks_ms()
+        self._write(memoryview(self._tx)[:n])
+        st.sent = (st.sent + (k or 1)) & 0xFFFFFFFF
+        return True
+
+    def pump(self):
+        # Send what the credit allows, resends first, then new socket data.
+        # Blocking sockets are read only when poll says so. Returns the
+        # number of frames sent.
+        ready = ()
+        if not self.socktab.nonblocking:
+            ready = [item[0] for item in self._poller.poll(0)]
+        now = ticks_ms()
+        sent = 0
+        for sid in list(self._m):
+            st = self._m[sid]
+            sl = self.socktab.slot(sid)
+            s = sl.s if sl is not None else None
+            if st.sent != st.acked and ticks_diff(now, st.last) >= STREAM_RTO_MS:
+                st.sent = st.acked  # no credit for a while: resend
+                st.last = now
+            readable = self.socktab.nonblocking or st.key in ready
+            while True:
+                room = off_diff(st.limit, st.sent)
+                pos = off_diff(st.sent, st.acked)
+                if pos < len(st.buf):
+                    if room <= 0:
+                        break
+                    k = min(len(st.buf) - pos, room, STREAM_CHUNK)
+                    if not self._send(sid, st, memoryview(st.buf)[pos:pos + k]):
+                        break
+                    sent += 1
+                    continue
+                if st.eof is not None:
+                    if st.sent == st.eof and self._send(sid, st, b""):
+                        sent += 1
+                    break
+                if room <= 0 or s is None:
+                    break
+                # tls may hold decrypted data the socket poll does not see
+                if not readable and not (hasattr(s, "pending") and s.pending()):
+                    break
+                try:
+                    data = s.recv(min(room, STREAM_CHUNK))
+                except OSError as e:
+                    if would_block(e):
+                        break
+                    data = b""
+                if not data:
+                    st.eof = st.sent  # closed or failed: end of stream
+                    continue
+                st.buf.extend(data)
+                sl.rx += len(data)
+                readable = self.socktab.nonblocking  # a blocking read may wait now
+        return sent
+
+def is_hello(payload):
+    # True for the payload of a "hello" request, the start of a client session
+    try:
+        return expand_request(unpack(bytes(payload)))[0] == "hello"
+    except Exception:
+        return False
+
+class Reorder:
+    # Pipelined requests are executed in seq order: a request that arrives
+    # ahead of a lost one is held until the retransmit fills the gap, or
+    # REORDER_WAIT_MS passes (skip_gap). The Pico keeps its window below
+    # REORDER_WINDOW (see op_hello), so within a session every request is
+    # fewer than that ahead, and a retransmit no more than that behind.
+    # A late retransmit of a skipped seq is answered seq_skipped and never
+    # executed; other requests behind are dropped. One further off in both
+    # directions starts a new session only if it is a "hello", or, for
+    # clients that skip it, while no gap is open; reset() then drops the
+    # caps of the old one. Others are dropped, the Pico re-sends them.
+    def __init__(self, execute, reset, respond=None, window=REORDER_WINDOW):
+        self.execute = execute  # execute(seq, payload, crc)
+        self.reset = reset
+        self.respond = respond  # respond(seq, resp_obj), for skipped seqs
+        self.window = window
+        self.held = {}          # seq -> (payload, crc)
+        self.skipped = []       # seqs skip_gap() passed over, newest last
+        self.expected = None
+        self.gap_since = 0
+        self.sessions = 0       # resyncs to a new client session
+        self.dropped = 0        # requests too far ahead during a gap
+        self.stale = 0          # requests behind: late retransmits
+
+    def on_request(self, seq, payload, crc):
+        # payload may be a view into the frame buffer
+        d = 0 if self.expected is None else (seq - self.expected) & 0xFFFF
+        if d:
+            if d < self.window:
+                if not self.held:
+                    self.gap_since = ticks_ms()
+                self.held[seq] = (bytes(payload), crc)
+                return
+            hello = is_hello(payload)
+            if not hello and 0x10000 - d <= self.window:
+                self.stale += 1
+                if seq in self.skipped:
+                    self.skipped.remove(seq)
+                    if self.respond is not None:
+                        self.respond(seq, {"ok": False, "error": "seq_skipped", "detail": seq})
+                return
+            if hello:
+                self.held.clear()  # op_hello sets the caps of the new session
+            elif self.held:
+                self.dropped += 1
+                return
+            else:
+                self.reset()
+            self.skipped.clear()
+            self.sessions += 1
+        self.expected = seq_next(seq)
+        self.execute(seq, payload, crc)
+        self.drain()
+
+    def drain(self):
+        held = self.held
+        while self.expected in held:
+            seq = self.expected
+            self.expected = seq_next(seq)
+            payload, crc = held.pop(seq)
+            self.execute(seq, payload, crc)
+
+    def overdue(self):
+        # A gap has been open for longer than REORDER_WAIT_MS
+        return bool(self.held) and ticks_diff(ticks_ms(), self.gap_since) > REORDER_WAIT_MS
+
+    def skip_gap(self):
+        # The missing request never came: continue with the oldest held one
+        expected = self.expected
+        self.expected = min(self.held, key=lambda s: (s - expected) & 0xFFFF)
+        skipped = self.skipped
+        while expected != self.expected:
+            skipped.append(expected)
+            expected = seq_next(expected)
+        del skipped[:-self.window]  # older ones can no longer come
+        self.drain()
+        self.gap_since = ticks_ms()
+
+    def last(self):
+        # seq of the last request executed in order
+        return seq_prev(self.expected)
+
+def main(uart=None, stop=None, nonblocking=None, rxbuf=None, gc_policy=None, uart_wait=None):
+    # uart: link to the Pico, from uart_setup() when None.
+    # stop: optional callable, the loop returns once it is true.
+    # nonblocking: park waiting socket ops (PendingOps), default NONBLOCKING.
+    # rxbuf: rx buffer size of uart, default esp32_config.UART_RXBUF.
+    # gc_policy: gcpolicy name or object, default esp32_config.GC_POLICY.
+    # uart_wait: UartWait mode, "irq", "poll" or "sleep"; None: the best one.
+    global sta
+    if sta is None:
+        sta = wifi_connect()
+    if uart is None:
+        uart = uart_setup()
+    set_time()
+
+    # Every frame is written through the link flow control, which holds
+    # responses and stream data back while the Pico's rx buffer may be full
+    if rxbuf is None:
+        rxbuf = getattr(esp32_config, "UART_RXBUF", 8192)
+    flow = FlowControl(uart.write, rxbuf)
+    can_send = flow.can_send
+    out_q = []  # frames waiting for flow control credit, in order
+
     check = uart.any
     read = uart.read
-    write = uart.write
-    collect = gc.collect
-    delay = time.sleep_ms
+    write = flow.write
+    # Sleeps until the Pico sends something, instead of 1 ms polling
+    uart_wait = UartWait(uart, uart_wait).wait
+    if gc_policy is None:
+        gc_policy = getattr(esp32_config, "GC_POLICY", None)
+    gcp = gcpolicy.make(gc_policy)
+    gc_step = gcp.step
+    gc_idle = gcp.idle
+
+    load_op_modules()
 
     slip = SlipStream()
-    slip_feed = slip.feed
-    socktab = SockTable()
+    slip_feed = slip.feed_views
+    if nonblocking is None:
+        nonblocking = NONBLOCKING
+    socktab = SockTable(nonblocking)
+    socktab.flow = flow
+    socktab.gc = gcp
+    pool_expire = socktab.pool.expire
 
-    resp_cache = {}
-    resp_cache_order = []
+    # Sent responses, replayed to retransmitted requests until acked
+    resp_cache = socktab.resp_cache = RespCache()
 
-    print("UART v3 bridge ready")
+    # Reusable encode buffers: responses (grown on demand) and ACKs
+    txbuf = bytearray(frame_size(1024))
+    ackbuf = bytearray(frame_size(0))
+    ackmv = memoryview(ackbuf)
 
-    try:
-        while True:
-            n = check()
-            if n:
-                data = read(n) or b""
-                for raw in slip_feed(data):
-                    pkt = unpack_packet(raw)
-                    if not pkt:
-                        continue
-                    msg_type, seq, payload = pkt
+    # Requests already executed whose response left the cache: a late
+    # retransmit (same seq and frame CRC) must not run a second time.
+    recent = {}
+    recent_ring = [None] * RECENT_MAX
+    recent_pos = 0
+
+    # "ack" mode: per-op duration estimate, to decide which requests get
+    # a stand-alone ACK before they run (the response acks the others)
+    op_ms = {}
+
+    def send(pkt):
+        # Out now if the Pico has room, else after the frames queued before
+        if out_q or not can_send(len(pkt)):
+            out_q.append(pkt)
+        else:
+            write(pkt)
+
+    def respond(seq, resp_obj):
+        nonlocal txbuf
+        resp_payload = pack(resp_obj)
+        need = frame_size(len(resp_payload))
+        if len(txbuf) < need:
+            txbuf = bytearray(need)
+        # In "ack" mode the response carries the cumulative ack of this request
+        n = pack_packet_into(txbuf, T_RESP, seq, resp_payload, seq if "ack" in caps else None)
+        resp_pkt = bytes(memoryview(txbuf)[:n])
+
+        resp_cache.put(seq, resp_pkt)
+        send(resp_pkt)
+
+        if DEBUG:
+            print("RESP", seq, resp_obj)
+
+    def park(seq):
+        # The response comes later: stop the client from re-sending
+        if "ack" in caps:
+            write(ackmv[:pack_packet_into(ackbuf, T_ACK, seq, b"", seq)])
 
-                    if msg_type in (T_REQ, T_RESP):
-                        write(pack_packet(T_ACK, seq, b""))
+    ops = PendingOps(socktab, respond, park, uart) if nonblocking else None
+    streams = socktab.streams = Streams(socktab, write, lambda n: not out_q and can_send(n))
 
-                    if msg_type == T_ACK:
-                        if seq in resp_cache:
-                            resp_cache.pop(seq, None)
-                        continue
+    def execute(seq, payload, crc):
+        nonlocal recent_pos
+        old = recent_ring[recent_pos]
+        if old is not None and recent.get(old) is not None:
+            recent.pop(old)
+        recent_ring[recent_pos] = seq
+        recent_pos = (recent_pos + 1) % RECENT_MAX
+        recent[seq] = crc
 
-                    if msg_type != T_REQ:
-                        continue
+        gcp.op_done()
+        req = unpack(bytes(payload)) if payload else {}
+        op, args = expand_request(req)
+        if not isinstance(op, str):
+            op = None
+        # unknown ops are ACKed too, so a slow first call is not re-sent
+        if op and "ack" in caps and op_ms.get(op, ACK_DELAY_MS + 1) > ACK_DELAY_MS:
+            write(ackmv[:pack_packet_into(ackbuf, T_ACK, seq, b"", seq)])
+        if DEBUG:
+            print("REQ", seq, req)
+        t0 = ticks_ms()
+        resp_obj = None
+        if ops is not None and op == "sock_reset":
+            ops.cancel_all()
+        if ops is None or not ops.take(seq, op, args):
+            resp_obj = handle_op(socktab, op, args)
+        if op:
+            dt = ticks_diff(ticks_ms(), t0)
+            op_ms[op] = (op_ms[op] * 3 + dt) // 4 if op in op_ms else dt
+        if resp_obj is not None:
+            respond(seq, resp_obj)
 
-                    cached = resp_cache.get(seq)
-                    if cached:
-                        write(cached)
-                        continue
+    def reset():
+        caps.clear()
+        flow.disable()
 
-                    req = unpack(payload) if payload else {}
-                    resp_obj = handle_req(socktab, req)
-                    resp_payload = pack(resp_obj)
-                    resp_pkt = pack_packet(T_RESP, seq, resp_payload)
+    reorder = Reorder(execute, reset, respond)
+    held = reorder.held
 
-                    resp_cache[seq] = resp_pkt
-                    resp_cache_order.append(seq)
-                    if len(resp_cache_order) > RESP_CACHE_MAX:
-                        old = resp_cache_order.pop(0)
-                        resp_cache.pop(old, None)
+    def on_frame(raw):
+        # raw is a view into the SLIP frame buffer, only valid during this call
+        pkt = unpack_packet_view(raw)
+        if not pkt:
+            return
+        msg_type, seq, payload = pkt
+        ack_mode = "ack" in caps
 
-                    write(resp_pkt)
+        if msg_type == T_CREDIT:
+            streams.on_credit(seq, payload)
+            return
+        if msg_type == T_WINDOW:
+            flow.on_window(payload)
+            return
 
-                    if DEBUG:
-                        print("REQ", seq, req, "RESP", resp_obj)
-                collect()
+        if msg_type == T_REQ and not ack_mode:
+            write(ackmv[:pack_packet_into(ackbuf, T_ACK, seq)])
+
+        # V3X frames carry a cumulative ack: every response up to it arrived
+        ack = packet_ack(raw)
+        if ack is not None:
+            resp_cache.ack(ack)
+
+        if msg_type == T_ACK:
+            if ack is None:
+                resp_cache.pop(seq)
+            return
+
+        if msg_type != T_REQ:
+            return
+
+        cached = resp_cache.get(seq)
+        if cached:
+            if cached not in out_q:
+                send(cached)
+            return
+        crc = packet_crc(raw)
+        if seq in held:
+            return
+        if recent.get(seq) == crc:
+            resp_cache.misses += 1  # evicted, or the op is still running
+            if ack_mode:
+                # Needless retransmit, tell the client how far we got
+                a = reorder.last()
+                write(ackmv[:pack_packet_into(ackbuf, T_ACK, a, b"", a)])
+            return
+        reorder.on_request(seq, payload, crc)
+
+    print("UART v3 bridge ready")
+
+    try:
+        while stop is None or not stop():
+            n = check()
+            if n:
+                data = read(n) or b""
+                flow.received(len(data))
+                slip_feed(data, on_frame)
+                gc_step()
+
+            elif reorder.overdue():
+                reorder.skip_gap()
+
+            elif ops is not None and ops.active():
+                gc_idle()
+                pool_expire()
+                # sleeps on the parked sockets, and the UART if pollable;
+                # short waits while the UART is not or something needs attention
+                busy = out_q or held or streams.active() or ops.spinning() or not ops.uart_polled
+                ops.poll(1 if busy else IDLE_WAIT_MS)
 
             else:
-                delay(1)
+                gc_idle()
+                pool_expire()
+                # short waits while frames, streams or a gap need attention
+                uart_wait(1 if out_q or held or streams.active() else IDLE_WAIT_MS)
+
+            if n and ops is not None and ops.active():
+                ops.poll(0)
+            while out_q and can_send(len(out_q[0])):
+                write(out_q.pop(0))
+            if streams.active():
+                streams.pump()
+        socktab.close_all()
     except KeyboardInterrupt:
         print("\nShutting down...")
         socktab.close_all()
@@ -414,4 +1799,6 @@ def main():
         socktab.close_all()
         raise
 
-main()
+# Start on import (main.py: import esp32_proxy), unless AUTOSTART = False
+if getattr(esp32_config, "AUTOSTART", True):
+    main()
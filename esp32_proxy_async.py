@@ -0,0 +1,465 @@
+# esp32_proxy_async.py
+#
+# asyncio variant of esp32_proxy: same ops, framing and link protocol, but
+# every request runs as its own task. A connect or a recv waiting on one
+# socket no longer holds up requests for the others; requests for the same
+# socket still run one at a time, in seq order.
+#
+# The ops come from esp32_proxy, so set AUTOSTART = False in esp32_config
+# and start this variant instead (main.py):
+#
+#   import esp32_proxy_async
+#   esp32_proxy_async.run()
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import errno
+import select
+
+import esp32_config
+import gcpolicy
+from esp32_config import uart_setup, wifi_connect, set_time
+from cbor3 import dumps as pack, loads as unpack
+import esp32_proxy
+from esp32_proxy import (
+    SockTable, Streams, RespCache, Reorder, NB_OPS, OpError, handle_op, sock_arg, op_deadline, load_op_modules,
+    batch_requests,
+    caps, REORDER_WINDOW, RECENT_MAX, ACK_DELAY_MS, IDLE_WAIT_MS,
+)
+from bridge import (
+    SlipStream, pack_packet_into, unpack_packet_view, frame_size,
+    packet_ack, packet_crc, expand_request,
+    T_REQ, T_RESP, T_ACK, T_CREDIT, T_WINDOW, FlowControl,
+    ticks_ms, ticks_diff
+)
+
+MAX_TASKS = getattr(esp32_config, "MAX_TASKS", 8)  # requests running at once
+WAITING_MAX = REORDER_WINDOW  # ... and waiting for one to finish, more get "busy"
+IO_POLL_MS = 20  # longest sleep between readiness checks of a waiting socket
+
+if hasattr(asyncio, "sleep_ms"):
+    sleep_ms = asyncio.sleep_ms
+else:  # CPython
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+if hasattr(asyncio, "wait_for_ms"):
+    _wait_for_ms = asyncio.wait_for_ms
+else:  # CPython
+    def _wait_for_ms(aw, ms):
+        return asyncio.wait_for(aw, ms / 1000)
+
+async def wait_event(ev, ms):
+    # Wait until ev is set, at most ms; True if it was
+    try:
+        await _wait_for_ms(ev.wait(), ms)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+class _Queue:
+    # FIFO between tasks (MicroPython asyncio has no Queue)
+    def __init__(self):
+        self._items = []
+        self._ev = asyncio.Event()
+
+    def put(self, item):
+        self._items.append(item)
+        self._ev.set()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    async def get(self):
+        while not self._items:
+            self._ev.clear()
+            await self._ev.wait()
+        return self._items.pop(0)
+
+async def wait_io(sock, mask, deadline=None, spin=0):
+    # Wait until sock is ready for mask. Returns the poll events, or 0 at the
+    # deadline. With spin (TLS: buffered data poll does not see, and a
+    # handshake waits on POLLOUT, nearly always set) it returns after spin
+    # ms, at once if data is pending. Else sleeps 1, 2, 4 ... up to
+    # IO_POLL_MS ms between checks.
+    p = select.poll()
+    p.register(sock, mask)
+    if spin:
+        if not (hasattr(sock, "pending") and sock.pending()):
+            await sleep_ms(spin)
+        ready = p.poll(0)
+        return ready[0][1] if ready else 0
+    ms = 1
+    while True:
+        ready = p.poll(0)
+        if ready:
+            return ready[0][1]
+        if deadline is not None and ticks_diff(deadline, ticks_ms()) <= 0:
+            return 0
+        await sleep_ms(ms)
+        ms = min(ms << 1, IO_POLL_MS)
+
+async def run_nb_op(socktab, op, args):
+    # Run one of esp32_proxy.NB_OPS on its non-blocking socket to the end
+    fn, error, close = NB_OPS[op]
+    sid = None
+    try:
+        sid, s = sock_arg(socktab, args)
+        deadline = op_deadline(socktab, sid, args)
+        # TLS ops retry after 1, 2, 4 ... ms while the socket stays quiet
+        spin = 1 if args.get("ssl") or op == "sock_wrap_ssl" else 0
+        gen = fn(socktab, sid, s, args)
+        mask = next(gen)
+        while True:
+            # wrap_ssl replaces the socket, so look it up each time
+            ev = await wait_io(socktab.get(sid), mask, deadline, spin)
+            if deadline is not None and ticks_diff(ticks_ms(), deadline) >= 0:
+                raise OSError(errno.ETIMEDOUT)
+            if spin:
+                spin = 1 if ev & select.POLLIN else min(spin << 1, IO_POLL_MS)
+            mask = gen.send(ev)
+    except StopIteration as r:
+        return r.args[0] if r.args else None
+    except OpError as e:
+        return e.resp()
+    except KeyError as e:
+        return {"ok": False, "error": "missing_parameter", "detail": repr(e)}
+    except ValueError as e:
+        return {"ok": False, "error": "invalid_parameter", "detail": repr(e)}
+    except Exception as e:
+        if close and sid is not None:
+            socktab.close(sid)
+        return {"ok": False, "error": error, "detail": repr(e)}
+
+async def run_batch(socktab, args):
+    # The "batch" op of esp32_proxy, with sub-requests that wait on a
+    # socket awaited instead of holding up the loop
+    try:
+        gen = batch_requests(args)
+        op, a = next(gen)
+        while True:
+            if op in NB_OPS:
+                r = await run_nb_op(socktab, op, a)
+            else:
+                r = handle_op(socktab, op, a)
+            op, a = gen.send(r)
+    except StopIteration as r:
+        return r.args[0] if r.args else None
+    except ValueError as e:
+        return {"ok": False, "error": "invalid_parameter", "detail": repr(e)}
+
+class AsyncProxy:
+    # Tasks: the UART reader, which executes requests in seq order by
+    # starting a task per request (or queueing it behind the running one of
+    # its socket), and the writer, which sends the frames the others queue.
+    def __init__(self, uart, max_tasks=None, rxbuf=None, gc_policy=None):
+        self.uart = uart
+        self.max_tasks = max_tasks or MAX_TASKS
+        self.socktab = SockTable(nonblocking=True)
+        if gc_policy is None:
+            gc_policy = getattr(esp32_config, "GC_POLICY", None)
+        self.gc = self.socktab.gc = gcpolicy.make(gc_policy)
+        # The writer holds frames back while the Pico's rx buffer may be full
+        if rxbuf is None:
+            rxbuf = getattr(esp32_config, "UART_RXBUF", 8192)
+        self.flow = self.socktab.flow = FlowControl(uart.write, rxbuf)
+        self.tasks = 0                  # request tasks running
+        self._waiting = []              # tasks to start once one finishes
+        self._out = _Queue()            # frames for the writer task
+        self._window = asyncio.Event()  # set on a window update: the writer may send
+        self._credit = asyncio.Event()  # set on stream credit or window: the streamer may send
+        self._socks = {}                # sid -> [queue of (seq, op, args), task]
+        self.streams = self.socktab.streams = Streams(
+            self.socktab, lambda b: self._out.put(bytes(b)),
+            lambda n: not self._out._items and self.flow.can_send(n))
+
+        self._slip = SlipStream()
+        self._ackbuf = bytearray(frame_size(0))
+        self._txbuf = bytearray(frame_size(1024))
+
+        self._resp_cache = self.socktab.resp_cache = RespCache()
+        # Pipelined requests are started in seq order, held while one is missing
+        self._reorder = Reorder(self._execute, self._reset, self._respond)
+        # Executed (seq, crc) pairs, to drop late retransmits
+        self._recent = {}
+        self._recent_ring = [None] * RECENT_MAX
+        self._recent_pos = 0
+        # "ack" mode: per-op duration estimate, as in esp32_proxy.main()
+        self._op_ms = {}
+
+    async def serve(self, stop=None):
+        # Runs until stop() is true (never when None)
+        writer = asyncio.create_task(self._writer())
+        streamer = asyncio.create_task(self._streamer())
+        try:
+            await self._reader(stop)
+        finally:
+            self._cancel_all(None)
+            streamer.cancel()
+            writer.cancel()
+            self.socktab.close_all()
+
+    async def _reader(self, stop):
+        check = self.uart.any
+        read = self.uart.read
+        feed = self._slip.feed_views
+        ms = 1
+        while stop is None or not stop():
+            # Frames are read while every task is busy too: ACKs, credit
+            # and window updates must not wait, _start() holds the requests
+            n = check()
+            if n:
+                data = read(n) or b""
+                self.flow.received(len(data))
+                feed(data, self._on_frame)
+                self.gc.step()
+                ms = 1
+                await sleep_ms(0)
+            elif self._reorder.overdue():
+                self._reorder.skip_gap()
+            else:
+                # 1, 2, 4 ... up to IDLE_WAIT_MS ms while nothing arrives
+                self.gc.idle()
+                self.socktab.pool.expire()
+                await sleep_ms(ms)
+                ms = min(ms << 1, IDLE_WAIT_MS)
+
+    async def _writer(self):
+        # Waits for a window update while flow control holds a frame back;
+        # can_send() asks for one when none comes
+        flow = self.flow
+        while True:
+            frame = await self._out.get()
+            while True:
+                self._window.clear()
+                if flow.can_send(len(frame)):
+                    break
+                await wait_event(self._window, IO_POLL_MS)
+            flow.write(frame)
+            if not self._out._items:
+                self._credit.set()  # the streamer's turn
+
+    async def _streamer(self):
+        # Socket data of sock_stream_start streams out as credit allows.
+        # While nothing goes out it waits 1, 2, 4 ... up to IO_POLL_MS ms
+        # for socket data, or less until credit or a window update arrives.
+        ms = 1
+        while True:
+            self._credit.clear()
+            if self.streams.active() and self.streams.pump():
+                ms = 1
+                await sleep_ms(0)
+                continue
+            if not await wait_event(self._credit, ms if self.streams.active() else IO_POLL_MS):
+                ms = min(ms << 1, IO_POLL_MS)
+
+    def _send_ack(self, seq, ack=None):
+        # straight out: ACKs are small and not held back by flow control
+        n = pack_packet_into(self._ackbuf, T_ACK, seq, b"", ack)
+        self.flow.write(memoryview(self._ackbuf)[:n])
+
+    def _respond(self, seq, resp_obj):
+        resp_payload = pack(resp_obj)
+        need = frame_size(len(resp_payload))
+        if len(self._txbuf) < need:
+            self._txbuf = bytearray(need)
+        n = pack_packet_into(self._txbuf, T_RESP, seq, resp_payload, seq if "ack" in caps else None)
+        resp_pkt = bytes(memoryview(self._txbuf)[:n])
+
+        self._resp_cache.put(seq, resp_pkt)
+        self._out.put(resp_pkt)
+
+    def _reset(self):
+        # A new client session without "hello", see Reorder
+        caps.clear()
+        self.flow.disable()
+        self._window.set()
+
+    def _cancel_all(self, error="sock_reset"):
+        # Stop the socket tasks; their requests get error (None: no answer)
+        socks = self._socks
+        self._socks = {}
+        for sid in socks:
+            q, task = socks[sid]
+            if task is not None:
+                task.cancel()
+            if error:
+                for seq, op, args in q:
+                    self._respond(seq, {"ok": False, "error": error, "detail": op})
+
+    def _execute(self, seq, payload, crc):
+        old = self._recent_ring[self._recent_pos]
+        if old is not None and self._recent.get(old) is not None:
+            self._recent.pop(old)
+        self._recent_ring[self._recent_pos] = seq
+        self._recent_pos = (self._recent_pos + 1) % RECENT_MAX
+        self._recent[seq] = crc
+
+        self.gc.op_done()
+        req = unpack(bytes(payload)) if payload else {}
+        op, args = expand_request(req)
+        if not isinstance(op, str):
+            op = None
+        if op and "ack" in caps and self._op_ms.get(op, ACK_DELAY_MS + 1) > ACK_DELAY_MS:
+            self._send_ack(seq, seq)
+
+        if op is None or op == "hello" or op == "sock_reset":
+            # Session ops take effect before any later request starts
+            if op == "sock_reset":
+                self._cancel_all()
+            self._respond(seq, handle_op(self.socktab, op, args))
+            return
+
+        try:
+            sid = int(args.get("sid"))
+        except (ValueError, TypeError):
+            sid = None
+        if sid is None:
+            self._start(None, (seq, op, args))
+            return
+        entry = self._socks.get(sid)
+        if entry is not None:
+            entry[0].append((seq, op, args))
+            return
+        q = [(seq, op, args)]
+        self._socks[sid] = [q, None]
+        self._start(sid, q)
+
+    def _start(self, sid, work):
+        # A task for one request (sid None) or for a socket's queue, once
+        # fewer than max_tasks are running
+        if self.tasks >= self.max_tasks:
+            if len(self._waiting) < WAITING_MAX:
+                self._waiting.append((sid, work))
+            else:
+                self._reject(sid, work)
+            return
+        if sid is None:
+            self.tasks += 1
+            asyncio.create_task(self._op_task(work))
+            return
+        entry = self._socks.get(sid)
+        if entry is None or entry[0] is not work:
+            return  # cancelled by sock_reset while waiting
+        self.tasks += 1
+        entry[1] = asyncio.create_task(self._sock_task(sid, work))
+
+    def _reject(self, sid, work):
+        # Too many requests waiting for a task: answer "busy" right away
+        if sid is None:
+            work = [work]
+        else:
+            entry = self._socks.get(sid)
+            if entry is not None and entry[0] is work:
+                del self._socks[sid]
+        for seq, op, args in work:
+            self._respond(seq, {"ok": False, "error": "busy", "detail": op})
+
+    def _task_done(self):
+        self.tasks -= 1
+        while self._waiting and self.tasks < self.max_tasks:
+            sid, work = self._waiting.pop(0)
+            self._start(sid, work)
+
+    async def _op_task(self, work):
+        try:
+            await self._run(*work)
+        finally:
+            self._task_done()
+
+    async def _sock_task(self, sid, q):
+        # The requests for one socket, in order; ends when none are left
+        try:
+            while q:
+                seq, op, args = q[0]
+                await self._run(seq, op, args)
+                q.pop(0)
+        finally:
+            entry = self._socks.get(sid)
+            if entry is not None and entry[0] is q:
+                del self._socks[sid]
+            self._task_done()
+
+    async def _run(self, seq, op, args):
+        t0 = ticks_ms()
+        if op in NB_OPS:
+            resp = await run_nb_op(self.socktab, op, args)
+        elif op == "batch":
+            resp = await run_batch(self.socktab, args)
+        else:
+            resp = handle_op(self.socktab, op, args)
+        dt = ticks_diff(ticks_ms(), t0)
+        op_ms = self._op_ms
+        op_ms[op] = (op_ms[op] * 3 + dt) // 4 if op in op_ms else dt
+        self._respond(seq, resp)
+
+    def _on_frame(self, raw):
+        # raw is a view into the SLIP frame buffer, only valid during this call
+        pkt = unpack_packet_view(raw)
+        if not pkt:
+            return
+        msg_type, seq, payload = pkt
+        ack_mode = "ack" in caps
+
+        if msg_type == T_CREDIT:
+            self.streams.on_credit(seq, payload)
+            self._credit.set()
+            return
+        if msg_type == T_WINDOW:
+            self.flow.on_window(payload)
+            self._window.set()
+            self._credit.set()
+            return
+
+        if msg_type == T_REQ and not ack_mode:
+            self._send_ack(seq)
+
+        # V3X frames carry a cumulative ack: every response up to it arrived
+        ack = packet_ack(raw)
+        if ack is not None:
+            self._resp_cache.ack(ack)
+
+        if msg_type == T_ACK:
+            if ack is None:
+                self._resp_cache.pop(seq)
+            return
+
+        if msg_type != T_REQ:
+            return
+
+        cached = self._resp_cache.get(seq)
+        if cached:
+            if cached not in self._out:  # a burst of retransmits: send it once
+                self._out.put(cached)
+            return
+        crc = packet_crc(raw)
+        if seq in self._reorder.held:
+            return
+        if self._recent.get(seq) == crc:
+            self._resp_cache.misses += 1  # evicted, or the op is still running
+            if ack_mode:
+                # Needless retransmit (or the op is still running)
+                a = self._reorder.last()
+                self._send_ack(a, a)
+            return
+        self._reorder.on_request(seq, payload, crc)
+
+def run(uart=None, stop=None, max_tasks=None, rxbuf=None, gc_policy=None):
+    # Like esp32_proxy.main(), on asyncio.
+    # stop: optional callable, returns once it is true.
+    # max_tasks: requests running at once, default MAX_TASKS.
+    # rxbuf: rx buffer size of uart, default esp32_config.UART_RXBUF.
+    # gc_policy: gcpolicy name or object, default esp32_config.GC_POLICY.
+    if esp32_proxy.sta is None:
+        esp32_proxy.sta = wifi_connect()
+    if uart is None:
+        uart = uart_setup()
+    set_time()
+    load_op_modules()
+
+    print("UART v3 bridge ready (asyncio)")
+    try:
+        asyncio.run(AsyncProxy(uart, max_tasks, rxbuf, gc_policy).serve(stop))
+    except KeyboardInterrupt:
+        print("\nShutting down...")
@@ -8,7 +8,22 @@ RX = 1
 CTS = 2
 RTS = 3
 
+# When BridgeClient runs gc.collect(): "always", "alloc", "threshold" or
+# "idle" (see gcpolicy.py)
+GC_POLICY = "idle"
+
+# Resolver cache of getaddrinfo(): names kept, and for how long a result
+# and a failed lookup are used (0: not cached)
+DNS_CACHE_MAX = 16
+DNS_TTL_MS = 300_000
+DNS_NEG_TTL_MS = 10_000
+
+# UART rx buffer size, set by uart_setup(); with the "flow" cap the other
+# side never has more bytes than this in flight
+UART_RXBUF = 8192
+
 def uart_setup():
+    global UART_RXBUF
     try:
         rxbuf=16384
         uart = UART(
@@ -18,6 +33,7 @@ def uart_setup():
             timeout=0, rxbuf=rxbuf,
             flow=UART.RTS | UART.CTS,
         )
+        UART_RXBUF = rxbuf
         print(f"UART: {BAUD} baud, rxbuf={rxbuf}, flow=ON, timeout=0")
         print(f"PINS: tx={TX}, rx={RX}, rts={RTS}, cts={CTS}")
     except TypeError:
@@ -27,6 +43,7 @@ def uart_setup():
             tx=Pin(TX), rx=Pin(RX),
             timeout=0, rxbuf=rxbuf,
         )
+        UART_RXBUF = rxbuf
         print(f"UART: {BAUD} baud, rxbuf={rxbuf}, flow=OFF, timeout=0")
         print(f"PINS: tx={TX}, rx={RX}")
     except Exception as e:
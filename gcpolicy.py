@@ -0,0 +1,153 @@
+# gcpolicy.py
+#
+# When the main loops of esp32_proxy and pico_client run gc.collect(). A
+# full collection takes milliseconds on a large or fragmented heap, so one
+# after every UART chunk, or on every 1 ms wait iteration, costs more than
+# the op itself. A policy decides instead:
+#
+#   "always"     at every step, as the loops used to
+#   "threshold"  left to the VM: gc.threshold(nbytes) collects after that
+#                much allocation, the loops never do
+#   "alloc"      at a step, once bytes have been allocated since the last
+#   "idle"       only while the loop has had nothing to do for idle_ms,
+#                unless allocation passes limit bytes
+#
+# The loops call step() after handling input, idle() when there was none
+# and op_done() once per op. stats() has the collections and the time
+# they took, per op.
+import gc
+import time
+
+DEFAULT = "idle"
+
+def _alloc():
+    # Heap bytes in use, None where the port cannot tell (CPython)
+    f = getattr(gc, "mem_alloc", None)
+    return f() if f is not None else None
+
+class GCPolicy:
+    # "always": the base class counts and times the collections it runs
+    name = "always"
+
+    def __init__(self):
+        self.ops = 0
+        self.collections = 0
+        self.gc_us = 0
+        self._mark = _alloc()  # heap in use after the last collection
+        self._steps = 0        # steps since then, where _alloc() is None
+
+    def step(self):
+        self.collect()
+
+    def idle(self):
+        pass
+
+    def op_done(self):
+        self.ops += 1
+
+    def collect(self):
+        t0 = time.ticks_us()
+        gc.collect()
+        self.gc_us += time.ticks_diff(time.ticks_us(), t0)
+        self.collections += 1
+        self._mark = _alloc()
+        self._steps = 0
+
+    def allocated(self, every):
+        # Bytes allocated since the last collection. Without mem_alloc,
+        # every counted step stands for every bytes.
+        a = _alloc()
+        if a is None or self._mark is None:
+            self._steps += 1
+            return self._steps * every
+        return a - self._mark
+
+    def stats(self):
+        ops = max(1, self.ops)
+        return {
+            "policy": self.name,
+            "ops": self.ops,
+            "collections": self.collections,
+            "gc_us": self.gc_us,
+            "collections_per_op": self.collections / ops,
+            "gc_us_per_op": self.gc_us // ops,
+        }
+
+class AllocGC(GCPolicy):
+    name = "alloc"
+
+    def __init__(self, nbytes=8192):
+        super().__init__()
+        self.bytes = nbytes
+
+    def step(self):
+        if self.allocated(self.bytes >> 4) >= self.bytes:
+            self.collect()
+
+class ThresholdGC(GCPolicy):
+    # The VM collects by itself; where gc.threshold is missing this falls
+    # back to "alloc". Collections by the VM are counted when the heap in
+    # use shrinks between steps, their time is not known.
+    name = "threshold"
+
+    def __init__(self, nbytes=8192):
+        super().__init__()
+        self.bytes = nbytes
+        self._vm = hasattr(gc, "threshold") and self._mark is not None
+        if self._vm:
+            gc.threshold(nbytes)
+
+    def step(self):
+        if not self._vm:
+            if self.allocated(self.bytes >> 4) >= self.bytes:
+                self.collect()
+            return
+        a = _alloc()
+        if a < self._mark:
+            self.collections += 1
+        self._mark = a
+
+class IdleGC(GCPolicy):
+    name = "idle"
+
+    def __init__(self, nbytes=1024, limit=32768, idle_ms=2):
+        super().__init__()
+        self.bytes = nbytes
+        self.limit = limit
+        self.idle_ms = idle_ms
+        self._busy_at = time.ticks_ms()
+
+    def step(self):
+        self._busy_at = time.ticks_ms()
+        if self.allocated(self.bytes) >= self.limit:
+            self.collect()
+
+    def op_done(self):
+        self.ops += 1
+        self._busy_at = time.ticks_ms()
+
+    def idle(self):
+        if time.ticks_diff(time.ticks_ms(), self._busy_at) < self.idle_ms:
+            return
+        a = _alloc()
+        if a is None or self._mark is None:
+            if self._steps:
+                self.collect()
+        elif a - self._mark >= self.bytes:
+            self.collect()
+
+POLICIES = {
+    "always": GCPolicy,
+    "alloc": AllocGC,
+    "threshold": ThresholdGC,
+    "idle": IdleGC,
+}
+
+def make(policy=None, **kwargs):
+    # A policy by name (None: DEFAULT), or policy itself if already one
+    if isinstance(policy, GCPolicy):
+        return policy
+    cls = POLICIES.get(policy or DEFAULT)
+    if cls is None:
+        raise ValueError(f"unknown gc policy: {policy}")
+    return cls(**kwargs)
@@ -1,111 +1,654 @@
 # pico_client.py
-import time
+import random
+import struct
 from machine import UART, Pin
 from cbor3 import dumps as pack, loads as unpack
 from pico_config import uart_setup
-import gc
+import pico_config
+import gcpolicy
 
 from bridge import (
-    SlipStream, pack_packet, unpack_packet,
-    T_REQ, T_RESP, T_ACK,
+    SlipStream, pack_packet_into, unpack_packet_view, frame_size, packet_ack,
+    compact_request, T_REQ, T_RESP, T_ACK, T_DATA, T_CREDIT, T_WINDOW, FlowControl, FLOW_RESERVE, UartWait, DnsCache, seq_next, seq_prev, seq_le,
+    DATA_HDR, DATA_HDR_SIZE, CREDIT_FMT, CREDIT_SIZE, CREDIT_GAP, off_diff,
     ticks_ms, ticks_add, ticks_diff
 )
 
+def ref(index, *path):
+    # A batch request arg taken from the result of request index of the
+    # same batch, e.g. ref(0, "sid") after a sock_open
+    return {"$ref": [index] + list(path)}
+
+def batch_error(resps, n):
+    # OSError for the first failed one of a batch of n, None if all went well
+    for r in resps:
+        if not r.get("ok"):
+            return OSError(f"{r.get('error', 'remote_error')}: {r.get('detail', '')}")
+    if len(resps) < n:
+        return OSError("batch_incomplete")
+    return None
+
+def is_address(host):
+    # True for a numeric IPv4 or IPv6 address, which needs no lookup
+    return ":" in host or (host.count(".") == 3 and host.replace(".", "").isdigit())
+
+def dns_negative(e):
+    # Whether a failed dns request is about the name (the ESP32's lookup
+    # failed), so its error may be cached; a lost link is not
+    return str(e).startswith("dns_error")
+
+def dns_args(key):
+    host, port, family, typ = key
+    return {"host": host, "port": port, "family": family, "type": typ}
+
+def wrap_args(sid, server_hostname=None, verify=None, reuse=True):
+    # Args of sock_wrap_ssl. verify None: the proxy's TLS_VERIFY; reuse
+    # False: a new SSLContext and no session resumption, for comparison.
+    args = {"sid": sid, "server_hostname": server_hostname}
+    if verify is not None:
+        args["verify"] = bool(verify)
+    if not reuse:
+        args["reuse"] = False
+    return args
+
+def connect_requests(host, port, ssl, server_hostname=None, data=None, timeout_ms=5000, pool=False,
+                     verify=None):
+    # The batch of ProxySocket.open_connection(): open, connect, TLS, send
+    sid = ref(0, "sid")
+    connect = {"sid": sid, "host": host, "port": int(port), "ssl": bool(ssl),
+               "timeout_ms": 0 if ssl else int(timeout_ms)}
+    if pool:
+        connect["pool"] = True
+    reqs = [
+        ("sock_open", {"family": ProxySocket.AF_INET, "type": ProxySocket.SOCK_STREAM, "proto": 0}),
+        ("sock_connect", connect),
+    ]
+    if ssl:
+        reqs.append(("sock_wrap_ssl", wrap_args(sid, server_hostname or host, verify)))
+    if data:
+        reqs.append(("sock_send", {"sid": sid, "data": bytes(data), "all": True}))
+    return reqs
+
+class PendingCall:
+    # Handle for an in-flight request, returned by BridgeClient.submit()
+    def __init__(self, client, op, seq, buf, n, timeout_ms, rto_ms):
+        self.client = client
+        self.op = op
+        self.seq = seq
+        self.resp = None
+        self.acked = False
+        self._buf = buf  # encoded frame is buf[:n], kept for retransmits
+        self._n = n
+        self._rto = int(rto_ms)  # backed off on every retransmit
+        self._deadline = ticks_add(ticks_ms(), int(timeout_ms))
+        self._first_sent = 0
+        self._next_send = 0
+        self._sent = False
+        self._retries = 0
+        self._timed = False  # RTT sample taken
+
+    def done(self):
+        if self.resp is None:
+            self.client.poll()
+        return self.resp is not None
+
+    def result(self):
+        return self.client.wait(self)
+
+class _RxStream:
+    # Receive side of a sock_stream_start stream
+    __slots__ = ("buf", "off", "credit", "acked", "granted", "eof", "gap", "last")
+
+    def __init__(self, credit):
+        self.buf = bytearray()  # arrived, not read yet
+        self.off = 0            # offset of the next byte expected
+        self.credit = credit    # most bytes buffered here
+        self.acked = 0          # offset and limit of the last T_CREDIT sent
+        self.granted = credit
+        self.eof = False
+        self.gap = False        # a gap was reported, not filled yet
+        self.last = ticks_ms()  # when the last T_CREDIT went out
+
 class BridgeClient:
-    def __init__(self):
-        self.uart = uart_setup()
+    # Retransmission timer bounds (ms). Before the first RTT sample every
+    # request starts at RTO_INIT_MS; once the ESP32 has ACKed a request it is
+    # only re-sent every ACK_PROBE_MS or more, in case the response was lost.
+    RTO_INIT_MS = 200
+    RTO_MIN_MS = 20
+    RTO_MAX_MS = 4000
+    ACK_PROBE_MS = 1000
+    # Streams: data arrived is acked within STREAM_ACK_MS, and credit is
+    # refreshed every STREAM_REFRESH_MS while idle, in case a T_CREDIT was lost
+    STREAM_ACK_MS = 20
+    STREAM_REFRESH_MS = 500
+
+    # Longest wait for input inside wait() and friends; input ends it early
+    IDLE_WAIT_MS = 20
+    # Most requests per batch, esp32_proxy.BATCH_MAX
+    BATCH_MAX = 16
+    # Most requests in flight: the ESP32 holds up to REORDER_WINDOW - 1
+    # requests ahead of a lost one, any further ahead it cannot tell from a
+    # new session. negotiate() lowers it to what the ESP32 says.
+    WINDOW_MAX = 15
+
+    def __init__(self, window=8, uart=None, rxbuf=None, gc_policy=None, uart_wait=None):
+        self.uart = uart if uart is not None else uart_setup()
+        # Waits for responses sleep until input arrives (UartWait mode
+        # "irq", "poll" or "sleep"; None: the best one the port has)
+        self.uart_wait = UartWait(self.uart, uart_wait)
+        # When to run gc.collect(): a gcpolicy name, or a policy object
+        if gc_policy is None:
+            gc_policy = getattr(pico_config, "GC_POLICY", None)
+        self.gc = gcpolicy.make(gc_policy)
+        # Link flow control ("flow" cap): every frame is written through it,
+        # requests wait while the ESP32's rx buffer may be full
+        if rxbuf is None:
+            rxbuf = getattr(pico_config, "UART_RXBUF", 8192)
+        self.flow = FlowControl(lambda buf: self.uart.write(buf), rxbuf)
+        # getaddrinfo() results, repeated lookups cost no UART traffic
+        self.dns = DnsCache(getattr(pico_config, "DNS_CACHE_MAX", 16),
+                            getattr(pico_config, "DNS_TTL_MS", 300_000),
+                            getattr(pico_config, "DNS_NEG_TTL_MS", 10_000))
         self.slip = SlipStream()
-        self.seq = 1
-
-        self._acked = set()
-        self._resp = {}
-        self._max_acked_size = 100
-        self._max_resp_size = 50
+        # Random start so a new client does not replay the seqs of the last one
+        self.seq = random.getrandbits(16) or 1
+
+        # Up to window requests may be outstanding at once, keyed by seq
+        self.window = max(1, min(int(window), self.WINDOW_MAX))
+        self._inflight = {}
+
+        # Protocol extensions agreed with negotiate(). With "ack", responses
+        # are acknowledged cumulatively: piggybacked on the next request, or
+        # in a stand-alone ACK once ack_delay_ms passes without one.
+        self.caps = set()
+        self.ack_delay_ms = 20
+        self._ack_pending = False
+        self._ack_since = 0
+
+        # Jacobson/Karn RTT estimator, in ms scaled by 8 (srtt) and 4 (rttvar)
+        self._srtt = None
+        self._rttvar = 0
+        self.rto_ms = self.RTO_INIT_MS
+        self._calls = 0
+        self._retransmits = 0
+        self._timeouts = 0
+        self._rtt_samples = 0
+
+        # sid -> _RxStream, sockets whose data the ESP32 pushes (stream_start)
+        self._streams = {}
+
+        # Reusable encode buffers: requests (one per window slot) and ACKs
+        self._free_bufs = []
+        self._max_pooled_buf = frame_size(1024)
+        self._ackbuf = bytearray(frame_size(0))
+        self._creditbuf = bytearray(frame_size(CREDIT_SIZE))
+        self._on_frame = self._handle_frame  # bind once, not per UART read
 
     def _next_seq(self):
-        s = self.seq & 0xFFFF
-        self.seq = (self.seq + 1) & 0xFFFF
-        if self.seq == 0:
-            self.seq = 1
-        return s
+        while True:
+            s = self.seq & 0xFFFF
+            self.seq = seq_next(s)
+            if s not in self._inflight:
+                return s
+
+    def _oldest(self):
+        # Outstanding seq furthest behind self.seq, None when idle
+        oldest = None
+        span = -1
+        for s in self._inflight:
+            d = (self.seq - s) & 0xFFFF
+            if d > span:
+                span = d
+                oldest = s
+        return oldest
+
+    def _window_full(self):
+        # Sliding window: the next seq may be at most window-1 ahead of the
+        # oldest outstanding one, so the ESP32 can still replay that response.
+        oldest = self._oldest()
+        return oldest is not None and ((self.seq - oldest) & 0xFFFF) >= self.window
+
+    def _ack_value(self):
+        # Cumulative ack: all responses before the oldest outstanding request
+        oldest = self._oldest()
+        return seq_prev(self.seq if oldest is None else oldest)
+
+    def _send_ack(self):
+        a = self._ack_value()
+        n = pack_packet_into(self._ackbuf, T_ACK, a, b"", a)
+        self.flow.write(memoryview(self._ackbuf)[:n])
+        self._ack_pending = False
+
+    def _rtt_sample(self, p, now):
+        # Karn: a retransmitted request gives an ambiguous sample, skip it
+        if p._timed or p._retries or not p._sent:
+            return
+        p._timed = True
+        r = max(0, ticks_diff(now, p._first_sent))
+        if self._srtt is None:
+            self._srtt = r << 3
+            self._rttvar = r << 1
+        else:
+            err = r - (self._srtt >> 3)
+            self._srtt += err
+            if err < 0:
+                err = -err
+            self._rttvar += err - (self._rttvar >> 2)
+        rto = (self._srtt >> 3) + max(1, self._rttvar)
+        self.rto_ms = min(self.RTO_MAX_MS, max(self.RTO_MIN_MS, rto))
+        self._rtt_samples += 1
+
+    def _mark_acked(self, p, now):
+        # The ESP32 has the request; only probe in case the response is lost
+        if p.acked:
+            return
+        p.acked = True
+        if p._sent:
+            p._next_send = ticks_add(now, max(p._rto << 2, self.ACK_PROBE_MS))
+
+    def stats(self):
+        srtt = None if self._srtt is None else self._srtt >> 3
+        return {
+            "srtt_ms": srtt,
+            "rttvar_ms": self._rttvar >> 2,
+            "rto_ms": self.rto_ms,
+            "calls": self._calls,
+            "retransmits": self._retransmits,
+            "timeouts": self._timeouts,
+            "rtt_samples": self._rtt_samples,
+            "inflight": len(self._inflight),
+            "flow_stalls": self.flow.stalls,
+            "gc": self.gc.stats(),
+            "uart_wait": self.uart_wait.mode,
+            "dns": self.dns.stats(),
+        }
 
     def _pump(self):
         n = self.uart.any()
         if not n:
             return
         data = self.uart.read(n) or b""
-        for raw in self.slip.feed(data):
-            pkt = unpack_packet(raw)
-            if not pkt:
-                continue
-            msg_type, seq, payload = pkt
+        self.flow.received(len(data))
+        self.slip.feed_views(data, self._on_frame)
+        self.gc.step()
+
+    def _handle_frame(self, raw):
+        # raw is a view into the SLIP frame buffer, only valid during this call
+        pkt = unpack_packet_view(raw)
+        if not pkt:
+            return
+        msg_type, seq, payload = pkt
+        if msg_type == T_DATA:
+            self._on_data(seq, payload)
+            return
+        if msg_type == T_WINDOW:
+            self.flow.on_window(payload)
+            return
+        now = ticks_ms()
+
+        # V3X frames acknowledge every request up to their ack field
+        ack = packet_ack(raw)
+        if ack is not None:
+            for p in self._inflight.values():
+                if seq_le(p.seq, ack):
+                    self._mark_acked(p, now)
+
+        if msg_type == T_ACK:
+            p = self._inflight.get(seq)
+            if p is not None:
+                # sent on receipt, so this times the link, not the op
+                self._rtt_sample(p, now)
+                self._mark_acked(p, now)
+            return
 
-            if msg_type == T_ACK:
-                self._acked.add(seq)
-                if len(self._acked) > self._max_acked_size:
-                    self._acked.clear()
+        if msg_type == T_RESP:
+            if "ack" in self.caps:
+                if not self._ack_pending:
+                    self._ack_pending = True
+                    self._ack_since = ticks_ms()
+            else:
+                n = pack_packet_into(self._ackbuf, T_ACK, seq)
+                self.flow.write(memoryview(self._ackbuf)[:n])
+            p = self._inflight.get(seq)
+            if p is None or p.resp is not None:
+                return  # late duplicate
+            self._rtt_sample(p, now)
+            try:
+                # decoded values outlive the frame buffer, so decode from a copy
+                obj = unpack(bytes(payload)) if payload else {}
+            except Exception as e:
+                obj = {"ok": False, "error": "bad_payload", "detail": repr(e)}
+            p.resp = obj
+            self._release(p)
+
+    def _send_credit(self, sid, st, flags=0):
+        window = max(0, st.credit - len(st.buf))
+        payload = struct.pack(CREDIT_FMT, st.off, window, flags)
+        n = pack_packet_into(self._creditbuf, T_CREDIT, sid, payload)
+        self.flow.write(memoryview(self._creditbuf)[:n])
+        st.acked = st.off
+        st.granted = (st.off + window) & 0xFFFFFFFF
+        st.last = ticks_ms()
+
+    def _on_data(self, sid, payload):
+        st = self._streams.get(sid)
+        if st is None or len(payload) < DATA_HDR_SIZE:
+            return
+        d = off_diff(struct.unpack_from(DATA_HDR, payload)[0], st.off)
+        data = payload[DATA_HDR_SIZE:]
+        if d > 0:
+            # an earlier frame was lost: drop this one, have it sent again
+            if not st.gap:
+                st.gap = True
+                self._send_credit(sid, st, CREDIT_GAP)
+            return
+        st.gap = False
+        if not len(data):
+            if not d and not st.eof:
+                st.eof = True
+                st.off = (st.off + 1) & 0xFFFFFFFF
+            self._send_credit(sid, st)
+        elif -d < len(data):
+            if d:
+                data = data[-d:]
+            st.buf.extend(data)
+            st.off = (st.off + len(data)) & 0xFFFFFFFF
+            if off_diff(st.off, st.acked) >= st.credit // 2:
+                self._send_credit(sid, st)
+        else:
+            self._send_credit(sid, st)  # a resend of what we have: our ack was lost
+        self._stream_ready(sid)
+
+    def _stream_ready(self, sid):
+        # Data or end of stream arrived for sid; a hook for subclasses
+        pass
+
+    def _poll_streams(self, now):
+        for sid, st in self._streams.items():
+            if st.eof and st.off == st.acked:
+                continue  # finished
+            idle = ticks_diff(now, st.last)
+            if idle >= self.STREAM_REFRESH_MS or (st.off != st.acked and idle >= self.STREAM_ACK_MS):
+                self._send_credit(sid, st)
+
+    def _wait_ms(self, now):
+        # How long poll() has nothing to do unless input arrives
+        t = self.IDLE_WAIT_MS
+        if self._ack_pending:
+            t = min(t, self.ack_delay_ms - ticks_diff(now, self._ack_since))
+        for st in self._streams.values():
+            if st.eof and st.off == st.acked:
                 continue
-
-            if msg_type == T_RESP:
-                self.uart.write(pack_packet(T_ACK, seq, b""))
-                try:
-                    obj = unpack(payload) if payload else {}
-                except Exception as e:
-                    obj = {"ok": False, "error": "bad_payload", "detail": repr(e)}
-                self._resp[seq] = obj
-                if len(self._resp) > self._max_resp_size:
-                    oldest_keys = sorted(self._resp.keys())[:10]
-                    for k in oldest_keys:
-                        self._resp.pop(k, None)
+            due = self.STREAM_ACK_MS if st.off != st.acked else self.STREAM_REFRESH_MS
+            t = min(t, due - ticks_diff(now, st.last))
+        for p in self._inflight.values():
+            if p.resp is not None:
                 continue
-
-    def call(self, op: str, args=None, timeout_ms=8000, resend_ms=200):
+            if not p._sent:
+                return 1  # held back by flow control
+            t = min(t, ticks_diff(p._next_send, now), ticks_diff(p._deadline, now))
+        return max(0, t)
+
+    def _idle(self):
+        # Nothing to do until input arrives or the next timer is due
+        self.gc.idle()
+        self.uart_wait.wait(self._wait_ms(ticks_ms()))
+
+    def _release(self, p):
+        # Request finished: stop tracking it and recycle its frame buffer
+        self._inflight.pop(p.seq, None)
+        buf = p._buf
+        p._buf = None
+        if buf is not None and len(buf) <= self._max_pooled_buf:
+            self._free_bufs.append(buf)
+
+    def poll(self):
+        # Read responses, retransmit due requests and expire timed out ones
+        self._pump()
+        now = ticks_ms()
+        if self._ack_pending and ticks_diff(now, self._ack_since) >= self.ack_delay_ms:
+            self._send_ack()
+        if self._streams:
+            self._poll_streams(now)
+        if not self._inflight:
+            return
+        blocked = False  # flow control: no room for more frames now
+        for p in list(self._inflight.values()):
+            if p.resp is not None:
+                continue
+            if ticks_diff(p._deadline, now) <= 0:
+                p.resp = {"ok": False, "error": "bridge_timeout", "detail": p.op}
+                self._timeouts += 1
+                self._release(p)
+                continue
+            if p._sent and ticks_diff(now, p._next_send) < 0:
+                continue
+            if blocked or not self.flow.can_send(p._n):
+                blocked = True
+                continue
+            if not p._sent:
+                self.flow.write(memoryview(p._buf)[:p._n])
+                p._sent = True
+                p._first_sent = now
+                p._next_send = ticks_add(now, p._rto)
+            else:
+                self.flow.write(memoryview(p._buf)[:p._n])
+                p._retries += 1
+                self._retransmits += 1
+                if p.acked:
+                    # steady probes: the link works, only a response is missing
+                    p._next_send = ticks_add(now, max(p._rto, self.ACK_PROBE_MS))
+                else:
+                    p._rto = min(p._rto << 1, self.RTO_MAX_MS)  # exponential backoff
+                    p._next_send = ticks_add(now, p._rto)
+
+    def submit(self, op: str, args=None, timeout_ms=8000, resend_ms=None) -> PendingCall:
+        # Send a request without waiting for its response. Blocks only while
+        # the window is full. Requests are executed in seq order on the ESP32.
+        # The first retransmit comes after the estimated RTO unless resend_ms
+        # is given; each further one waits twice as long.
         if args is None:
             args = {}
         if not isinstance(op, str) or not op:
             raise ValueError("Invalid operation")
 
-        seq = self._next_seq()
-        req_obj = {"op": op, "args": args}
-
+        req_obj = None
+        if "compact" in self.caps:
+            req_obj = compact_request(op, args)
+        if req_obj is None:
+            req_obj = {"op": op, "args": args}
         try:
             req_payload = pack(req_obj)
         except Exception as e:
             raise ValueError(f"Failed to pack request: {e}")
 
-        req_pkt = pack_packet(T_REQ, seq, req_payload)
-
+        while self._window_full():
+            self.poll()
+            if self._window_full():
+                self._idle()
+
+        need = frame_size(len(req_payload))
+        buf = self._free_bufs.pop() if self._free_bufs else None
+        if buf is None or len(buf) < need:
+            buf = bytearray(max(need, frame_size(512)))
+        ack = None
+        if "ack" in self.caps:
+            ack = self._ack_value()  # piggyback, no separate ACK frame needed
+            self._ack_pending = False
+        seq = self._next_seq()
+        n = pack_packet_into(buf, T_REQ, seq, req_payload, ack)
+
+        rto = self.rto_ms if resend_ms is None else resend_ms
+        p = PendingCall(self, op, seq, buf, n, timeout_ms, rto)
+        self._inflight[seq] = p
+        self._calls += 1
+        self.gc.op_done()
+        self.poll()
+        return p
+
+    def wait(self, p: PendingCall):
+        while p.resp is None:
+            self.poll()
+            if p.resp is not None:
+                break
+            self._idle()
+        return self._result(p)
+
+    def _result(self, p: PendingCall):
+        # The result of a finished call, or OSError("<error>: <detail>")
+        resp = p.resp
+        if not resp.get("ok", False):
+            error = resp.get("error", "remote_error")
+            detail = resp.get("detail", "")
+            raise OSError(f"{error}: {detail}")
+        return resp.get("result")
+
+    def negotiate(self, caps=("ack", "compact", "flow"), timeout_ms=3000):
+        # Agree on protocol extensions with the ESP32. An older proxy without
+        # the "hello" op answers unknown_op and plain V3 stays in use.
+        try:
+            r = self.call("hello", self._hello_args(caps), timeout_ms=timeout_ms)
+        except OSError:
+            r = None
+        return self._agreed(r)
+
+    def recv_limit(self):
+        # Largest data a response may carry: with "flow" it has to fit our rx
+        # buffer, less the frame and the CBOR around it
+        if self.flow.peer_rxbuf is None:
+            return 65535
+        return self.flow.rxbuf - FLOW_RESERVE - 64
+
+    def _hello_args(self, caps):
+        self.flow.disable()  # until the ESP32 has agreed
+        return {"caps": list(caps), "rx": self.flow.rxbuf}
+
+    def _agreed(self, r):
+        self.caps = set((r or {}).get("caps") or ())
+        if r and r.get("window"):
+            self.window = max(1, min(self.window, int(r["window"])))
+        if "flow" in self.caps:
+            self.flow.enable(int(r.get("rx") or 0))
+        return self.caps
+
+    def call(self, op: str, args=None, timeout_ms=8000, resend_ms=None):
+        return self.wait(self.submit(op, args, timeout_ms, resend_ms))
+
+    def batch(self, reqs, stop=True, timeout_ms=8000):
+        # Several requests in one round trip, run in order by the ESP32.
+        # reqs is [(op, args), ...]; an arg may be ref(i, key, ...), a value
+        # from the result of request i. Returns the responses, a dict with
+        # "ok" and "result" or "error" each; with stop, none after the first
+        # error. OSError("unknown_op: batch") from an older proxy.
+        return self.call("batch", self._batch_args(reqs, stop), timeout_ms)
+
+    def _batch_args(self, reqs, stop):
+        ops = []
+        for op, args in reqs:
+            req = compact_request(op, args or {}) if "compact" in self.caps else None
+            ops.append(req if req is not None else {"op": op, "args": args or {}})
+        return {"ops": ops, "stop": bool(stop)}
+
+    def getaddrinfo(self, host, port, family=0, typ=0, timeout_ms=6000):
+        # The ESP32's getaddrinfo(), cached in self.dns by (host, port,
+        # family, typ)
+        key = (host, int(port), int(family), int(typ))
+        return self.dns.lookup(key, lambda *k: self.call("dns", dns_args(k), timeout_ms), dns_negative)
+
+    def dns_prewarm(self, names, family=0, typ=0, timeout_ms=8000):
+        # Look up [(host, port), ...] in batches of BATCH_MAX, one round
+        # trip each, and cache the results; returns how many resolved.
+        # One request each with an older proxy.
+        keys = [(host, int(port), int(family), int(typ)) for host, port in names]
+        ok = 0
+        for i in range(0, len(keys), self.BATCH_MAX):
+            part = keys[i:i + self.BATCH_MAX]
+            try:
+                resps = self.batch([("dns", dns_args(k)) for k in part], stop=False, timeout_ms=timeout_ms)
+            except OSError as e:
+                if not str(e).startswith("unknown_op"):
+                    raise
+                resps = []
+                for k in part:
+                    try:
+                        resps.append({"ok": True, "result": self.call("dns", dns_args(k), timeout_ms=6000)})
+                    except OSError as e:
+                        resps.append({"ok": False, "error": str(e).split(":")[0]})
+            ok += self._dns_fill(part, resps)
+        return ok
+
+    def _dns_fill(self, keys, resps):
+        ok = 0
+        for key, r in zip(keys, resps):
+            if r.get("ok"):
+                self.dns.add(key, r.get("result"))
+                ok += 1
+            elif r.get("error") == "dns_error":
+                self.dns.add(key, OSError(f"dns_error: {r.get('detail', '')}"))
+        return ok
+
+    def resolved(self, host, port):
+        # host's address if getaddrinfo() has it cached, else host, for the
+        # ESP32 to look up. Not counted in the cache stats, which are about
+        # getaddrinfo().
+        if not isinstance(host, str) or is_address(host):
+            return host
+        r = self.dns.peek((host, int(port), 0, 0))
+        if isinstance(r, OSError):
+            return host  # the ESP32 reports the failure
+        for af, _, _, _, sa in r or ():
+            if af == ProxySocket.AF_INET:
+                return sa[0]
+        return host
+
+    def stream_start(self, sid, credit=8192):
+        # Have the ESP32 push the socket's data as it arrives, up to credit
+        # bytes buffered here; read it with stream_read()
+        sid = int(sid)
+        self._streams[sid] = _RxStream(int(credit))
+        try:
+            return self.call("sock_stream_start", {"sid": sid, "credit": int(credit)}, timeout_ms=4000)
+        except Exception:
+            self._streams.pop(sid, None)
+            raise
+
+    def stream_read(self, sid, n, timeout_ms=5000):
+        # Up to n bytes of the stream, b"" at its end
+        st = self._streams.get(int(sid))
+        if st is None:
+            raise OSError(f"not_streaming: {sid}")
         deadline = ticks_add(ticks_ms(), int(timeout_ms))
-        next_send = 0
-
-        self._acked.discard(seq)
-        self._resp.pop(seq, None)
-
-        while ticks_diff(deadline, ticks_ms()) > 0:
-            now = ticks_ms()
-            if next_send == 0 or ticks_diff(now, next_send) >= 0:
-                self.uart.write(req_pkt)
-                next_send = ticks_add(now, int(resend_ms))
-
-            self._pump()
-
-            if seq in self._resp:
-                resp = self._resp.pop(seq)
-                if not resp.get("ok", False):
-                    error = resp.get("error", "remote_error")
-                    detail = resp.get("detail", "")
-                    raise OSError(f"{error}: {detail}")
-                return resp.get("result")
-
-            time.sleep_ms(1)
-            gc.collect()
-
-        raise OSError(f"bridge_timeout: {op}")
+        while not st.buf and not st.eof:
+            self.poll()
+            if st.buf or st.eof:
+                break
+            if ticks_diff(deadline, ticks_ms()) <= 0:
+                raise OSError(f"stream_timeout: {sid}")
+            self._idle()
+        return self._stream_take(sid, st, n)
+
+    def _stream_take(self, sid, st, n):
+        data = bytes(st.buf[:n])
+        st.buf = st.buf[n:]
+        # reopen the window once half the credit can be granted again
+        window = st.credit - len(st.buf)
+        if off_diff((st.off + window) & 0xFFFFFFFF, st.granted) >= st.credit // 2:
+            self._send_credit(sid, st)
+        return data
+
+    def stream_stop(self, sid, notify=True):
+        # Stop pushing; data not read yet is dropped
+        sid = int(sid)
+        if self._streams.pop(sid, None) is not None and notify:
+            self.call("sock_stream_stop", {"sid": sid}, timeout_ms=2000)
 
 class ProxySocket:
     AF_INET = 2
     SOCK_STREAM = 1
     SOCK_DGRAM = 2
+    # Largest recv() per request: the response must fit a SlipStream frame
+    # (8192 B). Stream reads may return less than asked anyway.
+    RECV_MAX = 8000
 
     def __init__(self, client: BridgeClient, family=None, typ=None, proto=0):
         if family is None:
@@ -114,12 +657,61 @@ class ProxySocket:
             typ = self.SOCK_STREAM
         self.c = client
         self._closed = False
+        self._stream = False
+        self._host = None  # name given to connect(), for the SNI of wrap_ssl()
+        self._pool = False # connected with pool, close() parks it by default
         try:
             r = self.c.call("sock_open", {"family": int(family), "type": int(typ), "proto": int(proto)}, timeout_ms=4000)
             self.sid = int(r["sid"])
         except Exception as e:
             raise OSError(f"Failed to open socket: {e}")
 
+    @classmethod
+    def open_connection(cls, client, host, port, ssl=True, server_hostname=None, data=None, timeout_s=5, pool=False,
+                        verify=None):
+        # Open, connect, wrap_ssl (ssl) and send data (when given) in one
+        # batch request: one round trip instead of up to four. Then recv()
+        # as after connect(addr, ssl). One request each with an older proxy.
+        # pool: as for connect(), verify: as for wrap_ssl().
+        addr = host if pool else client.resolved(host, port)
+        reqs = connect_requests(addr, port, ssl, server_hostname or host, data, int(timeout_s * 1000), pool,
+                                verify)
+        try:
+            resps = client.batch(reqs, timeout_ms=2 * int(timeout_s * 1000) + 4000)
+        except OSError as e:
+            if not str(e).startswith("unknown_op"):
+                raise
+            s = cls(client)
+            try:
+                s.connect((host, port), ssl=ssl, timeout_s=timeout_s, pool=pool)
+                if ssl:
+                    s.wrap_ssl(server_hostname or host, timeout_s, verify)
+                if data:
+                    s.sendall(data)
+            except Exception:
+                s.close()
+                raise
+            return s
+        err = batch_error(resps, len(reqs))
+        sid = resps[0]["result"]["sid"] if resps and resps[0].get("ok") else None
+        if err is not None:
+            if addr != host and len(resps) == 2 and not resps[1].get("ok"):
+                client.dns.flush(host)  # the cached address may be stale
+            if sid is not None:
+                try:
+                    client.call("sock_close", {"sid": sid}, timeout_ms=2000)
+                except OSError:
+                    pass
+            raise err
+        s = object.__new__(cls)
+        s.c = client
+        s._closed = False
+        s._stream = False
+        s._host = host
+        s._pool = pool
+        s.sid = int(sid)
+        return s
+
     def _check_closed(self):
         if self._closed:
             raise OSError("Socket is closed")
@@ -131,15 +723,29 @@ class ProxySocket:
         else:
             self.c.call("sock_settimeout", {"sid": self.sid, "timeout_ms": int(timeout_s * 1000)}, timeout_ms=2000)
 
-    def connect(self, addr, ssl=False, timeout_s=5):
+    def connect(self, addr, ssl=False, timeout_s=5, pool=False):
+        # pool: take over an idle connection to addr the ESP32 keeps (then
+        # wrap_ssl() has nothing to do), and have close() hand this one
+        # back to it, see Connection Pool in the manual
         self._check_closed()
         if not isinstance(addr, (tuple, list)) or len(addr) != 2:
             raise ValueError("Address must be (host, port) tuple")
-        host, port = addr
-        if ssl:
-            self.c.call("sock_connect", {"sid": self.sid, "host": host, "port": int(port), "ssl": True, "timeout_ms": 0}, timeout_ms=int(timeout_s * 1000) + 2000)
-        else:
-            self.c.call("sock_connect", {"sid": self.sid, "host": host, "port": int(port), "ssl": False, "timeout_ms": int(timeout_s * 1000)}, timeout_ms=int(timeout_s * 1000) + 2000)
+        name, port = addr
+        # A name getaddrinfo() has cached goes out as its address; pooled
+        # connections go by name, one address may serve several
+        host = name if pool else self.c.resolved(name, port)
+        self._host = name
+        self._pool = bool(pool)
+        args = {"sid": self.sid, "host": host, "port": int(port), "ssl": bool(ssl),
+                "timeout_ms": 0 if ssl else int(timeout_s * 1000)}
+        if pool:
+            args["pool"] = True
+        try:
+            self.c.call("sock_connect", args, timeout_ms=int(timeout_s * 1000) + 2000)
+        except OSError:
+            if host != name:
+                self.c.dns.flush(name)  # the cached address may be stale
+            raise
 
     def send(self, data: bytes):
         self._check_closed()
@@ -150,22 +756,60 @@ class ProxySocket:
         r = self.c.call("sock_send", {"sid": self.sid, "data": data}, timeout_ms=8000)
         return int(r["n"])
 
+    def sendall(self, data: bytes, chunk=1024):
+        # Pipelined bulk send: up to client.window chunks are in flight at once
+        self._check_closed()
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data, 'utf-8')
+        mv = memoryview(data)
+        pending = []
+        total = 0
+        for i in range(0, len(mv), chunk):
+            part = bytes(mv[i:i + chunk])
+            pending.append(self.c.submit("sock_send", {"sid": self.sid, "data": part, "all": True}, timeout_ms=8000))
+            # Reap completed sends so the list stays bounded
+            while pending and pending[0].resp is not None:
+                total += int(self.c.wait(pending.pop(0))["n"])
+        for p in pending:
+            total += int(self.c.wait(p)["n"])
+        return total
+
+    def stream(self, credit=8192):
+        # Switch recv() to data the ESP32 pushes (sock_stream_start): no
+        # request per read, throughput limited by the UART only
+        self._check_closed()
+        r = self.c.stream_start(self.sid, credit)
+        self._stream = True
+        return r
+
     def recv(self, n: int, ssl=False, timeout_s=5):
         self._check_closed()
         if n <= 0:
             raise ValueError("Receive size must be positive")
+        if self._stream:
+            return self.c.stream_read(self.sid, int(n), int(timeout_s * 1000))
+        n = min(int(n), self.RECV_MAX, self.c.recv_limit())
         if ssl:
             r = self.c.call("sock_recv", {"sid": self.sid, "n": int(n), "ssl": True, "timeout_ms": 0}, timeout_ms=int(timeout_s * 1000) + 2000)
         else:
             r = self.c.call("sock_recv", {"sid": self.sid, "n": int(n), "ssl": False, "timeout_ms": int(timeout_s * 1000)}, timeout_ms=int(timeout_s * 1000) + 2000)
         return r["data"]
 
-    def close(self):
+    def close(self, pool=None):
+        # pool: keep the connection open on the ESP32 for a later
+        # connect(pool=True), default as given to connect(). Only when the
+        # protocol allows another request on it, e.g. HTTP keep-alive with
+        # the whole response read.
         if self._closed:
             return
         self._closed = True
+        if self._stream:
+            self.c.stream_stop(self.sid, notify=False)  # sock_close ends it
+        if pool is None:
+            pool = self._pool
+        args = {"sid": self.sid, "pool": True} if pool else {"sid": self.sid}
         try:
-            self.c.call("sock_close", {"sid": self.sid}, timeout_ms=2000)
+            self.c.call("sock_close", args, timeout_ms=2000)
         except:
             pass
 
@@ -187,8 +831,12 @@ class ProxySocket:
         # new_sock = type(ProxySocket).__call__(ProxySocket)
         new_sock = object.__new__(ProxySocket)
         # new_sock = ProxySocket(self.c, typ=ProxySocket.SOCK_STREAM) # WRONG!
+        # (open_connection() does the same)
         new_sock.c = self.c
         new_sock._closed = False
+        new_sock._stream = False
+        new_sock._host = None
+        new_sock._pool = False
         new_sock.sid = int(r["sid"])
         return new_sock, r["addr"]
 
@@ -211,14 +859,27 @@ class ProxySocket:
         r = self.c.call("sock_recvfrom", {"sid": self.sid, "n": int(n), "timeout_ms": int(timeout_s * 1000)}, timeout_ms=int(timeout_s * 1000) + 2000)
         return r["data"], r["addr"]
 
-    def wrap_ssl(self, server_hostname=None, timeout_s=5):
+    def wrap_ssl(self, server_hostname=None, timeout_s=5, verify=None, reuse=True):
+        # server_hostname (SNI) defaults to the name given to connect().
+        # verify: check the server certificate against the proxy's
+        # TLS_CAFILE, None for its TLS_VERIFY. reuse: see wrap_args().
         self._check_closed()
-        self.c.call("sock_wrap_ssl", {"sid": self.sid, "server_hostname": server_hostname}, timeout_ms=int(timeout_s * 1000) + 2000)
+        if server_hostname is None and self._host and not is_address(self._host):
+            server_hostname = self._host
+        self.c.call("sock_wrap_ssl", wrap_args(self.sid, server_hostname, verify, reuse),
+                    timeout_ms=int(timeout_s * 1000) + 2000)
 
-def getaddrinfo(client: BridgeClient, host: str, port: int):
+def getaddrinfo(client: BridgeClient, host: str, port: int, family=0, typ=0):
+    # Cached by the client, see BridgeClient.getaddrinfo()
     if not isinstance(host, str) or not host:
         raise ValueError("Invalid host")
     if not isinstance(port, int) or port < 0 or port > 65535:
         raise ValueError("Invalid port")
-    return client.call("dns", {"host": host, "port": int(port)}, timeout_ms=6000)
+    return client.getaddrinfo(host, port, family, typ)
+
+def dns_flush(client: BridgeClient, host: str = None):
+    # Empty the DNS caches of the client and the ESP32, or drop the
+    # entries of host
+    client.dns.flush(host)
+    return client.call("dns_flush", {"host": host}, timeout_ms=2000)
 
@@ -0,0 +1,475 @@
+# pico_client_async.py
+#
+# asyncio front end of pico_client: the same link protocol, but callers
+# await their response instead of spinning in wait(). One reader task polls
+# the UART, retransmits, and wakes the caller waiting on each seq, so other
+# coroutines (sensors, display, more sockets) run in the meantime.
+#
+#   client = AsyncBridgeClient()
+#   await client.negotiate()
+#   reader, writer = await open_connection(client, "example.com", 80)
+#   writer.write(b"GET / HTTP/1.0\r\nHost: example.com\r\n\r\n")
+#   await writer.drain()
+#   print(await reader.read(512))
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from pico_client import (
+    BridgeClient, PendingCall, ProxySocket, _RxStream, batch_error, connect_requests, wrap_args,
+    dns_args, dns_negative, is_address
+)
+
+if hasattr(asyncio, "wait_for_ms"):
+    _wait_for_ms = asyncio.wait_for_ms
+else:  # CPython
+    def _wait_for_ms(aw, ms):
+        return asyncio.wait_for(aw, ms / 1000)
+
+class AsyncBridgeClient(BridgeClient):
+    # Reader task period (ms): after input, doubling up to IDLE_POLL_MS
+    # while none arrives; a new request wakes it
+    POLL_MS = 1
+    IDLE_POLL_MS = 10
+
+    def __init__(self, window=8, uart=None, rxbuf=None, gc_policy=None, uart_wait=None):
+        super().__init__(window, uart, rxbuf, gc_policy, uart_wait)
+        self._events = {}              # seq -> Event of a waiting caller
+        self._space = asyncio.Event()  # set when a window slot frees up
+        self._stream_events = {}       # sid -> Event of a waiting stream_read()
+        self._wake = asyncio.Event()   # set by submit(): poll again soon
+        self._task = None
+
+    def start(self):
+        # Start the reader task; submit() does it on first use
+        if self._task is None:
+            self._task = asyncio.create_task(self._reader())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _reader(self):
+        ms = self.POLL_MS
+        while True:
+            rx = self.flow.rx
+            self.poll()
+            if self.flow.rx != rx:
+                ms = self.POLL_MS
+            if not (self._inflight or self._ack_pending):
+                self.gc.idle()
+            self._wake.clear()
+            try:
+                await _wait_for_ms(self._wake.wait(), ms)
+                ms = self.POLL_MS
+            except asyncio.TimeoutError:
+                ms = min(ms << 1, self.IDLE_POLL_MS)
+
+    def _release(self, p):
+        # Response or timeout: wake the caller
+        super()._release(p)
+        ev = self._events.pop(p.seq, None)
+        if ev is not None:
+            ev.set()
+        self._space.set()
+
+    def _stream_ready(self, sid):
+        ev = self._stream_events.get(sid)
+        if ev is not None:
+            ev.set()
+
+    async def submit(self, op: str, args=None, timeout_ms=8000, resend_ms=None) -> PendingCall:
+        # As BridgeClient.submit(), but waits for a window slot without blocking
+        self.start()
+        while self._window_full():
+            self._space.clear()
+            await self._space.wait()
+        p = BridgeClient.submit(self, op, args, timeout_ms, resend_ms)
+        self._wake.set()
+        return p
+
+    async def wait(self, p: PendingCall):
+        if p.resp is None:
+            ev = self._events.get(p.seq)
+            if ev is None:
+                ev = self._events[p.seq] = asyncio.Event()
+            await ev.wait()
+        return self._result(p)
+
+    async def call(self, op: str, args=None, timeout_ms=8000, resend_ms=None):
+        return await self.wait(await self.submit(op, args, timeout_ms, resend_ms))
+
+    async def batch(self, reqs, stop=True, timeout_ms=8000):
+        # As BridgeClient.batch()
+        return await self.call("batch", self._batch_args(reqs, stop), timeout_ms)
+
+    async def getaddrinfo(self, host, port, family=0, typ=0, timeout_ms=6000):
+        # As BridgeClient.getaddrinfo()
+        key = (host, int(port), int(family), int(typ))
+        r = self.dns.get(key)
+        if r is None:
+            try:
+                r = await self.call("dns", dns_args(key), timeout_ms)
+            except OSError as e:
+                if dns_negative(e):
+                    self.dns.add(key, e)
+                raise
+            self.dns.add(key, r)
+        return r
+
+    async def dns_prewarm(self, names, family=0, typ=0, timeout_ms=8000):
+        # As BridgeClient.dns_prewarm()
+        keys = [(host, int(port), int(family), int(typ)) for host, port in names]
+        ok = 0
+        for i in range(0, len(keys), self.BATCH_MAX):
+            part = keys[i:i + self.BATCH_MAX]
+            try:
+                resps = await self.batch([("dns", dns_args(k)) for k in part], stop=False, timeout_ms=timeout_ms)
+            except OSError as e:
+                if not str(e).startswith("unknown_op"):
+                    raise
+                resps = []
+                for k in part:
+                    try:
+                        resps.append({"ok": True, "result": await self.call("dns", dns_args(k), timeout_ms=6000)})
+                    except OSError as e:
+                        resps.append({"ok": False, "error": str(e).split(":")[0]})
+            ok += self._dns_fill(part, resps)
+        return ok
+
+    async def negotiate(self, caps=("ack", "compact", "flow"), timeout_ms=3000):
+        try:
+            r = await self.call("hello", self._hello_args(caps), timeout_ms=timeout_ms)
+        except OSError:
+            r = None
+        return self._agreed(r)
+
+    async def stream_start(self, sid, credit=8192):
+        sid = int(sid)
+        self._streams[sid] = _RxStream(int(credit))
+        try:
+            return await self.call("sock_stream_start", {"sid": sid, "credit": int(credit)}, timeout_ms=4000)
+        except Exception:
+            self._streams.pop(sid, None)
+            raise
+
+    async def stream_read(self, sid, n, timeout_ms=5000):
+        sid = int(sid)
+        st = self._streams.get(sid)
+        if st is None:
+            raise OSError(f"not_streaming: {sid}")
+        while not st.buf and not st.eof:
+            ev = self._stream_events[sid] = asyncio.Event()
+            try:
+                await asyncio.wait_for(ev.wait(), timeout_ms / 1000)
+            except asyncio.TimeoutError:
+                raise OSError(f"stream_timeout: {sid}")
+            finally:
+                self._stream_events.pop(sid, None)
+        return self._stream_take(sid, st, n)
+
+    async def stream_stop(self, sid, notify=True):
+        sid = int(sid)
+        if self._streams.pop(sid, None) is not None and notify:
+            await self.call("sock_stream_stop", {"sid": sid}, timeout_ms=2000)
+
+class AsyncProxySocket:
+    # ProxySocket with awaitable methods. Create with await AsyncProxySocket.open(client).
+    AF_INET = ProxySocket.AF_INET
+    SOCK_STREAM = ProxySocket.SOCK_STREAM
+    SOCK_DGRAM = ProxySocket.SOCK_DGRAM
+    RECV_MAX = ProxySocket.RECV_MAX
+
+    def __init__(self, client: AsyncBridgeClient, sid):
+        self.c = client
+        self.sid = int(sid)
+        self._closed = False
+        self._stream = False
+        self._host = None  # name given to connect(), for the SNI of wrap_ssl()
+        self._pool = False # connected with pool, close() parks it by default
+
+    @classmethod
+    async def open(cls, client, family=None, typ=None, proto=0):
+        if family is None:
+            family = cls.AF_INET
+        if typ is None:
+            typ = cls.SOCK_STREAM
+        try:
+            r = await client.call("sock_open", {"family": int(family), "type": int(typ), "proto": int(proto)}, timeout_ms=4000)
+        except Exception as e:
+            raise OSError(f"Failed to open socket: {e}")
+        return cls(client, r["sid"])
+
+    @classmethod
+    async def open_connection(cls, client, host, port, ssl=False, timeout_s=30, pool=False, verify=None):
+        # Connected (reader, writer) pair, as asyncio.open_connection().
+        # Reads wait up to timeout_s for data, then raise OSError. Open,
+        # connect and wrap_ssl go in one batch request where the proxy has it.
+        # pool: as for connect(), closing the stream parks the connection.
+        # verify: as for wrap_ssl().
+        s = await cls._connect(client, host, port, ssl, timeout_s, pool, verify)
+        stream = ProxyStream(s, ssl=ssl, timeout_s=timeout_s)
+        return stream, stream
+
+    @classmethod
+    async def _connect(cls, client, host, port, ssl, timeout_s, pool=False, verify=None):
+        addr = host if pool else client.resolved(host, port)
+        reqs = connect_requests(addr, port, ssl, host, timeout_ms=int(timeout_s * 1000), pool=pool, verify=verify)
+        try:
+            resps = await client.batch(reqs, timeout_ms=2 * int(timeout_s * 1000) + 4000)
+        except OSError as e:
+            if not str(e).startswith("unknown_op"):
+                raise
+            s = await cls.open(client)
+            try:
+                await s.connect((host, port), ssl=ssl, timeout_s=timeout_s, pool=pool)
+                if ssl:
+                    await s.wrap_ssl(host, timeout_s, verify)
+            except Exception:
+                await s.close()
+                raise
+            return s
+        err = batch_error(resps, len(reqs))
+        sid = resps[0]["result"]["sid"] if resps and resps[0].get("ok") else None
+        if err is not None:
+            if addr != host and len(resps) == 2 and not resps[1].get("ok"):
+                client.dns.flush(host)  # the cached address may be stale
+            if sid is not None:
+                try:
+                    await client.call("sock_close", {"sid": sid}, timeout_ms=2000)
+                except OSError:
+                    pass
+            raise err
+        s = cls(client, sid)
+        s._host = host
+        s._pool = pool
+        return s
+
+    def _check_closed(self):
+        if self._closed:
+            raise OSError("Socket is closed")
+
+    async def settimeout(self, timeout_s):
+        self._check_closed()
+        t = None if timeout_s is None else int(timeout_s * 1000)
+        await self.c.call("sock_settimeout", {"sid": self.sid, "timeout_ms": t}, timeout_ms=2000)
+
+    async def connect(self, addr, ssl=False, timeout_s=5, pool=False):
+        # As ProxySocket.connect()
+        self._check_closed()
+        if not isinstance(addr, (tuple, list)) or len(addr) != 2:
+            raise ValueError("Address must be (host, port) tuple")
+        name, port = addr
+        host = name if pool else self.c.resolved(name, port)
+        self._host = name
+        self._pool = bool(pool)
+        t = 0 if ssl else int(timeout_s * 1000)
+        args = {"sid": self.sid, "host": host, "port": int(port), "ssl": bool(ssl), "timeout_ms": t}
+        if pool:
+            args["pool"] = True
+        try:
+            await self.c.call("sock_connect", args, timeout_ms=int(timeout_s * 1000) + 2000)
+        except OSError:
+            if host != name:
+                self.c.dns.flush(name)  # the cached address may be stale
+            raise
+
+    async def send(self, data):
+        self._check_closed()
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data, 'utf-8')
+        if not data:
+            return 0
+        r = await self.c.call("sock_send", {"sid": self.sid, "data": data}, timeout_ms=8000)
+        return int(r["n"])
+
+    async def sendall(self, data, chunk=1024):
+        # Pipelined as ProxySocket.sendall(): up to client.window chunks in flight
+        self._check_closed()
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data, 'utf-8')
+        mv = memoryview(data)
+        pending = []
+        total = 0
+        for i in range(0, len(mv), chunk):
+            part = bytes(mv[i:i + chunk])
+            pending.append(await self.c.submit("sock_send", {"sid": self.sid, "data": part, "all": True}, timeout_ms=8000))
+            while pending and pending[0].resp is not None:
+                total += int((await self.c.wait(pending.pop(0)))["n"])
+        for p in pending:
+            total += int((await self.c.wait(p))["n"])
+        return total
+
+    async def stream(self, credit=8192):
+        # As ProxySocket.stream(): recv() reads data the ESP32 pushes
+        self._check_closed()
+        r = await self.c.stream_start(self.sid, credit)
+        self._stream = True
+        return r
+
+    async def recv(self, n, ssl=False, timeout_s=5):
+        self._check_closed()
+        if n <= 0:
+            raise ValueError("Receive size must be positive")
+        if self._stream:
+            return await self.c.stream_read(self.sid, int(n), int(timeout_s * 1000))
+        n = min(int(n), self.RECV_MAX, self.c.recv_limit())
+        t = 0 if ssl else int(timeout_s * 1000)
+        r = await self.c.call("sock_recv", {"sid": self.sid, "n": n, "ssl": bool(ssl), "timeout_ms": t}, timeout_ms=int(timeout_s * 1000) + 2000)
+        return r["data"]
+
+    async def close(self, pool=None):
+        # As ProxySocket.close()
+        if self._closed:
+            return
+        self._closed = True
+        if self._stream:
+            await self.c.stream_stop(self.sid, notify=False)
+        if pool is None:
+            pool = self._pool
+        args = {"sid": self.sid, "pool": True} if pool else {"sid": self.sid}
+        try:
+            await self.c.call("sock_close", args, timeout_ms=2000)
+        except:
+            pass
+
+    async def bind(self, addr, timeout_s=5):
+        self._check_closed()
+        if not isinstance(addr, (tuple, list)) or len(addr) != 2:
+            raise ValueError("Address must be (host, port) tuple")
+        host, port = addr
+        await self.c.call("sock_bind", {"sid": self.sid, "host": host, "port": int(port)}, timeout_ms=int(timeout_s * 1000) + 2000)
+
+    async def listen(self, backlog=5, timeout_s=5):
+        self._check_closed()
+        await self.c.call("sock_listen", {"sid": self.sid, "backlog": int(backlog)}, timeout_ms=int(timeout_s * 1000) + 2000)
+
+    async def accept(self, timeout_s=5):
+        self._check_closed()
+        r = await self.c.call("sock_accept", {"sid": self.sid, "timeout_ms": int(timeout_s * 1000)}, timeout_ms=int(timeout_s * 1000) + 2000)
+        return type(self)(self.c, r["sid"]), r["addr"]
+
+    async def sendto(self, data, addr):
+        self._check_closed()
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data, 'utf-8')
+        if not data:
+            return 0
+        if not isinstance(addr, (tuple, list)) or len(addr) != 2:
+            raise ValueError("Address must be (host, port) tuple")
+        host, port = addr
+        r = await self.c.call("sock_sendto", {"sid": self.sid, "data": data, "host": host, "port": int(port)}, timeout_ms=8000)
+        return int(r["n"])
+
+    async def recvfrom(self, n, timeout_s=5):
+        self._check_closed()
+        if n <= 0:
+            raise ValueError("Receive size must be positive")
+        r = await self.c.call("sock_recvfrom", {"sid": self.sid, "n": int(n), "timeout_ms": int(timeout_s * 1000)}, timeout_ms=int(timeout_s * 1000) + 2000)
+        return r["data"], r["addr"]
+
+    async def wrap_ssl(self, server_hostname=None, timeout_s=5, verify=None, reuse=True):
+        self._check_closed()
+        if server_hostname is None and self._host and not is_address(self._host):
+            server_hostname = self._host
+        await self.c.call("sock_wrap_ssl", wrap_args(self.sid, server_hostname, verify, reuse),
+                          timeout_ms=int(timeout_s * 1000) + 2000)
+
+class ProxyStream:
+    # Both ends of open_connection(), with the methods of asyncio's
+    # StreamReader (read, readexactly, readline) and StreamWriter (write,
+    # drain, close, wait_closed), as MicroPython's asyncio.Stream
+    def __init__(self, sock: AsyncProxySocket, ssl=False, timeout_s=30):
+        self.s = sock
+        self._ssl = ssl
+        self._timeout_s = timeout_s
+        self._rbuf = b""
+        self._wbuf = bytearray()
+        self._eof = False
+        self._closing = None
+
+    def get_extra_info(self, name, default=None):
+        if name == "sid":
+            return self.s.sid
+        return default
+
+    async def _fill(self, n):
+        # More data into the read buffer; False at end of stream
+        if self._eof:
+            return False
+        data = await self.s.recv(n, ssl=self._ssl, timeout_s=self._timeout_s)
+        if not data:
+            self._eof = True
+            return False
+        self._rbuf += data
+        return True
+
+    async def read(self, n=-1):
+        if n < 0:
+            while await self._fill(self.s.RECV_MAX):
+                pass
+            data, self._rbuf = self._rbuf, b""
+            return data
+        if not self._rbuf:
+            await self._fill(n)
+        data, self._rbuf = self._rbuf[:n], self._rbuf[n:]
+        return data
+
+    async def readexactly(self, n):
+        while len(self._rbuf) < n:
+            if not await self._fill(n - len(self._rbuf)):
+                raise EOFError
+        data, self._rbuf = self._rbuf[:n], self._rbuf[n:]
+        return data
+
+    async def readline(self):
+        while True:
+            i = self._rbuf.find(b"\n")
+            if i >= 0:
+                data, self._rbuf = self._rbuf[:i + 1], self._rbuf[i + 1:]
+                return data
+            if not await self._fill(self.s.RECV_MAX):
+                data, self._rbuf = self._rbuf, b""
+                return data
+
+    def write(self, buf):
+        self._wbuf.extend(buf)
+
+    async def drain(self):
+        if self._wbuf:
+            data = bytes(self._wbuf)
+            self._wbuf = bytearray()
+            await self.s.sendall(data)
+
+    async def _close(self):
+        try:
+            await self.drain()
+        finally:
+            await self.s.close()
+
+    def close(self):
+        # Sends what is still buffered, then closes; await wait_closed()
+        if self._closing is None:
+            self._closing = asyncio.create_task(self._close())
+
+    async def wait_closed(self):
+        self.close()
+        await self._closing
+
+async def open_connection(client, host, port, ssl=False, timeout_s=30, pool=False, verify=None):
+    return await AsyncProxySocket.open_connection(client, host, port, ssl, timeout_s, pool, verify)
+
+async def getaddrinfo(client, host, port, family=0, typ=0):
+    if not isinstance(host, str) or not host:
+        raise ValueError("Invalid host")
+    if not isinstance(port, int) or port < 0 or port > 65535:
+        raise ValueError("Invalid port")
+    return await client.getaddrinfo(host, port, family, typ)
+
+async def dns_flush(client, host=None):
+    # Empty the DNS caches of the client and the ESP32, or drop the
+    # entries of host
+    client.dns.flush(host)
+    return await client.call("dns_flush", {"host": host}, timeout_ms=2000)
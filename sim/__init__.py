@@ -0,0 +1,58 @@
+# sim: run the ESP32 proxy and the Pico client under CPython on one host.
+#
+#   import sim
+#   sim.install()                 # fake machine/network/ntptime/tls, ticks
+#   with sim.Loopback(baud=1_400_000, drop=0.01) as lb:
+#       client = lb.client()
+#       print(client.call("ping"))
+#
+# The proxy runs its main loop in a thread and opens real sockets on the
+# host, so connect/send/recv go to local (or remote) servers.
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _install_ticks():
+    # MicroPython time extensions, on a 30-bit wrapping tick counter as on
+    # the ports, so ticks_diff wraparound is exercised too
+    if hasattr(time, "ticks_ms"):
+        return
+    period = 1 << 30
+    half = period >> 1
+
+    def ticks_diff(a, b):
+        d = (a - b) & (period - 1)
+        return d - period if d >= half else d
+
+    time.ticks_ms = lambda: int(time.monotonic() * 1000) & (period - 1)
+    time.ticks_us = lambda: int(time.monotonic() * 1_000_000) & (period - 1)
+    time.ticks_add = lambda a, b: (a + b) & (period - 1)
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1_000_000)
+
+def _install_cbor():
+    # cbor3 ships as .mpy only: use cbor3.py when on the path, else cbor2
+    try:
+        import cbor3  # noqa: F401
+    except ImportError:
+        try:
+            import cbor2
+        except ImportError:
+            raise ImportError("sim needs a CBOR codec: cbor3.py on sys.path or 'pip install cbor2'")
+        sys.modules["cbor3"] = cbor2
+
+def install():
+    # Make the device modules importable. Safe to call more than once.
+    _install_ticks()
+    from sim import machine, network, ntptime, tls
+    for name, mod in (("machine", machine), ("network", network),
+                      ("ntptime", ntptime), ("tls", tls)):
+        sys.modules.setdefault(name, mod)
+    _install_cbor()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+from sim.runner import Loopback  # noqa: E402
@@ -0,0 +1,212 @@
+# sim/machine.py: UART over an in-process link with baud rate pacing,
+# byte loss, byte corruption, whole-write drops and rx buffer overruns,
+# an RX idle interrupt (UART.irq) and machine.idle()
+import random
+import threading
+import time
+
+class _Wire:
+    # One direction of a link. Written bytes arrive at the baud rate: a byte
+    # becomes readable 10 bit times after the previous one finished.
+    def __init__(self, link):
+        self._link = link
+        self._lock = threading.Lock()
+        self._chunks = []  # [t_start, data, pos, end]; data[pos:end] in the rx buffer
+        self._busy_until = 0.0
+        self.tx_bytes = 0
+        self.lost_bytes = 0
+        self.corrupt_bytes = 0
+        self.dropped_writes = 0
+        self.overrun_bytes = 0
+        self.irq = None  # (handler, uart): UART.irq of the receiving end
+
+    def _byte_time(self):
+        baud = self._link.baud
+        return 10.0 / baud if baud else 0.0
+
+    def _damage(self, data):
+        link = self._link
+        if link.drop and random.random() < link.drop:
+            self.dropped_writes += 1
+            return b""
+        if not (link.loss or link.corrupt):
+            return data
+        out = bytearray()
+        for b in data:
+            if link.loss and random.random() < link.loss:
+                self.lost_bytes += 1
+                continue
+            if link.corrupt and random.random() < link.corrupt:
+                b ^= 1 << random.getrandbits(3)
+                self.corrupt_bytes += 1
+            out.append(b)
+        return bytes(out)
+
+    def write(self, buf):
+        data = bytes(buf)
+        n = len(data)
+        self.tx_bytes += n
+        data = self._damage(data)
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._busy_until)
+            # the sender's line is busy for all n bytes, lost or not
+            self._busy_until = start + n * self._byte_time()
+            if data:
+                self._chunks.append([start, data, 0, 0])
+        if data and self.irq is not None:
+            # IRQ_RXIDLE: once the last byte of the write has arrived
+            delay = start + len(data) * self._byte_time() - time.monotonic()
+            if delay > 0:
+                t = threading.Timer(delay, self._fire)
+                t.daemon = True
+                t.start()
+            else:
+                self._fire()
+        return n
+
+    def _fire(self):
+        irq = self.irq
+        if irq is not None:
+            irq[0](irq[1])
+        with _wake:
+            _wake.notify_all()
+
+    def _arrived(self, chunk, now):
+        start, data = chunk[0], chunk[1]
+        bt = self._byte_time()
+        if not bt:
+            return len(data)
+        if now <= start:
+            return 0
+        return min(len(data), int((now - start) / bt))
+
+    def _settle(self, now):
+        # Move the bytes that arrived by now into the rx buffer. With a
+        # bounded buffer (link.rxbuf) what does not fit is lost, as on a
+        # UART without RTS/CTS. Returns the bytes buffered.
+        cap = self._link.rxbuf
+        buffered = 0
+        i = 0
+        while i < len(self._chunks):
+            chunk = self._chunks[i]
+            end = self._arrived(chunk, now)
+            if cap is not None and end > chunk[3]:
+                keep = min(end - chunk[3], max(0, cap - buffered - (chunk[3] - chunk[2])))
+                cut = chunk[3] + keep
+                if cut < end:
+                    # the rest of this chunk still arrives at its own time
+                    self.overrun_bytes += end - cut
+                    rest = [chunk[0] + end * self._byte_time(), chunk[1][end:], 0, 0]
+                    chunk[1] = chunk[1][:cut]
+                    if rest[1]:
+                        self._chunks.insert(i + 1, rest)
+                    end = cut
+            chunk[3] = max(chunk[3], end)
+            buffered += chunk[3] - chunk[2]
+            if chunk[3] < len(chunk[1]):
+                break
+            i += 1
+        return buffered
+
+    def any(self):
+        with self._lock:
+            return self._settle(time.monotonic())
+
+    def read(self, nbytes=None):
+        with self._lock:
+            self._settle(time.monotonic())
+            out = bytearray()
+            while self._chunks and (nbytes is None or len(out) < nbytes):
+                chunk = self._chunks[0]
+                end = chunk[3]
+                if nbytes is not None:
+                    end = min(end, chunk[2] + nbytes - len(out))
+                out += chunk[1][chunk[2]:end]
+                chunk[2] = end
+                if end < len(chunk[1]):
+                    break
+                self._chunks.pop(0)
+            return bytes(out) if out else None
+
+class Link:
+    # Two UART ends: a for the ESP32 proxy, b for the Pico client.
+    # baud=0 delivers instantly. loss and corrupt are per byte, drop is per
+    # write() (the code writes one frame per call). rxbuf bounds the bytes
+    # waiting to be read at each end, None: unbounded. All can be changed live.
+    def __init__(self, baud=1_400_000, loss=0.0, corrupt=0.0, drop=0.0, rxbuf=None):
+        self.baud = baud
+        self.rxbuf = rxbuf
+        self.loss = loss
+        self.corrupt = corrupt
+        self.drop = drop
+        ab = _Wire(self)
+        ba = _Wire(self)
+        self.a = UART(0, _rx=ba, _tx=ab)
+        self.b = UART(0, _rx=ab, _tx=ba)
+
+    def stats(self):
+        out = {}
+        for name, end in (("a", self.a), ("b", self.b)):
+            w = end._tx
+            out[name] = {
+                "tx_bytes": w.tx_bytes, "lost_bytes": w.lost_bytes,
+                "corrupt_bytes": w.corrupt_bytes, "dropped_writes": w.dropped_writes,
+                "overrun_bytes": w.overrun_bytes,
+            }
+        return out
+
+# machine.idle() returns on the next interrupt, or the 1 ms tick
+_wake = threading.Condition()
+
+def idle():
+    with _wake:
+        _wake.wait(0.001)
+
+# UART() without a link (uart_setup() in the config files) pairs up on this
+# one: the first end created is the ESP32 side, every later one the Pico side
+default_link = None
+_ends = 0
+_ends_lock = threading.Lock()
+
+class UART:
+    RTS = 1
+    CTS = 2
+    IRQ_RXIDLE = 4096
+
+    def __init__(self, id=0, baudrate=None, _rx=None, _tx=None, **kwargs):
+        global default_link, _ends
+        if _rx is None:
+            with _ends_lock:
+                if default_link is None:
+                    default_link = Link(baud=baudrate or 115200)
+                end = default_link.a if _ends == 0 else default_link.b
+                _ends += 1
+            _rx, _tx = end._rx, end._tx
+        self._rx = _rx
+        self._tx = _tx
+
+    def any(self):
+        return self._rx.any()
+
+    def read(self, nbytes=None):
+        return self._rx.read(nbytes)
+
+    def write(self, buf):
+        return self._tx.write(buf)
+
+    def irq(self, handler=None, trigger=0, hard=False):
+        self._rx.irq = (handler, self) if handler is not None and trigger else None
+
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, id, mode=-1, *args, **kwargs):
+        self.id = id
+        self._v = 0
+
+    def value(self, v=None):
+        if v is None:
+            return self._v
+        self._v = 1 if v else 0
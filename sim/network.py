@@ -0,0 +1,25 @@
+# sim/network.py: WLAN stub, the host network is always up
+STA_IF = 0
+AP_IF = 1
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self._if = interface
+        self._active = False
+
+    def active(self, on=None):
+        if on is not None:
+            self._active = bool(on)
+        return self._active
+
+    def connect(self, ssid=None, password=None):
+        self._active = True
+
+    def disconnect(self):
+        pass
+
+    def isconnected(self):
+        return self._if == STA_IF
+
+    def ifconfig(self):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
@@ -0,0 +1,67 @@
+# sim/runner.py: the proxy main loop in a thread, clients on the other end
+import threading
+
+class Loopback:
+    def __init__(self, baud=1_400_000, loss=0.0, corrupt=0.0, drop=0.0, nonblocking=None,
+                 async_proxy=False, rxbuf=None, gc_policy=None, uart_wait=None):
+        import sim
+        sim.install()
+        from sim.machine import Link
+        # rxbuf: UART rx buffer of both ends, overrun when full (no RTS/CTS)
+        self.link = Link(baud=baud, loss=loss, corrupt=corrupt, drop=drop, rxbuf=rxbuf)
+        self._stop = threading.Event()
+        self._thread = None
+        self.proxy = None
+        self.nonblocking = nonblocking  # None: esp32_config.NONBLOCKING
+        self.async_proxy = async_proxy  # run esp32_proxy_async instead
+        self.gc_policy = gc_policy      # of the proxy, None: esp32_config.GC_POLICY
+        self.uart_wait = uart_wait      # UartWait mode of esp32_proxy.main(), None: best
+
+    def start(self):
+        # Import the proxy without autostart, then run main() on end a
+        import esp32_config
+        esp32_config.AUTOSTART = False
+        import esp32_proxy
+        self.proxy = esp32_proxy
+        esp32_proxy.caps.clear()
+        self._stop.clear()
+        if self.async_proxy:
+            import esp32_proxy_async
+            target = esp32_proxy_async.run
+            kwargs = {"uart": self.link.a, "stop": self._stop.is_set}
+        else:
+            target = esp32_proxy.main
+            kwargs = {"uart": self.link.a, "stop": self._stop.is_set,
+                      "nonblocking": self.nonblocking, "uart_wait": self.uart_wait}
+        if self.link.rxbuf:
+            kwargs["rxbuf"] = self.link.rxbuf
+        if self.gc_policy is not None:
+            kwargs["gc_policy"] = self.gc_policy
+        self._thread = threading.Thread(target=target, kwargs=kwargs, daemon=True)
+        self._thread.start()
+        return self
+
+    def client(self, **kwargs):
+        from pico_client import BridgeClient
+        if self.link.rxbuf:
+            kwargs.setdefault("rxbuf", self.link.rxbuf)
+        return BridgeClient(uart=self.link.b, **kwargs)
+
+    def async_client(self, **kwargs):
+        # Create it inside the running event loop
+        from pico_client_async import AsyncBridgeClient
+        if self.link.rxbuf:
+            kwargs.setdefault("rxbuf", self.link.rxbuf)
+        return AsyncBridgeClient(uart=self.link.b, **kwargs)
+
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,41 @@
+# sim/tls.py: MicroPython tls module on top of CPython ssl
+import ssl
+
+PROTOCOL_TLS_CLIENT = 0
+PROTOCOL_TLS_SERVER = 1
+CERT_NONE = ssl.CERT_NONE
+CERT_OPTIONAL = ssl.CERT_OPTIONAL
+CERT_REQUIRED = ssl.CERT_REQUIRED
+
+class SSLContext:
+    def __init__(self, protocol=PROTOCOL_TLS_CLIENT):
+        if protocol == PROTOCOL_TLS_SERVER:
+            self._ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        else:
+            self._ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            # MicroPython checks the hostname only when it is given
+            self._ctx.check_hostname = False
+
+    @property
+    def verify_mode(self):
+        return self._ctx.verify_mode
+
+    @verify_mode.setter
+    def verify_mode(self, mode):
+        self._ctx.verify_mode = mode
+
+    def load_verify_locations(self, cafile=None, cadata=None):
+        if isinstance(cadata, (bytes, bytearray)) and cadata.lstrip().startswith(b"-----"):
+            cadata = bytes(cadata).decode()  # PEM: CPython wants str, DER bytes
+        self._ctx.load_verify_locations(cafile=cafile, cadata=cadata)
+
+    def load_cert_chain(self, certfile, keyfile=None):
+        self._ctx.load_cert_chain(certfile, keyfile)
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, server_hostname=None,
+                    session=None):
+        # session= is CPython's (resumption), MicroPython's tls has none yet
+        return self._ctx.wrap_socket(
+            sock, server_side=server_side, server_hostname=server_hostname,
+            do_handshake_on_connect=do_handshake_on_connect, session=session,
+        )
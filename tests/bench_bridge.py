@@ -0,0 +1,167 @@
+# bench_bridge.py
+import gc
+import time
+from bridge import crc16_update, pack_packet, SlipStream, compact_request, expand_request
+
+try:
+    _ticks_us = time.ticks_us
+    _ticks_diff = time.ticks_diff
+except AttributeError:  # CPython
+    def _ticks_us():
+        return int(time.perf_counter() * 1_000_000)
+
+    def _ticks_diff(a, b):
+        return a - b
+
+SIZES = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+def _crc16_bitwise(data, init=0xFFFF):
+    # Pre-table implementation, kept for comparison
+    crc = init
+    for b in data:
+        crc ^= (b << 8)
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc & 0xFFFF
+
+def _payload(n):
+    pattern = bytes(range(256))
+    return (pattern * (n // 256 + 1))[:n]
+
+def _rate(fn, data, min_bytes):
+    reps = max(1, min_bytes // len(data))
+    gc.collect()
+    t0 = _ticks_us()
+    for _ in range(reps):
+        fn(data)
+    dt = max(1, _ticks_diff(_ticks_us(), t0))
+    return reps * len(data) * 1_000_000 // dt
+
+def bench_crc16(sizes=SIZES, min_bytes=16384):
+    print("CRC16-CCITT throughput (bytes/s)")
+    print(f"  {'size':>6} {'bitwise':>10} {'table':>10} {'speedup':>8}")
+    results = []
+    table = lambda d: crc16_update(0xFFFF, d)
+    for n in sizes:
+        data = _payload(n)
+        assert _crc16_bitwise(data) == table(data)
+        old = _rate(_crc16_bitwise, data, min_bytes)
+        new = _rate(table, data, min_bytes)
+        results.append((n, old, new))
+        print(f"  {n:>6} {old:>10} {new:>10} {new / max(1, old):>7.1f}x")
+    return results
+
+class _LegacySlipStream:
+    # Per-byte decoder from before the chunked scan, kept for comparison
+    def __init__(self, max_frame_size=8192):
+        self._buf = bytearray()
+        self._esc = False
+        self._max_frame_size = max_frame_size
+
+    def feed(self, data):
+        frames = []
+        for b in data:
+            if b == 0xC0:
+                if self._buf:
+                    if len(self._buf) <= self._max_frame_size:
+                        frames.append(bytes(self._buf))
+                    self._buf = bytearray()
+                self._esc = False
+                continue
+            if self._esc:
+                if b == 0xDC:
+                    self._buf.append(0xC0)
+                elif b == 0xDD:
+                    self._buf.append(0xDB)
+                else:
+                    self._buf.append(b)
+                self._esc = False
+                continue
+            if b == 0xDB:
+                self._esc = True
+                continue
+            if len(self._buf) < self._max_frame_size:
+                self._buf.append(b)
+        return frames
+
+def _traffic(total, frame_payload=1024):
+    # Mostly-literal CBOR-like payloads with a rare 0xC0/0xDB byte
+    body = bytearray(b"\xa2\x62ok\xf5\x66result\x59\x04\x00")
+    i = 0
+    while len(body) < frame_payload:
+        body.append(0x20 + (i * 7) % 90)
+        i += 1
+    body[frame_payload // 3] = 0xC0
+    body[2 * frame_payload // 3] = 0xDB
+    wire = bytearray()
+    seq = 1
+    while len(wire) < total:
+        wire.extend(pack_packet(2, seq, bytes(body)))
+        seq += 1
+    return bytes(wire)
+
+def bench_slip_decode(total=32768, chunk=256):
+    print(f"SLIP decode, {total} B in {chunk} B reads (ms per MB)")
+    wire = _traffic(total)
+    chunks = [wire[i:i + chunk] for i in range(0, len(wire), chunk)]
+    results = []
+    for name, cls in (("per-byte", _LegacySlipStream), ("chunked", SlipStream)):
+        stream = cls()
+        gc.collect()
+        t0 = _ticks_us()
+        nframes = 0
+        for c in chunks:
+            nframes += len(stream.feed(c))
+        dt = max(1, _ticks_diff(_ticks_us(), t0))
+        ms_per_mb = dt * 1048576 // len(wire) // 1000
+        results.append((name, nframes, ms_per_mb))
+        print(f"  {name:>8}: {nframes} frames, {ms_per_mb} ms/MB")
+    return results
+
+# Typical requests as ProxySocket sends them
+_REQUESTS = (
+    ("sock_recv", {"sid": 3, "n": 1024, "ssl": False, "timeout_ms": 5000}),
+    ("sock_send", {"sid": 3, "data": b"GET / HTTP/1.1\r\n\r\n", "all": True}),
+    ("sock_connect", {"sid": 3, "host": "example.com", "port": 443, "ssl": True, "timeout_ms": 0}),
+    ("ping", {}),
+)
+
+def bench_request_encoding(n=500):
+    # Needs cbor3, as on the devices
+    try:
+        from cbor3 import dumps, loads
+    except ImportError:
+        print("Request encoding: cbor3 not available, skipped")
+        return []
+    print("Request size (B) and decode time (us), dict vs compact form")
+    print(f"  {'op':>12} {'dict':>5} {'compact':>7} {'saved':>6} {'dec us':>7} {'compact':>7}")
+    results = []
+    for op, args in _REQUESTS:
+        full = dumps({"op": op, "args": args})
+        small = dumps(compact_request(op, args))
+        times = []
+        for raw in (full, small):
+            gc.collect()
+            t0 = _ticks_us()
+            for _ in range(n):
+                expand_request(loads(raw))
+            times.append(_ticks_diff(_ticks_us(), t0) / n)
+        saved = 100 - 100 * len(small) // len(full)
+        results.append((op, len(full), len(small), times[0], times[1]))
+        print(f"  {op:>12} {len(full):>5} {len(small):>7} {saved:>5}% {times[0]:>7.1f} {times[1]:>7.1f}")
+    return results
+
+def run_all():
+    print("=" * 50)
+    print("Running Bridge Benchmarks")
+    print("=" * 50)
+    bench_crc16()
+    bench_slip_decode()
+    bench_request_encoding()
+    print("=" * 50)
+
+if __name__ == "__main__":
+    run_all()
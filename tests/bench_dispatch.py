@@ -0,0 +1,103 @@
+# bench_dispatch.py
+#
+# Cost of dispatching a request in esp32_proxy: handle_op() with the OPS
+# table against an if/elif chain over the same op functions, as the old
+# handle_req had. Both run the real handlers with the same error handling,
+# so the difference is the lookup. Runs on the ESP32 (with esp32_proxy.py
+# and its modules on the board) or on CPython with the sim package.
+import gc
+import time
+
+try:
+    _ticks_us = time.ticks_us
+    _ticks_diff = time.ticks_diff
+except AttributeError:  # CPython
+    def _ticks_us():
+        return int(time.perf_counter() * 1_000_000)
+
+    def _ticks_diff(a, b):
+        return a - b
+
+try:
+    import machine  # noqa: F401
+except ImportError:  # CPython: the sim package provides the device modules
+    import os
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import sim
+    sim.install()
+
+import esp32_config
+esp32_config.AUTOSTART = False  # import esp32_proxy without starting it
+import esp32_proxy as P
+from esp32_proxy import OpError, SockTable, handle_op
+
+def _if_chain(socktab, op, args):
+    # Dispatch as the old handle_req did: compare op against each name, in
+    # its order, then call the handler as handle_op() does
+    if op == "hello": fn = P.op_hello
+    elif op == "sock_reset": fn = P.op_sock_reset
+    elif op == "ping": fn = P.op_ping
+    elif op == "get_time": fn = P.op_get_time
+    elif op == "set_time": fn = P.op_set_time
+    elif op == "wifi_status": fn = P.op_wifi_status
+    elif op == "dns": fn = P.op_dns
+    elif op == "sock_open": fn = P.op_sock_open
+    elif op == "sock_settimeout": fn = P.op_sock_settimeout
+    elif op == "sock_connect": fn = P.op_sock_connect
+    elif op == "sock_send": fn = P.op_sock_send
+    elif op == "sock_recv": fn = P.op_sock_recv
+    elif op == "sock_close": fn = P.op_sock_close
+    elif op == "sock_bind": fn = P.op_sock_bind
+    elif op == "sock_listen": fn = P.op_sock_listen
+    elif op == "sock_accept": fn = P.op_sock_accept
+    elif op == "sock_sendto": fn = P.op_sock_sendto
+    elif op == "sock_recvfrom": fn = P.op_sock_recvfrom
+    elif op == "sock_wrap_ssl": fn = P.op_sock_wrap_ssl
+    else:
+        return {"ok": False, "error": "unknown_op", "detail": op}
+    try:
+        return fn(socktab, args)
+    except OpError as e:
+        return e.resp()
+    except KeyError as e:
+        return {"ok": False, "error": "missing_parameter", "detail": repr(e)}
+    except ValueError as e:
+        return {"ok": False, "error": "invalid_parameter", "detail": repr(e)}
+    except Exception as e:
+        return {"ok": False, "error": "exception", "detail": repr(e)}
+
+def _per_call_us(fn, socktab, op, args, n):
+    gc.collect()
+    t0 = _ticks_us()
+    for _ in range(n):
+        fn(socktab, op, args)
+    dt = _ticks_diff(_ticks_us(), t0)
+    return dt / n
+
+def bench_dispatch(ops=("ping", "sock_send", "sock_recv", "sock_wrap_ssl", "no_such_op"), n=5000):
+    # The socket ops get a sid that is not open: the handler runs up to
+    # sock_arg() and answers invalid_sid, without touching the network
+    socktab = SockTable()
+    print(f"Dispatch + handler per request (us), {n} calls")
+    print(f"  {'op':>14} {'if-chain':>9} {'OPS':>9}")
+    results = []
+    for name in ops:
+        args = {"sid": 1, "data": b"x", "max": 1}
+        a, b = _if_chain(socktab, name, args), handle_op(socktab, name, args)
+        assert (a["ok"], a.get("error")) == (b["ok"], b.get("error"))
+        old = _per_call_us(_if_chain, socktab, name, args, n)
+        new = _per_call_us(handle_op, socktab, name, args, n)
+        results.append((name, old, new))
+        print(f"  {name:>14} {old:>9.2f} {new:>9.2f}")
+    return results
+
+def run_all():
+    print("=" * 50)
+    print("Running Dispatch Benchmarks")
+    print("=" * 50)
+    bench_dispatch()
+    print("=" * 50)
+
+if __name__ == "__main__":
+    run_all()
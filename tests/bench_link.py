@@ -0,0 +1,82 @@
+# bench_link.py
+import gc
+import time
+from pico_client import BridgeClient
+
+try:
+    _ticks_us = time.ticks_us
+    _ticks_diff = time.ticks_diff
+except AttributeError:  # CPython
+    def _ticks_us():
+        return int(time.perf_counter() * 1_000_000)
+
+    def _ticks_diff(a, b):
+        return a - b
+
+class _CountingUART:
+    # Wraps the client UART; every write() is one frame on this link
+    def __init__(self, uart):
+        self._uart = uart
+        self.tx_frames = 0
+        self.tx_bytes = 0
+
+    def any(self):
+        return self._uart.any()
+
+    def read(self, n=None):
+        return self._uart.read(n)
+
+    def write(self, buf):
+        self.tx_frames += 1
+        self.tx_bytes += len(buf)
+        return self._uart.write(buf)
+
+def _count_rx(client):
+    counts = [0]
+    handler = client._on_frame
+    def on_frame(raw):
+        counts[0] += 1
+        handler(raw)
+    client._on_frame = on_frame
+    return counts
+
+def bench_acks(client=None, n=200, caps=()):
+    # Frames on the wire per ping and ping rate, with the given extensions
+    if client is None:
+        client = BridgeClient()
+    client.negotiate(caps)
+    uart = _CountingUART(client.uart)
+    client.uart = uart
+    rx = _count_rx(client)
+
+    gc.collect()
+    t0 = _ticks_us()
+    for _ in range(n):
+        client.call("ping", {}, timeout_ms=3000)
+    dt = max(1, _ticks_diff(_ticks_us(), t0))
+    # let delayed ACKs go out so they are counted
+    end = time.time() + 0.2
+    while time.time() < end:
+        client.poll()
+
+    frames = uart.tx_frames + rx[0]
+    ops_s = n * 1_000_000 // dt
+    label = ",".join(sorted(client.caps)) or "v3"
+    print(f"  {label:>11}: {frames / n:.2f} frames/op, {uart.tx_bytes // n} B/op out, {ops_s} ops/s")
+    return {"caps": label, "frames_per_op": frames / n, "tx_bytes_per_op": uart.tx_bytes // n, "ops_per_s": ops_s}
+
+def run_all(client_factory=BridgeClient):
+    print("=" * 50)
+    print("Running Link Benchmarks (ESP32 must be running)")
+    print("=" * 50)
+    print("ping, stop-and-wait")
+    results = [
+        bench_acks(client_factory(), caps=()),
+        bench_acks(client_factory(), caps=("ack",)),
+        bench_acks(client_factory(), caps=("ack", "compact")),
+    ]
+    print("=" * 50)
+    return results
+
+if __name__ == "__main__":
+    run_all()
@@ -0,0 +1,403 @@
+# bench_suite.py
+#
+# End-to-end benchmarks of BridgeClient/ProxySocket -> esp32_proxy, results
+# as JSON. On the Pico (ESP32 running, servers from --serve on a PC):
+#
+#   >>> import bench_suite
+#   >>> bench_suite.run_all(host="192.168.1.10", out="bench.json")
+#
+# On a PC, over the simulated UART of the sim package:
+#
+#   $ python tests/bench_suite.py --sim --baud 1400000 --out bench.json
+#   $ python tests/bench_suite.py --serve      # servers for an on-device run
+#
+# --cert cert.pem --key key.pem adds a TLS echo server and bench_tls().
+import gc
+import sys
+import time
+
+try:
+    import json
+except ImportError:
+    import ujson as json
+
+try:
+    _ticks_us = time.ticks_us
+    _ticks_diff = time.ticks_diff
+except AttributeError:  # CPython without sim
+    def _ticks_us():
+        return int(time.perf_counter() * 1_000_000)
+
+    def _ticks_diff(a, b):
+        return a - b
+
+# Ports of the --serve servers: TCP sink, TCP source, UDP echo, TLS echo
+SINK_PORT = 9000
+SOURCE_PORT = 9001
+UDP_PORT = 9002
+TLS_PORT = 9003
+
+SIZES = (64, 256, 1024, 4096, 16384)
+
+def _percentile(sorted_us, p):
+    if not sorted_us:
+        return 0
+    i = min(len(sorted_us) - 1, (len(sorted_us) * p) // 100)
+    return sorted_us[i]
+
+def _mem_start():
+    # Heap in use now: gc.mem_alloc on MicroPython, tracemalloc on CPython
+    gc.collect()
+    if hasattr(gc, "mem_alloc"):
+        return gc.mem_alloc()
+    import tracemalloc
+    tracemalloc.start()
+    return 0
+
+def _mem_allocated(start):
+    if hasattr(gc, "mem_alloc"):
+        return gc.mem_alloc() - start
+    import tracemalloc
+    total = sum(s.size for s in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+    return total - start
+
+def bench_ping(client, n=200):
+    # Stop-and-wait ops/s and round-trip latency percentiles (us)
+    lat = []
+    t0 = _ticks_us()
+    for _ in range(n):
+        t = _ticks_us()
+        client.call("ping", {}, timeout_ms=3000)
+        lat.append(_ticks_diff(_ticks_us(), t))
+    dt = max(1, _ticks_diff(_ticks_us(), t0))
+    lat.sort()
+    r = {
+        "n": n,
+        "ops_per_s": n * 1_000_000 // dt,
+        "p50_us": _percentile(lat, 50),
+        "p90_us": _percentile(lat, 90),
+        "p99_us": _percentile(lat, 99),
+        "max_us": lat[-1],
+    }
+    print(f"  ping: {r['ops_per_s']} ops/s, p50 {r['p50_us']} us, p99 {r['p99_us']} us")
+    return r
+
+def bench_pipelined_ping(client, n=200):
+    # Same, with up to client.window requests in flight
+    t0 = _ticks_us()
+    pending = []
+    for _ in range(n):
+        pending.append(client.submit("ping", {}, timeout_ms=3000))
+        if len(pending) >= client.window:
+            client.wait(pending.pop(0))
+    for p in pending:
+        client.wait(p)
+    dt = max(1, _ticks_diff(_ticks_us(), t0))
+    r = {"n": n, "window": client.window, "ops_per_s": n * 1_000_000 // dt}
+    print(f"  ping, window {client.window}: {r['ops_per_s']} ops/s")
+    return r
+
+def bench_alloc(client, n=50):
+    # Heap allocated per ping, and GC time to reclaim it
+    start = _mem_start()
+    enabled = gc.isenabled() if hasattr(gc, "isenabled") else True
+    gc.disable()
+    try:
+        for _ in range(n):
+            client.call("ping", {}, timeout_ms=3000)
+        used = _mem_allocated(start)
+    finally:
+        if enabled:
+            gc.enable()
+    t0 = _ticks_us()
+    gc.collect()
+    gc_us = _ticks_diff(_ticks_us(), t0)
+    r = {"n": n, "bytes_per_op": used // n, "gc_us_per_op": gc_us / n}
+    print(f"  alloc: {r['bytes_per_op']} B/op, gc {r['gc_us_per_op']:.1f} us/op")
+    return r
+
+def bench_gc(client, policies=("always", "alloc", "threshold", "idle"), n=200):
+    # Ping rate and GC cost per op with each gcpolicy on the Pico; the ESP32
+    # keeps its own (esp32_config.GC_POLICY), reported as "proxy"
+    import gcpolicy
+    saved = client.gc
+    results = []
+    try:
+        for name in policies:
+            client.gc = gcpolicy.make(name)
+            t0 = _ticks_us()
+            for _ in range(n):
+                client.call("ping", {}, timeout_ms=3000)
+            dt = max(1, _ticks_diff(_ticks_us(), t0))
+            st = client.gc.stats()
+            r = {"policy": name, "ops_per_s": n * 1_000_000 // dt,
+                 "collections_per_op": st["collections_per_op"],
+                 "gc_us_per_op": st["gc_us_per_op"]}
+            results.append(r)
+            print(f"  gc {name:>9}: {r['ops_per_s']} ops/s, "
+                  f"{r['collections_per_op']:.2f} collections/op, {r['gc_us_per_op']} us/op")
+    finally:
+        client.gc = saved
+        if hasattr(gc, "threshold"):
+            gc.threshold(-1)  # undo "threshold"
+    try:
+        proxy = client.call("proxy_stats", {}, timeout_ms=3000).get("gc")
+    except OSError:
+        proxy = None  # older proxy
+    return {"pico": results, "proxy": proxy}
+
+def bench_tcp_send(client, host, port=SINK_PORT, sizes=SIZES, total=65536):
+    # sendall() of size-byte writes to a sink server, MB/s per size
+    from pico_client import ProxySocket
+    results = []
+    for size in sizes:
+        data = bytes(size)
+        reps = max(1, total // size)
+        s = ProxySocket(client)
+        s.connect((host, port))
+        t0 = _ticks_us()
+        for _ in range(reps):
+            s.sendall(data)
+        dt = max(1, _ticks_diff(_ticks_us(), t0))
+        s.close()
+        mbs = reps * size / dt
+        results.append({"size": size, "bytes": reps * size, "mb_per_s": mbs})
+        print(f"  tcp send {size:>5} B: {mbs:.3f} MB/s")
+    return results
+
+def bench_tcp_recv(client, host, port=SOURCE_PORT, sizes=SIZES, total=65536):
+    # recv() of total bytes from a source server, MB/s per read size
+    from pico_client import ProxySocket
+    results = []
+    for size in sizes:
+        s = ProxySocket(client)
+        s.connect((host, port))
+        s.send(str(total).encode() + b"\n")
+        got = 0
+        t0 = _ticks_us()
+        while got < total:
+            part = s.recv(size)
+            if not part:
+                break
+            got += len(part)
+        dt = max(1, _ticks_diff(_ticks_us(), t0))
+        s.close()
+        mbs = got / dt
+        results.append({"size": size, "bytes": got, "mb_per_s": mbs})
+        print(f"  tcp recv {size:>5} B: {mbs:.3f} MB/s")
+    return results
+
+def bench_tcp_recv_stream(client, host, port=SOURCE_PORT, total=65536, credit=8192):
+    # The same download pushed by the ESP32 (ProxySocket.stream()), MB/s
+    from pico_client import ProxySocket
+    s = ProxySocket(client)
+    s.connect((host, port))
+    s.stream(credit)
+    s.send(str(total).encode() + b"\n")
+    got = 0
+    t0 = _ticks_us()
+    while got < total:
+        part = s.recv(4096)
+        if not part:
+            break
+        got += len(part)
+    dt = max(1, _ticks_diff(_ticks_us(), t0))
+    s.close()
+    r = {"credit": credit, "bytes": got, "mb_per_s": got / dt}
+    print(f"  tcp recv streamed, credit {credit}: {r['mb_per_s']:.3f} MB/s")
+    return r
+
+def bench_udp(client, host, port=UDP_PORT, n=200, size=64):
+    # sendto() packets/s, and echoed round trips/s
+    from pico_client import ProxySocket
+    s = ProxySocket(client, ProxySocket.AF_INET, ProxySocket.SOCK_DGRAM)
+    data = bytes(size)
+    t0 = _ticks_us()
+    for _ in range(n):
+        s.sendto(data, (host, port))
+    dt = max(1, _ticks_diff(_ticks_us(), t0))
+    send_pps = n * 1_000_000 // dt
+    s.close()
+
+    s = ProxySocket(client, ProxySocket.AF_INET, ProxySocket.SOCK_DGRAM)
+    echoed = 0
+    t0 = _ticks_us()
+    for _ in range(n):
+        s.sendto(data, (host, port))
+        try:
+            d, _ = s.recvfrom(size, timeout_s=1)
+            echoed += 1
+        except OSError:
+            pass  # lost datagram
+    dt = max(1, _ticks_diff(_ticks_us(), t0))
+    s.close()
+    r = {"n": n, "size": size, "send_pps": send_pps,
+         "echo_pps": echoed * 1_000_000 // dt, "echo_lost": n - echoed}
+    print(f"  udp {size} B: send {send_pps} pkt/s, echo {r['echo_pps']} pkt/s")
+    return r
+
+def bench_tls(client, host, port=TLS_PORT, server_hostname="localhost", n=5):
+    # Connect + TLS handshake + one echo, n times with a new SSLContext per
+    # connection and no session resumption (reuse=False), then with the
+    # ESP32's cached context and sessions. Wall time per connection (ms),
+    # the most the ESP32's heap in use grew over a handshake (TLSCache
+    # heap_max: sampled, MicroPython only, else 0), resumed.
+    from pico_client import ProxySocket
+    results = []
+    for reuse in (False, True):
+        ms = []
+        heap = 0
+        resumed = client.call("proxy_stats", {}, timeout_ms=3000)["tls"]["resumed"]
+        for _ in range(n):
+            t0 = _ticks_us()
+            s = ProxySocket(client)
+            s.connect((host, port), ssl=True)
+            s.wrap_ssl(server_hostname, reuse=reuse)
+            s.sendall(b"x")
+            s.recv(1, ssl=True)
+            s.close()
+            ms.append(_ticks_diff(_ticks_us(), t0) / 1000)
+            st = client.call("proxy_stats", {}, timeout_ms=3000)["tls"]
+            heap = max(heap, st["heap_last"])
+        r = {"reuse": reuse, "n": n, "ms_per_conn": sum(ms) / n, "first_ms": ms[0],
+             "heap_max": heap, "resumed": st["resumed"] - resumed}
+        results.append(r)
+        print(f"  tls reuse={reuse!s:>5}: {r['ms_per_conn']:.1f} ms/conn, "
+              f"heap +{heap} B, {r['resumed']}/{n} resumed")
+    return results
+
+def run_all(client=None, host="127.0.0.1", out=None, caps=("ack", "compact", "flow"), info=None, tls=False):
+    # tls: also bench_tls(), against the TLS echo of serve(certfile=...)
+    from pico_client import BridgeClient
+    if client is None:
+        client = BridgeClient()
+    agreed = client.negotiate(caps)
+
+    print("=" * 50)
+    print("Running Bridge Benchmark Suite (ESP32 must be running)")
+    print("=" * 50)
+    results = {
+        "platform": sys.platform,
+        "implementation": sys.implementation.name,
+        "caps": sorted(agreed),
+        "window": client.window,
+        "ping": bench_ping(client),
+        "ping_pipelined": bench_pipelined_ping(client),
+        "alloc": bench_alloc(client),
+        "gc": bench_gc(client),
+        "tcp_send": bench_tcp_send(client, host),
+        "tcp_recv": bench_tcp_recv(client, host),
+        "tcp_recv_stream": bench_tcp_recv_stream(client, host),
+        "udp": bench_udp(client, host),
+    }
+    if tls:
+        results["tls"] = bench_tls(client, host)
+    results["link"] = client.stats()
+    if info:
+        results.update(info)
+    print("=" * 50)
+
+    text = json.dumps(results)
+    if out:
+        with open(out, "w") as f:
+            f.write(text)
+        print("Results written to", out)
+    else:
+        print(text)
+    return results
+
+def serve(bind="0.0.0.0", base=SINK_PORT, block=True, certfile=None, keyfile=None):
+    # Servers for the benchmarks, on a PC (CPython): TCP sink on base,
+    # TCP source on base+1 (sends the byte count it is asked for), UDP echo
+    # on base+2, and with a certificate a TLS echo on base+3
+    import socket
+    import threading
+
+    def tcp(port, handler):
+        srv = socket.socket()
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind((bind, port))
+        srv.listen(4)
+
+        def loop():
+            while True:
+                conn, _ = srv.accept()
+                threading.Thread(target=handler, args=(conn,), daemon=True).start()
+        threading.Thread(target=loop, daemon=True).start()
+
+    def sink(conn):
+        with conn:
+            while conn.recv(65536):
+                pass
+
+    def source(conn):
+        with conn:
+            line = b""
+            while not line.endswith(b"\n"):
+                d = conn.recv(16)
+                if not d:
+                    return
+                line += d
+            conn.sendall(bytes(int(line)))
+
+    def udp_echo():
+        u = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        u.bind((bind, base + 2))
+        while True:
+            d, addr = u.recvfrom(65536)
+            u.sendto(d, addr)
+
+    def tls_echo(conn):
+        try:
+            with ctx.wrap_socket(conn, server_side=True) as t:
+                while True:
+                    d = t.recv(65536)
+                    if not d:
+                        return
+                    t.sendall(d)
+        except OSError:
+            pass
+
+    tcp(base, sink)
+    tcp(base + 1, source)
+    threading.Thread(target=udp_echo, daemon=True).start()
+    print(f"Serving on {bind}: sink {base}, source {base + 1}, udp echo {base + 2}")
+    if certfile:
+        import ssl
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(certfile, keyfile)
+        tcp(base + 3, tls_echo)
+        print(f"  tls echo {base + 3}")
+    if block:
+        while True:
+            time.sleep(3600)
+
+def _arg(name, default=None):
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+def _main():
+    cert = _arg("--cert")  # with --key: the TLS echo, and bench_tls()
+    if "--serve" in sys.argv:
+        serve(certfile=cert, keyfile=_arg("--key"))
+        return
+    if "--sim" in sys.argv:
+        import os
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import sim
+        baud = int(_arg("--baud", "1400000"))
+        drop = float(_arg("--drop", "0"))
+        policy = _arg("--gc")  # of the proxy
+        serve(bind="127.0.0.1", block=False, certfile=cert, keyfile=_arg("--key"))
+        with sim.Loopback(baud=baud, drop=drop, gc_policy=policy) as lb:
+            run_all(lb.client(), out=_arg("--out"), tls=bool(cert),
+                    info={"sim": {"baud": baud, "drop": drop, "gc": policy}})
+        return
+    run_all(host=_arg("--host", "127.0.0.1"), out=_arg("--out"), tls=bool(cert))
+
+if __name__ == "__main__":
+    _main()
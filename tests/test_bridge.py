@@ -2,8 +2,12 @@
 import gc
 from bridge import (
     slip_encode, SlipStream, pack_packet, unpack_packet,
-    T_REQ, T_RESP, T_ACK, _crc16_ccitt
+    pack_packet_into, frame_size, unpack_packet_view, packet_ack,
+    seq_next, seq_prev, seq_le, compact_request, expand_request, OP_ARGS,
+    T_REQ, T_RESP, T_ACK, T_DATA, T_CREDIT, _crc16_ccitt, crc16_update,
+    DATA_HDR, CREDIT_FMT, CREDIT_SIZE, CREDIT_GAP, off_diff
 )
+import struct
 
 def test_crc16():
     print("Testing CRC16...")
@@ -16,6 +20,36 @@ def test_crc16():
     assert crc == crc2
     print("  CRC16: PASS")
 
+def _crc16_bitwise(data, init=0xFFFF):
+    crc = init
+    for b in data:
+        crc ^= (b << 8)
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+def test_crc16_table():
+    print("Testing CRC16 table engine...")
+    # CRC-16/CCITT-FALSE check value
+    assert _crc16_ccitt(b"123456789") == 0x29B1
+
+    data = bytes(range(256)) * 3 + b"\xC0\xDB tail"
+    assert _crc16_ccitt(data) == _crc16_bitwise(data)
+    assert _crc16_ccitt(b"") == 0xFFFF
+
+    crc = crc16_update(0xFFFF, data, 0, 100)
+    crc = crc16_update(crc, data, 100, 500)
+    crc = crc16_update(crc, data, 500)
+    assert crc == _crc16_ccitt(data)
+
+    mv = memoryview(bytearray(data))
+    assert crc16_update(0xFFFF, mv[10:50]) == _crc16_bitwise(data[10:50])
+    assert crc16_update(0xFFFF, mv, 10, 50) == _crc16_bitwise(data[10:50])
+    print("  CRC16 table: PASS")
+
 def test_slip_encode():
     print("Testing SLIP encoding...")
     
@@ -56,6 +90,86 @@ def test_slip_stream():
     
     print("  SLIP stream: PASS")
 
+def test_slip_stream_chunked():
+    print("Testing SLIP stream chunking...")
+
+    raw1 = b"lit\xC0eral\xDBrun\xDB\xC0"
+    raw2 = b"second frame"
+    wire = slip_encode(raw1) + slip_encode(raw2)
+
+    # every split point, including between ESC and its escaped byte
+    for cut in range(len(wire) + 1):
+        stream = SlipStream()
+        frames = stream.feed(wire[:cut]) + stream.feed(wire[cut:])
+        assert frames == [raw1, raw2]
+
+    stream = SlipStream()
+    frames = []
+    for i in range(len(wire)):
+        frames += stream.feed(wire[i:i + 1])
+    assert frames == [raw1, raw2]
+
+    # oversized frames are dropped, the stream resyncs on the next END
+    stream = SlipStream(max_frame_size=16)
+    frames = stream.feed(slip_encode(b"Y" * 17) + slip_encode(b"Z" * 16))
+    assert frames == [b"Z" * 16]
+
+    print("  SLIP stream chunking: PASS")
+
+def test_slip_stream_views():
+    print("Testing SLIP stream views...")
+
+    raw1 = b"first \xC0 frame"
+    raw2 = b"second frame"
+    wire = slip_encode(raw1) + slip_encode(raw2)
+
+    seen = []
+    views = []
+    def handler(mv):
+        assert isinstance(mv, memoryview)
+        seen.append(bytes(mv))
+        views.append(mv)
+
+    stream = SlipStream()
+    assert stream.feed_views(wire, handler) == 2
+    assert seen == [raw1, raw2]
+
+    # Lifetime: a view is only valid until the handler returns, the next
+    # frame is assembled in the same buffer and overwrites it.
+    assert bytes(views[0]) != raw1
+    assert bytes(views[0][:len(raw2)]) == raw2
+
+    assert stream.feed_views(b"", handler) == 0
+    print("  SLIP stream views: PASS")
+
+def test_unpack_packet_view():
+    print("Testing unpack_packet_view...")
+
+    payload = b"X" * 4096
+    stream = SlipStream()
+    out = []
+    def handler(mv):
+        pkt = unpack_packet_view(mv)
+        assert pkt is not None
+        msg_type, seq, view = pkt
+        assert isinstance(view, memoryview)
+        out.append((msg_type, seq, bytes(view)))
+    stream.feed_views(pack_packet(T_RESP, 3, payload), handler)
+    assert out == [(T_RESP, 3, payload)]
+
+    # The payload view aliases the frame, it is not a copy
+    frame = bytearray(SlipStream().feed(pack_packet(T_REQ, 4, b"abc"))[0])
+    msg_type, seq, view = unpack_packet_view(frame)
+    frame[8] = ord("z")
+    assert bytes(view) == b"zbc"
+
+    frame = bytearray(SlipStream().feed(pack_packet(T_REQ, 4, b"abc"))[0])
+    frame[9] ^= 0xFF
+    assert unpack_packet_view(frame) is None
+    assert unpack_packet_view(frame[:5]) is None
+
+    print("  unpack_packet_view: PASS")
+
 def test_packet_pack_unpack():
     print("Testing packet pack/unpack...")
     
@@ -79,6 +193,29 @@ def test_packet_pack_unpack():
     
     print("  Packet pack/unpack: PASS")
 
+def test_pack_packet_into():
+    print("Testing pack_packet_into...")
+
+    payload = b"\xC0head\xDBmid\xC0\xC0tail\xDB"
+    buf = bytearray(frame_size(len(payload)))
+    n = pack_packet_into(buf, T_RESP, 7, payload)
+    assert bytes(buf[:n]) == pack_packet(T_RESP, 7, payload)
+
+    # memoryview payloads and buffer reuse
+    data = bytearray(b"abc" + payload)
+    n = pack_packet_into(buf, T_RESP, 8, memoryview(data)[3:])
+    assert bytes(buf[:n]) == pack_packet(T_RESP, 8, payload)
+    n = pack_packet_into(buf, T_ACK, 9)
+    assert bytes(buf[:n]) == pack_packet(T_ACK, 9, b"")
+
+    try:
+        pack_packet_into(bytearray(8), T_REQ, 1, b"too long for this")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+    print("  pack_packet_into: PASS")
+
 def test_packet_corruption():
     print("Testing packet corruption detection...")
     
@@ -128,6 +265,84 @@ def test_large_payload():
     
     print("  Large payload: PASS")
 
+def test_packet_ack_field():
+    print("Testing V3X ack field...")
+
+    packed = pack_packet(T_REQ, 10, b"payload", ack=9)
+    raw = SlipStream().feed(packed)[0]
+    assert packet_ack(raw) == 9
+    assert unpack_packet(raw) == (T_REQ, 10, b"payload")
+
+    raw = SlipStream().feed(pack_packet(T_REQ, 10, b"payload"))[0]
+    assert packet_ack(raw) is None
+
+    # the ack field is covered by the CRC
+    raw = bytearray(SlipStream().feed(pack_packet(T_ACK, 5, b"", ack=5))[0])
+    raw[6] ^= 0x01
+    assert unpack_packet(bytes(raw)) is None
+
+    # cumulative acks compare in serial number order, seq 0 is skipped
+    assert seq_next(65535) == 1
+    assert seq_prev(1) == 65535
+    assert seq_le(65530, 3)
+    assert not seq_le(3, 65530)
+    assert seq_le(7, 7)
+
+    print("  V3X ack field: PASS")
+
+def test_stream_frames():
+    print("Testing stream frames...")
+
+    payload = struct.pack(DATA_HDR, 0xFFFFFFF0) + b"data"
+    raw = SlipStream().feed(pack_packet(T_DATA, 7, payload))[0]
+    assert unpack_packet(raw) == (T_DATA, 7, payload)
+    assert packet_ack(raw) is None
+
+    payload = struct.pack(CREDIT_FMT, 4096, 8192, CREDIT_GAP)
+    assert len(payload) == CREDIT_SIZE
+    raw = SlipStream().feed(pack_packet(T_CREDIT, 7, payload))[0]
+    assert struct.unpack(CREDIT_FMT, unpack_packet(raw)[2]) == (4096, 8192, CREDIT_GAP)
+
+    # offsets wrap around at 2**32
+    assert off_diff(4, 0xFFFFFFFC) == 8
+    assert off_diff(0xFFFFFFFC, 4) == -8
+    assert off_diff(100, 100) == 0
+
+    print("  Stream frames: PASS")
+
+def test_compact_request():
+    print("Testing compact requests...")
+
+    args = {"sid": 3, "n": 512, "ssl": False, "timeout_ms": 5000}
+    req = compact_request("sock_recv", args)
+    assert req == [11, 3, 512, False, 5000]
+    assert expand_request(req) == ("sock_recv", args)
+
+    # trailing missing args are dropped, None is the same as missing
+    assert compact_request("sock_send", {"sid": 1, "data": b"x"}) == [10, 1, b"x"]
+    assert compact_request("sock_settimeout", {"sid": 1, "timeout_ms": None}) == [8, 1]
+    assert expand_request([8, 1, None]) == ("sock_settimeout", {"sid": 1})
+    assert compact_request("ping", {}) == [2]
+
+    # a batch carries its sub-requests in either form
+    ops = [[7, 2, 1], {"op": "my_op", "args": {}}]
+    assert compact_request("batch", {"ops": ops, "stop": True}) == [21, ops, True]
+    assert expand_request([21, ops]) == ("batch", {"ops": ops})
+    # args appended to an op: older senders just leave them out
+    assert compact_request("sock_close", {"sid": 3, "pool": True}) == [12, 3, True]
+    assert expand_request([12, 3]) == ("sock_close", {"sid": 3})
+
+    # no compact form: unknown op or arg, the dict form is used instead
+    assert compact_request("my_op", {}) is None
+    assert compact_request("ping", {"extra": 1}) is None
+
+    # the dict form is still understood
+    assert expand_request({"op": "ping", "args": None}) == ("ping", {})
+    assert expand_request([len(OP_ARGS)]) == (None, {})
+    assert expand_request("ping") == (None, {})
+
+    print("  Compact requests: PASS")
+
 def test_sequence_wraparound():
     print("Testing sequence wraparound...")
     
@@ -150,12 +365,20 @@ def run_all_tests():
     
     tests = [
         test_crc16,
+        test_crc16_table,
         test_slip_encode,
         test_slip_stream,
+        test_slip_stream_chunked,
+        test_slip_stream_views,
+        test_unpack_packet_view,
         test_packet_pack_unpack,
+        test_pack_packet_into,
         test_packet_corruption,
         test_empty_payload,
         test_large_payload,
+        test_packet_ack_field,
+        test_stream_frames,
+        test_compact_request,
         test_sequence_wraparound,
     ]
     
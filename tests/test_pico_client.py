@@ -125,6 +125,41 @@ def test_multiple_requests():
         print(f"  Multiple requests: FAIL - {e}")
         return False
 
+def test_pipelined_requests():
+    print("Testing pipelined requests...")
+    try:
+        client = BridgeClient(window=4)
+
+        pending = [client.submit("ping", {}, timeout_ms=3000) for _ in range(8)]
+        for p in pending:
+            result = client.wait(p)
+            assert result["pong"] == True
+
+        print("  Pipelined requests: PASS")
+        return True
+    except Exception as e:
+        print(f"  Pipelined requests: FAIL - {e}")
+        return False
+
+def test_rtt_stats():
+    print("Testing RTT estimation...")
+    try:
+        client = BridgeClient()
+
+        for _ in range(10):
+            client.call("ping", {}, timeout_ms=3000)
+        st = client.stats()
+        assert st["rtt_samples"] > 0
+        assert st["srtt_ms"] is not None
+        assert client.RTO_MIN_MS <= st["rto_ms"] <= client.RTO_MAX_MS
+        print(f"  srtt={st['srtt_ms']}ms rto={st['rto_ms']}ms retransmits={st['retransmits']}")
+
+        print("  RTT estimation: PASS")
+        return True
+    except Exception as e:
+        print(f"  RTT estimation: FAIL - {e}")
+        return False
+
 def test_timeout_handling():
     print("Testing timeout handling...")
     try:
@@ -273,6 +308,8 @@ def run_all_tests():
         ("Socket Open/Close", test_socket_open_close),
         ("HTTP Request", test_http_request),
         ("Multiple Requests", test_multiple_requests),
+        ("Pipelined Requests", test_pipelined_requests),
+        ("RTT Estimation", test_rtt_stats),
         ("Timeout Handling", test_timeout_handling),
         ("Socket Reuse", test_socket_reuse),
         ("Large Transfer", test_large_transfer),
@@ -0,0 +1,905 @@
+# test_sim.py - full stack under CPython: python tests/test_sim.py
+# Needs a CBOR codec (cbor3.py on the path, or pip install cbor2).
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sim
+
+def _echo_server():
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(1)
+
+    def serve():
+        conn, _ = srv.accept()
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+        srv.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return srv.getsockname()[1]
+
+def _source_server(data):
+    # Sends data to the first client, then closes
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(1)
+
+    def serve():
+        conn, _ = srv.accept()
+        with conn:
+            conn.sendall(data)
+        srv.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return srv.getsockname()[1]
+
+def _transfer(lb, size, caps):
+    from pico_client import ProxySocket
+    client = lb.client()
+    client.negotiate(caps)
+    port = _echo_server()
+    s = ProxySocket(client)
+    s.connect(("127.0.0.1", port))
+    data = bytes((i * 7) & 0xFF for i in range(size))
+    s.sendall(data)
+    got = bytearray()
+    while len(got) < size:
+        part = s.recv(4096)
+        if not part:
+            break
+        got.extend(part)
+    s.close()
+    return bytes(got) == data, client.stats()
+
+def test_ping():
+    print("Testing ping over the simulated link...")
+    with sim.Loopback(baud=0) as lb:
+        client = lb.client()
+        assert client.call("ping")["pong"] == True
+    print("  Ping: PASS")
+
+def test_echo_clean():
+    print("Testing TCP echo, clean link...")
+    with sim.Loopback() as lb:
+        for caps in ((), ("ack", "compact")):
+            ok, st = _transfer(lb, 20000, caps)
+            assert ok, caps
+    print("  TCP echo, clean link: PASS")
+
+def test_echo_lossy():
+    print("Testing TCP echo, 5% frame drops and corrupted bytes...")
+    with sim.Loopback(drop=0.05, corrupt=0.0001) as lb:
+        ok, st = _transfer(lb, 20000, ("ack", "compact"))
+        assert ok
+        assert st["retransmits"] > 0
+    print(f"  retransmits={st['retransmits']}")
+    print("  TCP echo, lossy link: PASS")
+
+def test_large_window():
+    print("Testing a large window on a lossy link...")
+    sim.install()
+    import esp32_config
+    esp32_config.AUTOSTART = False
+    from cbor3 import dumps
+    from pico_client import ProxySocket
+    from esp32_proxy import Reorder
+    # A request too far ahead during a gap is dropped, a hello resyncs
+    done, resets = [], []
+    r = Reorder(lambda seq, payload, crc: done.append(seq), lambda: resets.append(1), window=4)
+    hello = dumps({"op": "hello", "args": {}})
+    ping = dumps({"op": "ping", "args": {}})
+    for seq in (1, 3, 9):
+        r.on_request(seq, ping, 0)
+    assert done == [1] and sorted(r.held) == [3] and r.dropped == 1
+    r.on_request(100, hello, 0)
+    assert done == [1, 100] and not r.held and not resets
+    r.on_request(200, ping, 0)  # no gap open: a client without hello
+    assert done == [1, 100, 200] and resets == [1] and r.sessions == 2
+
+    for kw in ({}, {"nonblocking": True}, {"async_proxy": True}):
+        with sim.Loopback(drop=0.05, **kw) as lb:
+            client = lb.client(window=32)
+            assert client.window == client.WINDOW_MAX
+            agreed = client.negotiate()
+            assert client.window == 15
+            port = _echo_server()
+            s = ProxySocket(client)
+            s.connect(("127.0.0.1", port))
+            data = bytes((i * 7) & 0xFF for i in range(60000))
+            s.sendall(data, 128)
+            got = bytearray()
+            while len(got) < len(data):
+                part = s.recv(4096)
+                if not part:
+                    break
+                got.extend(part)
+            s.close()
+            assert bytes(got) == data, kw
+            assert lb.proxy.caps == agreed, lb.proxy.caps
+        print(f"  {kw or 'blocking'}: retransmits={client.stats()['retransmits']}")
+    print("  Large window: PASS")
+
+def test_late_retransmit():
+    print("Testing a late retransmit after a skipped gap...")
+    sim.install()
+    import esp32_config
+    esp32_config.AUTOSTART = False
+    from cbor3 import dumps
+    from esp32_proxy import Reorder
+    done, resets, resps = [], [], []
+    r = Reorder(lambda seq, payload, crc: done.append(seq), lambda: resets.append(1),
+                lambda seq, resp: resps.append((seq, resp["error"])), window=4)
+    ping = dumps({"op": "ping", "args": {}})
+    for seq in (10, 12, 13):  # 11 lost
+        r.on_request(seq, ping, 0)
+    assert done == [10] and r.overdue() is False
+    r.skip_gap()
+    assert done == [10, 12, 13] and r.skipped == [11]
+    r.on_request(11, ping, 0)  # the Pico's retransmit, after the skip
+    r.on_request(11, ping, 0)
+    r.on_request(12, ping, 0)  # a retransmit of one that ran
+    assert done == [10, 12, 13] and resps == [(11, "seq_skipped")], resps
+    assert not resets and r.sessions == 0 and r.stale == 3
+    r.on_request(14, ping, 0)  # not held: expected did not move back
+    assert done == [10, 12, 13, 14] and not r.held
+    r.on_request(1000, ping, 0)  # far off both ways, no gap: a new session
+    assert resets == [1] and r.sessions == 1 and not r.skipped
+    print("  Late retransmit: PASS")
+
+def _free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def _no_head_of_line(lb):
+    from pico_client import ProxySocket, ref
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(4)
+    client = lb.client()
+    client.negotiate()
+    # recvs that wait 1.5 s for peers that never send
+    socks = []
+    pending = []
+    for _ in range(2):
+        a = ProxySocket(client)
+        a.connect(("127.0.0.1", silent.getsockname()[1]))
+        socks.append(a)
+        pending.append(client.submit("sock_recv", {"sid": a.sid, "n": 16, "ssl": False, "timeout_ms": 1500}, timeout_ms=5000))
+    t0 = time.time()
+    assert client.call("ping")["pong"] == True
+    assert time.time() - t0 < 0.5
+    assert not pending[0].done()
+    for p in pending:
+        try:
+            client.wait(p)
+            assert False, "recv should time out"
+        except OSError:
+            pass
+    assert time.time() - t0 < 2.5  # in parallel, not one after the other
+
+    # A batch waiting for a TLS handshake (open_connection) holds up nothing
+    sid = ref(0, "sid")
+    b = client.submit("batch", client._batch_args([
+        ("sock_open", {"family": ProxySocket.AF_INET, "type": ProxySocket.SOCK_STREAM, "proto": 0}),
+        ("sock_settimeout", {"sid": sid, "timeout_ms": 1000}),
+        ("sock_connect", {"sid": sid, "host": "127.0.0.1", "port": silent.getsockname()[1], "ssl": True}),
+        ("sock_wrap_ssl", {"sid": sid, "server_hostname": "localhost"}),
+    ], True), timeout_ms=5000)
+    t0 = time.time()
+    assert client.call("ping")["pong"] == True
+    assert time.time() - t0 < 0.5 and not b.done()
+    r = client.wait(b)
+    assert [x["ok"] for x in r] == [True, True, True, False], r
+    client.call("sock_close", {"sid": r[0]["result"]["sid"]})
+
+    # accept() through the proxy, parked until the peer connects
+    port = _free_port()
+    srv = ProxySocket(client)
+    srv.bind(("127.0.0.1", port))
+    srv.listen(1)
+    acc = client.submit("sock_accept", {"sid": srv.sid, "timeout_ms": 3000})
+    peer = socket.create_connection(("127.0.0.1", port))
+    r = client.wait(acc)
+    assert r["sid"] != srv.sid
+    peer.close()
+    srv.close()
+    silent.close()
+
+def test_nonblocking():
+    print("Testing non-blocking proxy: no head-of-line blocking...")
+    with sim.Loopback(nonblocking=True) as lb:
+        _no_head_of_line(lb)
+    print("  Non-blocking proxy: PASS")
+
+def test_async_proxy():
+    print("Testing asyncio proxy...")
+    with sim.Loopback(async_proxy=True) as lb:
+        for caps in ((), ("ack", "compact")):
+            ok, st = _transfer(lb, 20000, caps)
+            assert ok, caps
+        _no_head_of_line(lb)
+
+    # Retransmits of a request whose response is still queued add no copies
+    import esp32_proxy_async
+    from bridge import T_REQ, frame_size, pack_packet_into
+
+    class _Uart:
+        def any(self):
+            return 0
+
+        def write(self, b):
+            return len(b)
+
+    proxy = esp32_proxy_async.AsyncProxy(_Uart())
+    proxy._resp_cache.put(7, b"response")
+    buf = bytearray(frame_size(16))
+    req = bytes(buf[:pack_packet_into(buf, T_REQ, 7, b"\xa0")])
+    for _ in range(3):
+        proxy._slip.feed_views(req, proxy._on_frame)
+    assert proxy._out._items == [b"response"], proxy._out._items
+
+    # Every task busy: frames are still read, the ping is ACKed at once and
+    # runs once the recv gives up
+    from pico_client import ProxySocket
+    saved = esp32_proxy_async.MAX_TASKS
+    esp32_proxy_async.MAX_TASKS = 1
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(1)
+    try:
+        with sim.Loopback(async_proxy=True) as lb:
+            client = lb.client()
+            client.negotiate()
+            a = ProxySocket(client)
+            a.connect(("127.0.0.1", silent.getsockname()[1]))
+            p = client.submit("sock_recv", {"sid": a.sid, "n": 16, "ssl": False, "timeout_ms": 1000}, timeout_ms=5000)
+            ping = client.submit("ping", {})
+            t0 = time.time()
+            while not ping.acked and time.time() - t0 < 0.5:
+                client.poll()
+            assert ping.acked and not p.done()
+            assert client.wait(ping)["pong"] == True
+            assert p.done()
+    finally:
+        esp32_proxy_async.MAX_TASKS = saved
+        silent.close()
+    print("  asyncio proxy: PASS")
+
+def test_async_client():
+    print("Testing asyncio client: concurrent calls and streams...")
+    import asyncio
+    from pico_client_async import open_connection
+
+    async def main(lb):
+        client = lb.async_client()
+        await client.negotiate()
+        # concurrent calls share the window
+        r = await asyncio.gather(*[client.call("ping") for _ in range(20)])
+        assert all(x["pong"] for x in r)
+        port = _echo_server()
+        reader, writer = await open_connection(client, "127.0.0.1", port)
+        data = bytes((i * 7) & 0xFF for i in range(10000))
+        writer.write(b"hello\n")
+        writer.write(data)
+        await writer.drain()
+        # a coroutine keeps running while the stream waits for data
+        ticks = [0]
+
+        async def ticker():
+            while True:
+                ticks[0] += 1
+                await asyncio.sleep(0.005)
+        t = asyncio.create_task(ticker())
+        assert await reader.readline() == b"hello\n"
+        assert await reader.readexactly(len(data)) == data
+        t.cancel()
+        assert ticks[0] > 0
+        writer.close()
+        await writer.wait_closed()
+        client.close()
+
+    with sim.Loopback(nonblocking=True) as lb:
+        asyncio.run(main(lb))
+    print("  asyncio client: PASS")
+
+def _download(lb, size):
+    # Streamed recv() of size bytes; True when intact, and the requests used
+    from pico_client import ProxySocket
+    client = lb.client()
+    client.negotiate()
+    data = bytes((i * 13) & 0xFF for i in range(size))
+    s = ProxySocket(client)
+    s.connect(("127.0.0.1", _source_server(data)))
+    s.stream(credit=8192)
+    calls = client.stats()["calls"]
+    got = bytearray()
+    while True:
+        part = s.recv(4096)
+        if not part:
+            break
+        got.extend(part)
+    calls = client.stats()["calls"] - calls
+    s.close()
+    return bytes(got) == data, calls
+
+def test_stream():
+    print("Testing server-push streams, clean and lossy link...")
+    for kwargs in ({}, {"drop": 0.05}, {"nonblocking": True, "drop": 0.05}, {"async_proxy": True}):
+        with sim.Loopback(**kwargs) as lb:
+            ok, calls = _download(lb, 60000)
+            assert ok, kwargs
+            assert calls == 0, calls  # no request per chunk
+
+    import asyncio
+    from pico_client_async import AsyncProxySocket
+
+    async def main(lb):
+        client = lb.async_client()
+        await client.negotiate()
+        data = bytes((i * 13) & 0xFF for i in range(30000))
+        s = await AsyncProxySocket.open(client)
+        await s.connect(("127.0.0.1", _source_server(data)))
+        await s.stream()
+        got = bytearray()
+        while True:
+            part = await s.recv(4096)
+            if not part:
+                break
+            got.extend(part)
+        await s.close()
+        client.close()
+        assert bytes(got) == data
+
+    with sim.Loopback(drop=0.05) as lb:
+        asyncio.run(main(lb))
+    print("  Server-push streams: PASS")
+
+def _stress(caps):
+    # Both directions at full speed into 4 KB UART rx buffers (no RTS/CTS)
+    # while each side is busy at times. Returns the bytes lost to overruns.
+    from pico_client import ProxySocket
+    with sim.Loopback(rxbuf=4096) as lb:
+        client = lb.client()
+        client.negotiate(caps)
+        silent = socket.socket()
+        silent.bind(("127.0.0.1", 0))
+        silent.listen(1)
+        a = ProxySocket(client)
+        a.connect(silent.getsockname())
+        s = ProxySocket(client)
+        s.connect(("127.0.0.1", _echo_server()))
+        data = bytes((i * 7) & 0xFF for i in range(40000))
+
+        # Pico -> ESP32: pipelined sends while the ESP32 waits in a recv
+        p = client.submit("sock_recv", {"sid": a.sid, "n": 16, "ssl": False, "timeout_ms": 300}, timeout_ms=5000)
+        s.sendall(data)
+        try:
+            client.wait(p)
+        except OSError:
+            pass  # timed out, as meant
+        got = bytearray()
+        while len(got) < len(data):
+            got.extend(s.recv(4096))
+        assert bytes(got) == data
+
+        # ESP32 -> Pico: a stream with more credit than the rx buffer,
+        # read by a Pico that is busy between reads
+        d = ProxySocket(client)
+        d.connect(("127.0.0.1", _source_server(data)))
+        d.stream(credit=8192)
+        got = bytearray()
+        while True:
+            time.sleep(0.01)
+            part = d.recv(1024)
+            if not part:
+                break
+            got.extend(part)
+        assert bytes(got) == data
+        silent.close()
+        st = lb.link.stats()
+        return st["a"]["overrun_bytes"] + st["b"]["overrun_bytes"]
+
+def test_flow_control():
+    print("Testing link flow control, 4 KB rx buffers without RTS/CTS...")
+    lost = _stress(("ack", "compact"))
+    print(f"  without flow control: {lost} bytes overrun")
+    assert lost > 0
+    lost = _stress(("ack", "compact", "flow"))
+    print(f"  with flow control: {lost} bytes overrun")
+    assert lost == 0
+    print("  Link flow control: PASS")
+
+def test_resp_cache():
+    print("Testing the response replay cache...")
+    with sim.Loopback(drop=0.05) as lb:
+        from esp32_proxy import RespCache
+        c = RespCache(max_entries=4, max_bytes=100)
+        for seq in (1, 2, 3, 4, 5):
+            c.put(seq, bytes(10))
+        assert len(c) == 4 and c.get(1) is None and c.evictions == 1
+        c.put(6, bytes(90))  # over the byte budget: the oldest go
+        assert len(c) == 2 and c.bytes == 100 and c.evictions == 4
+        c.ack(5)
+        assert c.get(5) is None and c.get(6) is not None and c.hits == 1
+        c.put(7, bytes(200))  # larger than the budget, kept on its own
+        assert len(c) == 1 and c.get(7) is not None
+        c.pop(7)
+        assert len(c) == 0 and c.bytes == 0
+
+        ok, st = _transfer(lb, 20000, ("ack", "compact"))
+        assert ok
+        rc = lb.client().call("proxy_stats")["resp_cache"]
+        print(f"  {rc}")
+        assert rc["hits"] > 0
+        assert rc["bytes"] <= 32768
+    print("  Response replay cache: PASS")
+
+def test_gc_policy():
+    print("Testing gc policies...")
+    sim.install()
+    import gcpolicy
+    p = gcpolicy.make("always")
+    p.step()
+    p.step()
+    assert p.collections == 2
+    p = gcpolicy.make("alloc", nbytes=1600)  # every 16 steps without mem_alloc
+    for _ in range(32):
+        p.step()
+    assert p.collections == 2
+    p = gcpolicy.make("idle", idle_ms=5)
+    p.step()
+    p.idle()
+    assert p.collections == 0  # not idle long enough
+    time.sleep(0.01)
+    p.idle()
+    p.idle()
+    assert p.collections == 1  # nothing allocated since
+    try:
+        gcpolicy.make("never")
+        assert False, "unknown policy accepted"
+    except ValueError:
+        pass
+
+    with sim.Loopback(gc_policy="idle") as lb:
+        client = lb.client(gc_policy="idle")
+        for _ in range(100):
+            client.call("ping")
+        st = client.stats()["gc"]
+        esp = client.call("proxy_stats")["gc"]
+        print(f"  pico: {st}")
+        print(f"  esp32: {esp}")
+        assert st["policy"] == "idle" and st["ops"] == 100
+        assert st["collections"] < 100
+        assert esp["ops"] >= 100 and esp["collections"] < 100
+    print("  gc policies: PASS")
+
+def _ping_p50_ms(mode):
+    with sim.Loopback(baud=0, uart_wait=mode) as lb:
+        client = lb.client(uart_wait=mode)
+        assert client.uart_wait.mode == mode
+        lat = []
+        for _ in range(200):
+            t = time.perf_counter()
+            client.call("ping")
+            lat.append(time.perf_counter() - t)
+        lat.sort()
+        return lat[len(lat) // 2] * 1000
+
+def test_uart_wait():
+    print("Testing UART wakeup: irq vs 1 ms sleeps...")
+    sim.install()
+    from sim.machine import Link
+    from bridge import UartWait
+    link = Link(baud=115200)
+    w = UartWait(link.a)
+    assert w.mode == "irq"
+    assert UartWait(link.b, "poll").mode == "sleep"  # no select.poll on the sim UART
+    t = time.perf_counter()
+    assert not w.wait(30)
+    assert time.perf_counter() - t >= 0.025
+    link.b.write(b"x" * 10)  # ~0.9 ms on the wire
+    t = time.perf_counter()
+    assert w.wait(1000)
+    dt = (time.perf_counter() - t) * 1000
+    assert link.a.read() == b"x" * 10
+    print(f"  woken {dt:.2f} ms after the write")
+    assert dt < 50
+
+    sleep_ms = _ping_p50_ms("sleep")
+    irq_ms = _ping_p50_ms("irq")
+    print(f"  ping p50: sleep {sleep_ms:.3f} ms, irq {irq_ms:.3f} ms")
+    assert irq_ms < sleep_ms
+    print("  UART wakeup: PASS")
+
+def test_batch():
+    print("Testing batch requests and open_connection()...")
+    sim.install()
+    from pico_client import ProxySocket, ref
+    for kw in ({}, {"nonblocking": True}, {"async_proxy": True}):
+        with sim.Loopback(**kw) as lb:
+            client = lb.client()
+            client.negotiate()
+            calls = client.stats()["calls"]
+            s = ProxySocket.open_connection(client, "127.0.0.1", _echo_server(), ssl=False, data=b"hello")
+            assert client.stats()["calls"] == calls + 1  # one round trip
+            assert s.recv(5) == b"hello"
+            s.close()
+
+            rs = client.batch([("ping", {}), ("sock_close", {"sid": ref(3, "sid")}), ("ping", {})])
+            assert len(rs) == 2 and rs[0]["ok"] and rs[1]["error"] == "invalid_ref"
+            rs = client.batch([("sock_send", {"sid": 999, "data": b"x"}), ("hello", {}), ("ping", {})], stop=False)
+            assert [r["ok"] for r in rs] == [False, False, True]
+            assert rs[1]["error"] == "not_batchable"
+            try:
+                ProxySocket.open_connection(client, "127.0.0.1", _free_port(), ssl=False)
+                assert False, "connected to a closed port"
+            except OSError as e:
+                assert "sock_connect_error" in str(e)
+            assert client.call("ping")["pong"]
+        print(f"  {kw or 'blocking'}: PASS")
+    print("  Batch requests: PASS")
+
+def test_dns_cache():
+    print("Testing the DNS cache...")
+    sim.install()
+    from bridge import DnsCache
+    calls = []
+
+    def resolve(host, port, *rest):
+        calls.append(host)
+        if host == "bad":
+            raise OSError(-202)
+        return [[2, 1, 0, "", (host, port)]]
+
+    c = DnsCache(max_entries=2, ttl_ms=50, neg_ttl_ms=50)
+    assert c.lookup(("a", 80), resolve) == c.lookup(("a", 80), resolve)
+    for _ in range(2):
+        try:
+            c.lookup(("bad", 80), resolve)
+            assert False, "resolved bad"
+        except OSError as e:
+            assert e.args == (-202,)
+    assert calls == ["a", "bad"] and c.hits == 2 and c.neg_hits == 1
+    assert isinstance(c.peek(("bad", 80)), OSError) and c.peek(("x", 80)) is None
+    assert c.hits == 2 and c.misses == 2  # peek() counts nothing
+    c.lookup(("a", 80), resolve)
+    c.lookup(("b", 80), resolve)  # full: "bad" was used least recently
+    assert ("bad", 80) not in c._m and c.evictions == 1
+    time.sleep(0.06)
+    c.lookup(("a", 80), resolve)  # expired
+    assert calls == ["a", "bad", "b", "a"]
+    assert c.flush("a") == 1 and c.flush() == 1 and len(c) == 0
+
+    from pico_client import ProxySocket, dns_flush, getaddrinfo
+    with sim.Loopback() as lb:
+        client = lb.client()
+        client.negotiate()
+        dns_flush(client)
+        calls = client.stats()["calls"]
+        addr = getaddrinfo(client, "localhost", 80)
+        assert getaddrinfo(client, "localhost", 80) == addr
+        assert client.stats()["calls"] == calls + 1  # the second one from the Pico's cache
+        assert dns_flush(client, "localhost") == {"flushed": 1}
+        getaddrinfo(client, "localhost", 80)
+        s = client.call("proxy_stats")["dns"]
+        print(f"  esp32 {s}")
+        assert s["hits"] == 0 and s["misses"] == 2
+
+        # Pre-warmed in one round trip, failures included
+        calls = client.stats()["calls"]
+        port = _echo_server()
+        names = [("localhost", port), ("127.0.0.1", 81), ("nonexistent.invalid", 80)]
+        assert client.dns_prewarm(names) == 2
+        assert client.stats()["calls"] == calls + 1
+        try:
+            getaddrinfo(client, "nonexistent.invalid", 80)
+            assert False, "resolved nonexistent.invalid"
+        except OSError as e:
+            assert str(e).startswith("dns_error")
+        assert client.stats()["calls"] == calls + 1
+
+        # With WiFi down a failed lookup is not cached on either side
+        misses = client.call("proxy_stats")["dns"]["misses"]
+        lb.proxy.sta.isconnected = lambda: False
+        for _ in range(2):
+            try:
+                getaddrinfo(client, "offline.invalid", 80)
+                assert False, "resolved offline.invalid"
+            except OSError as e:
+                assert str(e).startswith("dns_unavailable")
+        del lb.proxy.sta.isconnected
+        assert client.call("proxy_stats")["dns"]["misses"] == misses + 2
+
+        # connect() sends the cached address, and keeps the name for SNI;
+        # it looks in the cache without counting hits or misses
+        before = client.stats()["dns"]
+        assert client.resolved("localhost", port) == "127.0.0.1"
+        for p in (port, _echo_server()):  # cached, and not
+            s = ProxySocket(client)
+            s.connect(("localhost", p))
+            assert s._host == "localhost"
+            s.sendall(b"ping")
+            assert s.recv(4) == b"ping"
+            s.close()
+        st = client.stats()["dns"]
+        print(f"  pico {st}")
+        assert st == before and st["hits"] == 2 and st["neg_hits"] == 1
+    print("  DNS cache: PASS")
+
+def _keepalive_server():
+    # Echoes on every connection until the client sends b"bye"; returns
+    # the port and the list of accepted connections
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(4)
+    accepted = []
+
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data or data == b"bye":
+                    break
+                conn.sendall(data)
+
+    def serve():
+        while True:
+            conn, _ = srv.accept()
+            accepted.append(conn)
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return srv.getsockname()[1], accepted
+
+def test_conn_pool():
+    print("Testing the ESP32's connection pool...")
+    sim.install()
+    from esp32_proxy import ConnPool
+    pool = ConnPool(max_entries=2, idle_ms=50)
+    pairs = [socket.socketpair() for _ in range(3)]
+    for i, (a, b) in enumerate(pairs):
+        pool.park(("h", i, False), a)
+    assert len(pool) == 2 and pool.evictions == 1 and pool.take(("h", 0, False)) is None
+    pairs[1][1].sendall(b"x")  # unasked data: not reusable
+    assert pool.take(("h", 1, False)) is None and pool.dead == 1
+    time.sleep(0.06)
+    pool.expire()
+    assert len(pool) == 0 and pool.expired == 1
+
+    from pico_client import ProxySocket
+    for kw in ({}, {"nonblocking": True}, {"async_proxy": True}):
+        with sim.Loopback(**kw) as lb:
+            client = lb.client()
+            client.negotiate()
+            port, accepted = _keepalive_server()
+            for i in range(3):
+                s = ProxySocket(client)
+                s.connect(("127.0.0.1", port), pool=True)
+                s.sendall(b"hello %d" % i)
+                assert s.recv(7) == b"hello %d" % i
+                s.close()  # parked, connected with pool
+            assert len(accepted) == 1
+
+            # The server closed the parked one: a new connection
+            s = ProxySocket.open_connection(client, "127.0.0.1", port, ssl=False, data=b"bye", pool=True)
+            s.close()
+            time.sleep(0.05)
+            s = ProxySocket.open_connection(client, "127.0.0.1", port, ssl=False, data=b"ping", pool=True)
+            assert s.recv(4) == b"ping"
+            s.close(pool=False)
+            assert len(accepted) == 2
+            st = client.call("proxy_stats")["pool"]
+            assert st["hits"] == 3 and st["misses"] == 2 and st["dead"] == 1 and st["parked"] == 0
+        print(f"  {kw or 'blocking'}: {st}")
+    print("  Connection pool: PASS")
+
+def _tls_cert(tmp):
+    # Self-signed certificate for localhost in tmp: (certfile, keyfile),
+    # None without the openssl command
+    import subprocess
+    cert, key = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+    try:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                        "-keyout", key, "-out", cert], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return cert, key
+
+def _tls_echo_server(certfile, keyfile):
+    # Echoes on every TLS connection; returns the port
+    import ssl
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(certfile, keyfile)
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(4)
+
+    def echo(conn):
+        try:
+            with ctx.wrap_socket(conn, server_side=True) as t:
+                while True:
+                    data = t.recv(65536)
+                    if not data:
+                        break
+                    t.sendall(data)
+        except OSError:
+            pass  # client went away mid-handshake
+
+    def serve():
+        while True:
+            conn, _ = srv.accept()
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return srv.getsockname()[1]
+
+def test_tls_cache():
+    print("Testing the ESP32's TLS contexts and sessions...")
+    import tempfile
+    sim.install()
+    tmp = tempfile.mkdtemp()
+    pem = _tls_cert(tmp)
+    if pem is None:
+        print("  SKIP: no openssl command")
+        return
+    port = _tls_echo_server(*pem)
+
+    import esp32_config
+    esp32_config.AUTOSTART = False
+    from esp32_proxy import TLSCache, OpError
+    cache = TLSCache(cafile=None)
+    try:
+        cache.context(verify=True)
+        assert False, "verify without CA certificates"
+    except OpError as e:
+        assert e.error == "no_ca"
+    cache = TLSCache(cafile=pem[0])
+    t = cache.wrap(socket.create_connection(("127.0.0.1", port)), "localhost", verify=True)
+    t.sendall(b"ok")
+    assert t.recv(2) == b"ok"
+    t.close()
+    assert cache.context(True) is cache.context(True) and cache.contexts == 1
+
+    from pico_client import ProxySocket
+    for kw in ({}, {"nonblocking": True}, {"async_proxy": True}):
+        with sim.Loopback(**kw) as lb:
+            client = lb.client()
+            client.negotiate()
+            for reuse in (True, True, True, False):
+                s = ProxySocket(client)
+                s.connect(("127.0.0.1", port), ssl=True)
+                s.wrap_ssl("localhost", reuse=reuse)
+                s.sendall(b"hello")
+                assert s.recv(5, ssl=True) == b"hello"
+                s.close()
+            try:
+                ProxySocket.open_connection(client, "127.0.0.1", port, verify=True)
+                assert False, "verify without TLS_CAFILE"
+            except OSError as e:
+                assert "no_ca" in str(e)
+            st = client.call("proxy_stats")["tls"]
+            # One context for the three with reuse, and resumed sessions
+            assert st["contexts"] == 2 and st["handshakes"] == 4 and st["resumed"] == 2
+        print(f"  {kw or 'blocking'}: {st}")
+    print("  TLS cache: PASS")
+
+def test_sock_table():
+    print("Testing the ESP32's socket table...")
+    sim.install()
+    import esp32_config
+    esp32_config.AUTOSTART = False
+    from esp32_proxy import SockTable, OpError
+    tab = SockTable(slots=2)
+    a = tab.new(socket.AF_INET, socket.SOCK_STREAM)
+    b = tab.new(socket.AF_INET, socket.SOCK_DGRAM)
+    assert (a, b) == (1, 2) and len(tab) == 2
+    try:
+        tab.new(socket.AF_INET, socket.SOCK_STREAM)
+        assert False, "a third socket in two slots"
+    except OpError as e:
+        assert e.error == "no_free_sid" and tab.full == 1
+    tab.close(a)
+    c = tab.new(socket.AF_INET, socket.SOCK_STREAM)
+    assert c != a and c & 0xFF == a  # same slot, next generation
+    try:
+        tab.get(a)
+        assert False, "stale sid"
+    except KeyError:
+        assert tab.stale == 1
+    tab.io(c, rx=5, tx=7)
+    assert [(sid, sl.typ, sl.rx, sl.tx) for sid, sl in tab.sids()] == [
+        (c, socket.SOCK_STREAM, 5, 7), (b, socket.SOCK_DGRAM, 0, 0)]
+    tab.close_all()
+    assert len(tab) == 0
+
+    from pico_client import ProxySocket
+    with sim.Loopback() as lb:
+        client = lb.client()
+        client.negotiate()
+        port, _ = _keepalive_server()
+        s = ProxySocket(client)
+        s.connect(("127.0.0.1", port))
+        stale = s.sid
+        s.close()
+        s = ProxySocket(client)
+        s.connect(("127.0.0.1", port))
+        assert s.sid != stale
+        s.sendall(b"hello")
+        assert s.recv(5) == b"hello"
+        try:
+            client.call("sock_send", {"sid": stale, "data": b"x"})
+            assert False, "send on a closed sid"
+        except OSError as e:
+            assert "invalid_sid" in str(e)
+        s.close()
+        st = client.call("proxy_stats")["socks"]
+        assert st["open"] == 0 and st["opened"] == 2 and st["stale"] == 1
+    print(f"  {st}")
+    print("  Socket table: PASS")
+
+def run_all_tests():
+    print("=" * 50)
+    print("Running Simulator Tests")
+    print("=" * 50)
+
+    tests = [
+        test_ping,
+        test_echo_clean,
+        test_echo_lossy,
+        test_large_window,
+        test_late_retransmit,
+        test_nonblocking,
+        test_async_proxy,
+        test_async_client,
+        test_stream,
+        test_flow_control,
+        test_resp_cache,
+        test_gc_policy,
+        test_uart_wait,
+        test_batch,
+        test_dns_cache,
+        test_conn_pool,
+        test_tls_cache,
+        test_sock_table,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except AssertionError as e:
+            print(f"  FAIL: {e}")
+            failed += 1
+        except Exception as e:
+            print(f"  ERROR: {e}")
+            failed += 1
+
+    print("=" * 50)
+    print(f"Results: {passed} passed, {failed} failed")
+    print("=" * 50)
+
+    return failed == 0
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)